@@ -149,6 +149,47 @@ def print_default_config_register_subparser(subparser):
     return
 
 
+def prepare_reference_register_subparser(subparser):
+    parser = subparser.add_parser('prepare-reference',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Encode reference fasta and precompute the cytosine context table once "
+                                       "for ALLC calling, all ALLC workers share them through memmap.")
+
+    parser_req = parser.add_argument_group("Required inputs")
+    parser_opt = parser.add_argument_group("Optional inputs")
+
+    parser_req.add_argument(
+        "--reference_fasta",
+        type=str,
+        required=True,
+        help="Reference fasta file indexed by samtools faidx, "
+             "same as reference_fasta in callMethylation config"
+    )
+
+    parser_opt.add_argument(
+        "--num_upstr_bases",
+        type=int,
+        required=False,
+        default=0,
+        help="Number of base before mC for the context table, same as callMethylation config"
+    )
+
+    parser_opt.add_argument(
+        "--num_downstr_bases",
+        type=int,
+        required=False,
+        default=2,
+        help="Number of base after mC for the context table, same as callMethylation config"
+    )
+
+    parser_opt.add_argument(
+        "--overwrite",
+        action='store_true',
+        help="Rebuild the prepared reference and context table even if they exist"
+    )
+    return
+
+
 def batch_pipeline_register_subparser(subparser):
     parser = subparser.add_parser('mapping-qsub',
                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -460,6 +501,40 @@ def allc_to_bigwig_register_subparser(subparser):
     return
 
 
+def allc_convert_register_subparser(subparser):
+    parser = subparser.add_parser('allc-convert',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                  help="Convert text ALLC to binary ALLC (.allc.npz) or binary ALLC to text ALLC, "
+                                       "the direction is judged by the input format.")
+
+    parser_req = parser.add_argument_group("Required inputs")
+    parser_opt = parser.add_argument_group("Optional inputs")
+
+    parser_req.add_argument(
+        "--allc_path",
+        type=str,
+        required=True,
+        help="Path of the input ALLC file, text or binary."
+    )
+
+    parser_req.add_argument(
+        "--out_path",
+        type=str,
+        required=True,
+        help="Path of the output ALLC file. "
+             "Text output ends with gz is BGZF compressed together with the tabix index."
+    )
+
+    parser_opt.add_argument(
+        "--cpu",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of threads to compress text output."
+    )
+    return
+
+
 def simulate_read_genome_cov_register_subparser(subparser):
     parser = subparser.add_parser('simulate-long-reads-coverage',
                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -699,6 +774,8 @@ def main():
         from .mapping.pipeline import pipeline as func
     elif cur_command == 'default-mapping-config':
         from .mapping.pipeline import print_default_configuration as func
+    elif cur_command == 'prepare-reference':
+        from .mapping.reference import prepare_allc_reference as func
     elif cur_command == 'mapping-qsub':
         from .local.mc.prepare_allc import batch_pipeline as func
     elif cur_command == 'generate-dataset':
@@ -719,6 +796,8 @@ def main():
         from .tools.simulation import simulate_allc as func
     elif cur_command == 'allc-extract':
         from .tools.allc import extract_context_allc as func
+    elif cur_command == 'allc-convert':
+        from .tools.allc_io import convert_allc as func
     else:
         log.debug(f'{cur_command} not Known, check the main function if else part')
         parser.parse_args(["-h"])
@@ -217,18 +217,36 @@ import subprocess
 import shlex
 import pathlib
 import gzip
+import re
+import numpy as np
 import pandas as pd
 import multiprocessing
-import collections
-
-
-def _read_faidx(faidx_path):
-    """
-    Read fadix of reference fasta file
-    samtools fadix ref.fa
-    """
-    return pd.read_table(faidx_path, index_col=0, header=None,
-                         names=['NAME', 'LENGTH', 'OFFSET', 'LINEBASES', 'LINEWIDTH'])
+import itertools
+import functools
+import shutil
+import logging
+from ..tools.bgzf import BgzfWriter, TabixIndex, BGZF_EOF
+from .allc_stats import SiteStats, write_site_stats_tables
+from .usage import run, run_in_unit, usage_unit, ProcessUsage
+from .reference import _read_faidx, prepare_reference, read_prepared_reference, get_chromosome_array, \
+    get_site_contexts, prepare_context_table, read_context_table, get_chromosome_context, lookup_site_contexts
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# samtools mpileup default read filter: UNMAP, SECONDARY, QCFAIL, DUP
+_MPILEUP_SKIP_FLAG = 0x4 | 0x100 | 0x200 | 0x400
+# number of reads the pysam engine expands into numpy arrays at once
+_PILEUP_CHUNK_READS = 50000
+# read start marker and the mapping quality character follow it, e.g. "^~."
+_READ_START_PATTERN = re.compile(r'\^.')
+# indel marker and its length, followed by length bases of the indel, e.g. "+2AC"
+_INDEL_PATTERN = re.compile(rb'[+-]([0-9]+)')
+# mpileup bases counted by the mpileup engine, unconverted C, converted C, unconverted G, converted G
+_COUNT_BASES = np.frombuffer(b'.T,a', dtype=np.uint8)
+# number of mpileup C/G lines decoded together
+_DECODE_BATCH_LINES = 50000
 
 
 def _get_chromosome_sequence(fasta_path, fai_df, query_chrom):
@@ -240,19 +258,122 @@ def _get_chromosome_sequence(fasta_path, fai_df, query_chrom):
     else:
         chrom_pointer = fai_df.loc[query_chrom, 'OFFSET']
         tail = fai_df.loc[query_chrom, 'LINEBASES'] - fai_df.loc[query_chrom, 'LINEWIDTH']
-        seq = ""
+        lines = []
         with open(fasta_path, 'r') as f:
             f.seek(chrom_pointer)
             for line in f:
                 if line[0] == '>':
                     break
-                seq += line[:tail]  # trim \n
-        return seq
+                lines.append(line[:tail])  # trim \n
+        return ''.join(lines)
+
+
+def _load_chromosome(reference_fasta, fai_df, prepared_reference, query_chrom):
+    """
+    Get the upper case uint8 chromosome sequence, slice it from the prepared reference if available,
+    otherwise read it from fasta.
+    """
+    if prepared_reference is not None:
+        return get_chromosome_array(prepared_reference, query_chrom)
+    seq = _get_chromosome_sequence(reference_fasta, fai_df, query_chrom)
+    if seq is None:
+        return None
+    return np.frombuffer(seq.upper().encode(), dtype=np.uint8)
+
+
+def _get_allc_path(bam_path):
+    """ALLC output path of a final bam file"""
+    input_path = pathlib.Path(bam_path)
+    allc_name = 'allc_' + input_path.name.split('.')[0] + '.tsv.gz'
+    return str(input_path.parent / allc_name)
+
+
+def _write_allc_index(output_path, chr_out_pos_list):
+    with open(output_path + '.idx', 'w') as idx_f:
+        for (chrom, out_pos) in chr_out_pos_list:
+            idx_f.write(f'{chrom}\t{out_pos}\n')
+        idx_f.write('#eof\n')  # methylpy idx end
+    return
+
+
+def _open_allc_writer(output_path, bgzip, compress_threads):
+    """Return the ALLC output handle and a TabixIndex to fill (None for plain gzip)"""
+    if bgzip:
+        return BgzfWriter(output_path, threads=compress_threads), TabixIndex()
+    else:
+        return gzip.open(output_path, 'wt'), None
+
+
+def _iter_mpileup_lines(mpileup_cmd, regions):
+    """Run samtools mpileup for the whole bam or one region after another, yield text lines"""
+    if regions is None:
+        cmd_list = [mpileup_cmd]
+    else:
+        cmd_list = [f'{mpileup_cmd} -r {region}' for region in regions]
+    for cmd in cmd_list:
+        pipes = subprocess.Popen(shlex.split(cmd),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+        usage = ProcessUsage(pipes)
+        result_handle = pipes.stdout
+        yield from result_handle
+        result_handle.close()
+        usage.wait()
+
+
+def _count_read_bases(read_bases_list):
+    """
+    Decode the read bases column of many mpileup lines together.
+    Read start markers are removed first, their mapping quality character can be ".", ",", "T" or "a",
+    which were counted as bases before. Then "+N"/"-N" indels with their N bases are removed,
+    same as the old per character scan. A "+" or "-" without number is kept.
+
+    Parameters
+    ----------
+    read_bases_list
+        list of mpileup read bases strings (5th column)
+    Returns
+    -------
+    int64 array of shape (n_lines, 4), the number of ".", "T", "," and "a" of each line
+    """
+    n_lines = len(read_bases_list)
+    if n_lines == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    # newline never appear in the read bases column, so lines can be processed as one string
+    text = _READ_START_PATTERN.sub('', '\n'.join(read_bases_list)).encode()
+    data = np.frombuffer(text, dtype=np.uint8)
+    is_newline = data == ord('\n')
+    line_id = np.cumsum(is_newline) - is_newline
+
+    # mask indels, a marker inside the bases of the previous indel is skipped, same as the old scan
+    if b'+' in text or b'-' in text:
+        starts = []
+        stops = []
+        for match in _INDEL_PATTERN.finditer(text):
+            if len(stops) > 0 and match.start() < stops[-1]:
+                continue
+            # indel can not extend into the next line
+            line_end = text.find(b'\n', match.end())
+            line_end = len(text) if line_end < 0 else line_end
+            starts.append(match.start())
+            stops.append(min(match.end() + int(match.group(1)), line_end))
+        if len(starts) > 0:
+            delta = np.zeros(data.size + 1, dtype=np.int64)
+            np.add.at(delta, starts, 1)
+            np.add.at(delta, stops, -1)
+            data = np.where(np.cumsum(delta[:-1]) > 0, 0, data)
+
+    counts = np.zeros((n_lines, 4), dtype=np.int64)
+    for i, base in enumerate(_COUNT_BASES):
+        counts[:, i] = np.bincount(line_id[data == base], minlength=n_lines)
+    return counts
 
 
 def _call_methylated_sites_worker(bam_path, reference_fasta,
                                   num_upstr_bases, num_downstr_bases,
-                                  buffer_line_number, min_mapq, min_base_quality):
+                                  buffer_line_number, min_mapq, min_base_quality,
+                                  regions=None, output_path=None, bgzip=False, compress_threads=1):
     """
     Main ALLC calling function. Take one bam file, use samtools mpileup to call variants
     and pipe to this function to generate mC and cov count. Only for single cell, not base level statistics.
@@ -273,34 +394,45 @@ def _call_methylated_sites_worker(bam_path, reference_fasta,
         minimum MAPQ for a read being considered, samtools mpileup parameter
     min_base_quality
         minimum base quality for a base being considered, samtools mpileup parameter
+    regions
+        if not None, only call these chromosomes (a shard of the bam file), bam need to be indexed
+    output_path
+        output ALLC path, if None, use allc_{bam name}.tsv.gz in the bam dir
+    bgzip
+        if True, write BGZF blocks and build the tabix index along the way, otherwise write plain gzip
+    compress_threads
+        number of threads to compress BGZF blocks
     Returns
     -------
     count_df
         A dataframe contain all mC context summary counts.
+    chr_out_pos_list
+        list of (chrom, uncompressed start offset) for the methylpy idx
+    out_size
+        uncompressed size of the ALLC output
+    tabix_index
+        resolved TabixIndex of the output if bgzip is True, otherwise None
+    site_stats
+        SiteStats of all written sites
     """
     # Check fasta index
     if not pathlib.Path(reference_fasta + ".fai").exists():
         raise FileNotFoundError("Reference fasta not indexed. Use samtools faidx to index it and run again.")
     fai_df = _read_faidx(pathlib.Path(reference_fasta + ".fai"))
+    prepared_reference = read_prepared_reference(reference_fasta)
 
     if not pathlib.Path(bam_path + ".bai").exists():
-        subprocess.check_call(shlex.split("samtools index " + bam_path))
+        run(shlex.split("samtools index " + bam_path), check=True)
 
     # mpileup
     mpileup_cmd = f"samtools mpileup -Q {min_base_quality} " \
                   f"-q {min_mapq} -B -f {reference_fasta} {bam_path}"
-    pipes = subprocess.Popen(shlex.split(mpileup_cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-    result_handle = pipes.stdout
+    result_handle = _iter_mpileup_lines(mpileup_cmd, regions)
 
     # Output handel
-    input_path = pathlib.Path(bam_path)
-    file_dir = input_path.parent
-    allc_name = 'allc_' + input_path.name.split('.')[0] + '.tsv.gz'
-    output_path = str(file_dir / allc_name)
-    output_file_handler = gzip.open(output_path, 'wt')
+    if output_path is None:
+        output_path = _get_allc_path(bam_path)
+    output_file_handler, tabix_index = _open_allc_writer(output_path, bgzip, compress_threads)
 
     # initialize variables
     complement = {"A": "T",
@@ -308,131 +440,455 @@ def _call_methylated_sites_worker(bam_path, reference_fasta,
                   "C": "G",
                   "G": "C",
                   "N": "N"}
-    mc_sites = {'C', 'G'}
     context_len = num_upstr_bases + 1 + num_downstr_bases
     cur_chrom = ""
-    line_counts = 0
-    out = ""
     seq = None  # whole cur_chrom seq
     chr_out_pos_list = []
     cur_out_pos = 0
-    cov_dict = collections.defaultdict(int)  # context: cov_total
-    mc_dict = collections.defaultdict(int)  # context: mc_total
+    site_stats = SiteStats(num_upstr_bases)
+    # C/G lines of cur_chrom not decoded yet, pos (1-based), strand, context, read bases
+    batch = ([], [], [], [])
+    out_lines = []
+
+    def _flush_batch():
+        nonlocal cur_out_pos
+        pos, strand, context, read_bases = batch
+        if len(pos) == 0:
+            return
+        counts = _count_read_bases(read_bases)
+        minus_strand = np.array(strand) == '-'
+        mc = np.where(minus_strand, counts[:, 2], counts[:, 0])
+        cov = mc + np.where(minus_strand, counts[:, 3], counts[:, 1])
+        keep = cov > 0
+        batch_context = np.array(context)[keep]
+        batch_pos = np.array(pos)[keep]
+        lines = [f'{cur_chrom}\t{p}\t{s}\t{c}\t{m}\t{v}\t1\n'
+                 for p, s, c, m, v in zip(batch_pos.tolist(), np.array(strand)[keep], batch_context,
+                                          mc[keep].tolist(), cov[keep].tolist())]
+        if tabix_index is not None and len(lines) > 0:
+            line_end = cur_out_pos + np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)))
+            tabix_index.add_batch(cur_chrom, batch_pos, np.append(cur_out_pos, line_end[:-1]), line_end)
+        cur_out_pos += sum(map(len, lines))
+        out_lines.extend(lines)
+        site_stats.add(cur_chrom, batch_context, mc[keep], cov[keep])
+        for values in batch:
+            values.clear()
+        return
 
     # process mpileup result
     for line in result_handle:
-        fields = line.split("\t")
-        fields[2] = fields[2].upper()
+        fields = line.split("\t", 5)
+        ref_base = fields[2].upper()
         # if chrom changed, read whole chrom seq from fasta
         if fields[0] != cur_chrom:
+            _flush_batch()
             cur_chrom = fields[0]
             chr_out_pos_list.append((cur_chrom, str(cur_out_pos)))
             # get seq for cur_chrom
-            seq = _get_chromosome_sequence(reference_fasta, fai_df, cur_chrom)
-            if seq is not None:
-                seq = seq.upper()
+            seq = _load_chromosome(reference_fasta, fai_df, prepared_reference, cur_chrom)
 
         if seq is None:
             continue
-        if fields[2] not in mc_sites:
-            continue
-
-        # indels
-        read_bases = fields[4]
-        incons_basecalls = read_bases.count("+") + read_bases.count("-")
-        if incons_basecalls > 0:
-            read_bases_no_indel = ""
-            index = 0
-            prev_index = 0
-            while index < len(read_bases):
-                if read_bases[index] == "+" or read_bases[index] == "-":
-                    # get insert size
-                    indel_size = ""
-                    ind = index + 1
-                    while True:
-                        try:
-                            int(read_bases[ind])
-                            indel_size += read_bases[ind]
-                            ind += 1
-                        except:
-                            break
-                    try:
-                        # sometimes +/- does not follow by a number and
-                        # it should be ignored
-                        indel_size = int(indel_size)
-                    except:
-                        index += 1
-                        continue
-                    read_bases_no_indel += read_bases[prev_index:index]
-                    index = ind + indel_size
-                    prev_index = index
-                else:
-                    index += 1
-            read_bases_no_indel += read_bases[prev_index:index]
-            fields[4] = read_bases_no_indel
-
-        # count converted and unconverted bases
-        if fields[2] == "C":
+        if ref_base == "C":
             pos = int(fields[1]) - 1
             try:
-                context = seq[(pos - num_upstr_bases):(pos + num_downstr_bases + 1)]
+                context = seq[(pos - num_upstr_bases):(pos + num_downstr_bases + 1)].tobytes().decode()
             except:  # complete context is not available, skip
                 continue
-            unconverted_c = fields[4].count(".")
-            converted_c = fields[4].count("T")
-            cov = unconverted_c + converted_c
-            if cov > 0 and len(context) == context_len:
-                line_counts += 1
-                data = "\t".join([cur_chrom, str(pos + 1), "+", context,
-                                  str(unconverted_c), str(cov), "1"]) + "\n"
-                cov_dict[context] += cov
-                mc_dict[context] += unconverted_c
-                out += data
-                cur_out_pos += len(data)
-
-        elif fields[2] == "G":
+        elif ref_base == "G":
             pos = int(fields[1]) - 1
             try:
                 context = "".join([complement[base]
                                    for base in reversed(
-                        seq[(pos - num_downstr_bases):(pos + num_upstr_bases + 1)]
+                        seq[(pos - num_downstr_bases):(pos + num_upstr_bases + 1)].tobytes().decode()
                     )]
                                   )
             except:  # complete context is not available, skip
                 continue
-            unconverted_c = fields[4].count(",")
-            converted_c = fields[4].count("a")
-            cov = unconverted_c + converted_c
-            if cov > 0 and len(context) == context_len:
-                line_counts += 1
-                data = "\t".join([cur_chrom, str(pos + 1), "-", context,
-                                  str(unconverted_c), str(cov), "1"]) + "\n"
-                cov_dict[context] += cov
-                mc_dict[context] += unconverted_c
-                out += data
-                cur_out_pos += len(data)
-
-        if line_counts > buffer_line_number:
+        else:
+            continue
+        if len(context) != context_len:
+            continue
+        batch[0].append(pos + 1)
+        batch[1].append('+' if ref_base == 'C' else '-')
+        batch[2].append(context)
+        batch[3].append(fields[4])
+
+        if len(batch[0]) >= _DECODE_BATCH_LINES:
+            _flush_batch()
+        if len(out_lines) > buffer_line_number:
+            output_file_handler.write(''.join(out_lines))
+            out_lines.clear()
+
+    _flush_batch()
+    if len(out_lines) > 0:
+        output_file_handler.write(''.join(out_lines))
+    output_file_handler.close()
+    if tabix_index is not None:
+        tabix_index.resolve(output_file_handler)
+
+    return site_stats.count_df(), chr_out_pos_list, cur_out_pos, tabix_index, site_stats
+
+
+def _count_read_chunk(reads, seq, min_base_quality):
+    """
+    Walk CIGAR of a chunk of reads and expand all aligned blocks into reference positions together.
+    Only C (forward reads) and G (reverse reads) reference positions with a C/T or G/A read base are kept,
+    which are the ".", "T", "," and "a" bases counted in the mpileup engine.
+
+    Returns
+    -------
+    pos
+        0-based reference positions, sorted
+    mc
+        number of unconverted bases at each position
+    cov
+        number of unconverted and converted bases at each position
+    """
+    block_ref_start = []
+    block_query_start = []
+    block_length = []
+    block_reverse = []
+    query_seqs = []
+    query_quals = []
+    query_offset = 0
+    for read in reads:
+        query_seq = read.query_sequence
+        ref_pos = read.reference_start
+        query_pos = query_offset
+        for op, length in read.cigartuples:
+            if op == 0 or op == 7 or op == 8:  # M, =, X
+                block_ref_start.append(ref_pos)
+                block_query_start.append(query_pos)
+                block_length.append(length)
+                block_reverse.append(read.is_reverse)
+                ref_pos += length
+                query_pos += length
+            elif op == 1 or op == 4:  # I, S
+                query_pos += length
+            elif op == 2 or op == 3:  # D, N
+                ref_pos += length
+        quals = read.query_qualities
+        query_seqs.append(query_seq)
+        # missing base quality is 0xff in BAM, which always pass the filter
+        query_quals.append(b'\xff' * len(query_seq) if quals is None else quals.tobytes())
+        query_offset += len(query_seq)
+
+    length = np.array(block_length, dtype=np.int64)
+    block_id = np.repeat(np.arange(length.size), length)
+    within = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+    ref_pos = np.array(block_ref_start, dtype=np.int64)[block_id] + within
+    query_pos = np.array(block_query_start, dtype=np.int64)[block_id] + within
+    reverse = np.array(block_reverse, dtype=bool)[block_id]
+
+    bases = np.frombuffer(''.join(query_seqs).encode(), dtype=np.uint8)[query_pos]
+    quals = np.frombuffer(b''.join(query_quals), dtype=np.uint8)[query_pos]
+    in_seq = ref_pos < seq.size
+    ref = np.zeros_like(bases)
+    ref[in_seq] = seq[ref_pos[in_seq]]
+
+    c_site = ~reverse & (ref == ord('C')) & ((bases == ord('C')) | (bases == ord('T')))
+    g_site = reverse & (ref == ord('G')) & ((bases == ord('G')) | (bases == ord('A')))
+    keep = (c_site | g_site) & (quals >= min_base_quality)
+    return _sum_site_counts(ref_pos[keep], (bases == ref)[keep].astype(np.int64), np.ones(keep.sum(), dtype=np.int64))
+
+
+def _sum_site_counts(pos, mc, cov):
+    """Sum mc and cov for duplicated positions, return sorted unique positions"""
+    pos, inverse = np.unique(pos, return_inverse=True)
+    mc = np.bincount(inverse, weights=mc, minlength=pos.size).astype(np.int64)
+    cov = np.bincount(inverse, weights=cov, minlength=pos.size).astype(np.int64)
+    return pos, mc, cov
+
+
+def _pileup_c_sites(read_iter, reference_fasta, fai_df, prepared_reference, min_mapq, min_base_quality):
+    """
+    Generator of the pysam engine, read coordinate sorted alignments from read_iter
+    and yield (chrom, seq, pos, mc, cov) for each batch of finished C sites.
+    Every chromosome that has reads yield an empty batch first, so its start is recorded in the idx.
+    Reads are filtered the same way as samtools mpileup default.
+    """
+    cur_chrom_id = None
+    cur_chrom = None
+    seq = None
+    chunk = []
+    pending = (np.array([], dtype=np.int64),) * 3
+    empty = pending
+
+    def _flush(boundary):
+        nonlocal pending
+        if len(chunk) > 0:
+            chunk_counts = _count_read_chunk(chunk, seq, min_base_quality)
+            pending = _sum_site_counts(*[np.concatenate([p, c]) for p, c in zip(pending, chunk_counts)])
+            chunk.clear()
+        if boundary is None:
+            finished, pending = pending, empty
+        else:
+            n_finished = np.searchsorted(pending[0], boundary)
+            finished = tuple(p[:n_finished] for p in pending)
+            pending = tuple(p[n_finished:] for p in pending)
+        return finished
+
+    for read in read_iter:
+        if read.flag & _MPILEUP_SKIP_FLAG or read.mapping_quality < min_mapq:
+            continue
+        if read.is_paired and not read.is_proper_pair:
+            continue
+        if read.reference_id != cur_chrom_id:
+            if seq is not None:
+                yield (cur_chrom, seq) + _flush(None)
+            cur_chrom_id = read.reference_id
+            cur_chrom = read.reference_name
+            seq = _load_chromosome(reference_fasta, fai_df, prepared_reference, cur_chrom)
+            yield (cur_chrom, seq) + empty
+        if seq is None:
+            continue
+        chunk.append(read)
+        if len(chunk) >= _PILEUP_CHUNK_READS:
+            # reads are sorted, no later read can cover positions before the start of the last read
+            yield (cur_chrom, seq) + _flush(read.reference_start)
+    if seq is not None:
+        yield (cur_chrom, seq) + _flush(None)
+
+
+def _call_methylated_sites_pysam_worker(bam_path, reference_fasta,
+                                        num_upstr_bases, num_downstr_bases,
+                                        buffer_line_number, min_mapq, min_base_quality,
+                                        regions=None, output_path=None, bgzip=False, compress_threads=1):
+    """
+    Same as _call_methylated_sites_worker, but read the BAM file directly with pysam instead of parsing
+    samtools mpileup text. Reads are counted in chunks by a vectorized CIGAR walker,
+    the ALLC and idx output are the same as the mpileup engine.
+    Site contexts are taken from the precomputed context table if it exists.
+    Sites deeper than the samtools mpileup max depth (-d) are not capped here.
+
+    Parameters
+    ----------
+    See _call_methylated_sites_worker, buffer_line_number is not used,
+    output is written every _PILEUP_CHUNK_READS reads.
+
+    Returns
+    -------
+    See _call_methylated_sites_worker
+    """
+    try:
+        import pysam
+    except ImportError:
+        raise ImportError('pysam is needed for the pysam ALLC calling engine, '
+                          'install it or use engine = mpileup in callMethylation config.')
+
+    # Output handel
+    if output_path is None:
+        output_path = _get_allc_path(bam_path)
+
+    with pysam.AlignmentFile(bam_path, 'rb') as bam:
+        if regions is None:
+            read_iter = bam.fetch(until_eof=True)
+        else:
+            read_iter = itertools.chain.from_iterable(bam.fetch(region) for region in regions)
+        return _call_sites_from_reads(read_iter, output_path, reference_fasta,
+                                     num_upstr_bases, num_downstr_bases, min_mapq, min_base_quality,
+                                     bgzip=bgzip, compress_threads=compress_threads)
+
+
+def _call_sites_from_reads(read_iter, output_path, reference_fasta,
+                          num_upstr_bases, num_downstr_bases, min_mapq, min_base_quality,
+                          bgzip=False, compress_threads=1):
+    """
+    Core of the pysam engine, call ALLC from any iterator of coordinate sorted pysam AlignedSegment,
+    such as reads streamed from the bam processing step without writing a BAM file.
+
+    Returns
+    -------
+    See _call_methylated_sites_worker
+    """
+    # Check fasta index
+    if not pathlib.Path(reference_fasta + ".fai").exists():
+        raise FileNotFoundError("Reference fasta not indexed. Use samtools faidx to index it and run again.")
+    fai_df = _read_faidx(pathlib.Path(reference_fasta + ".fai"))
+    prepared_reference = read_prepared_reference(reference_fasta)
+    context_table = read_context_table(reference_fasta, num_upstr_bases, num_downstr_bases)
+
+    chr_out_pos_list = []
+    cur_out_pos = 0
+    site_stats = SiteStats(num_upstr_bases)
+    output_file_handler, tabix_index = _open_allc_writer(output_path, bgzip, compress_threads)
+    with output_file_handler:
+        for chrom, seq, pos, mc, cov in _pileup_c_sites(read_iter, reference_fasta, fai_df,
+                                                          prepared_reference, min_mapq, min_base_quality):
+            if len(chr_out_pos_list) == 0 or chr_out_pos_list[-1][0] != chrom:
+                chr_out_pos_list.append((chrom, str(cur_out_pos)))
+                chrom_context = None
+                if context_table is not None:
+                    chrom_context = get_chromosome_context(context_table, chrom)
+            if pos.size == 0:
+                continue
+            minus_strand = seq[pos] == ord('G')
+            if chrom_context is not None:
+                context, valid = lookup_site_contexts(context_table, chrom_context, pos)
+            else:
+                context, valid = get_site_contexts(seq, pos, minus_strand, num_upstr_bases, num_downstr_bases)
+            strand = np.where(minus_strand, '-', '+')
+            lines = [f'{chrom}\t{p}\t{s}\t{c}\t{m}\t{v}\t1\n'
+                     for p, s, c, m, v in zip((pos[valid] + 1).tolist(), strand[valid],
+                                              context[valid], mc[valid].tolist(),
+                                              cov[valid].tolist())]
+            out = ''.join(lines)
             output_file_handler.write(out)
-            line_counts = 0
-            out = ""
+            if tabix_index is not None:
+                line_end = cur_out_pos + np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)))
+                tabix_index.add_batch(chrom, pos[valid] + 1, np.append(cur_out_pos, line_end[:-1]), line_end)
+            cur_out_pos += len(out)
+            site_stats.add(chrom, context[valid], mc[valid], cov[valid])
+
+    if tabix_index is not None:
+        tabix_index.resolve(output_file_handler)
+
+    return site_stats.count_df(), chr_out_pos_list, cur_out_pos, tabix_index, site_stats
+
+
+def _read_bam_chroms(bam_path):
+    """Chromosome names and lengths in bam header order"""
+    header = run(shlex.split(f'samtools view -H {bam_path}'),
+                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                 encoding='utf8', check=True).stdout
+    chroms = []
+    for line in header.split('\n'):
+        if not line.startswith('@SQ'):
+            continue
+        fields = dict(field.split(':', 1) for field in line.split('\t')[1:])
+        chroms.append((fields['SN'], int(fields['LN'])))
+    return chroms
 
-    if line_counts > 0:
-        output_file_handler.write(out)
-    result_handle.close()
-    output_file_handler.close()
 
-    with open(output_path + '.idx', 'w') as idx_f:
-        for (chrom, out_pos) in chr_out_pos_list:
-            idx_f.write(f'{chrom}\t{out_pos}\n')
-        idx_f.write('#eof\n')  # methylpy idx end
+def _split_chrom_shards(chroms, shard_number):
+    """
+    Split ordered (chrom, length) list into at most shard_number contiguous shards of similar total length.
+    Shards keep the bam header order, so the stitched ALLC is the same as calling the whole bam.
+    """
+    total_length = sum(length for _, length in chroms)
+    shards = []
+    cur_shard = []
+    cur_length = 0
+    for chrom, length in chroms:
+        cur_shard.append(chrom)
+        cur_length += length
+        if cur_length >= total_length * (len(shards) + 1) / shard_number:
+            shards.append(cur_shard)
+            cur_shard = []
+    if len(cur_shard) > 0:
+        shards.append(cur_shard)
+    return shards
+
+
+def _index_bam(bam_path):
+    if not pathlib.Path(bam_path + ".bai").exists():
+        run(shlex.split("samtools index " + bam_path), check=True)
+    return
 
-    count_df = pd.DataFrame({'mc': mc_dict, 'cov': cov_dict})
-    count_df['mc_rate'] = count_df['mc'] / count_df['cov']
-    return count_df
 
+def _stitch_allc_shards(output_path, part_paths, shard_results):
+    """
+    Concatenate gzip shard parts in order (multi-member gzip) and shift the idx offsets of each shard
+    by the uncompressed size of the previous shards.
+    For BGZF parts, the EOF block of all but the last part is dropped, the tabix index of each shard
+    is shifted by the compressed size of the previous shards.
 
-def call_methylated_sites(bam_result_df, out_dir, config):
+    Returns
+    -------
+    count_df
+        mC context summary counts of all shards
+    site_stats
+        SiteStats of all shards
+    """
+    chr_out_pos_list = []
+    shard_offset = 0
+    compressed_offset = 0
+    site_stats = None
+    tabix_index = None
+    for i, (part_path, shard_result) in enumerate(zip(part_paths, shard_results)):
+        _, part_chr_out_pos_list, part_size, part_tabix_index, part_site_stats = shard_result
+        for chrom, out_pos in part_chr_out_pos_list:
+            chr_out_pos_list.append((chrom, str(int(out_pos) + shard_offset)))
+        shard_offset += part_size
+        if site_stats is None:
+            site_stats = part_site_stats
+        else:
+            site_stats.update(part_site_stats)
+        if part_tabix_index is not None:
+            part_tabix_index.shift(compressed_offset)
+            if tabix_index is None:
+                tabix_index = part_tabix_index
+            else:
+                tabix_index.update(part_tabix_index)
+            compressed_offset += pathlib.Path(part_path).stat().st_size - len(BGZF_EOF)
+
+    if part_paths != [output_path]:
+        with open(output_path, 'wb') as out_f:
+            for i, part_path in enumerate(part_paths):
+                with open(part_path, 'rb') as part_f:
+                    if tabix_index is not None and i < len(part_paths) - 1:
+                        out_f.write(part_f.read()[:-len(BGZF_EOF)])
+                    else:
+                        shutil.copyfileobj(part_f, out_f)
+                pathlib.Path(part_path).unlink()
+    _write_allc_index(output_path, chr_out_pos_list)
+    if tabix_index is not None and len(tabix_index.chroms) > 0:
+        tabix_index.write(output_path + '.tbi')
+
+    return site_stats.count_df(), site_stats
+
+
+def _prepare_call_reference(config):
+    """Build the prepared reference and context table before any ALLC worker start, if config ask for them"""
+    reference_fasta = config['callMethylation']['reference_fasta']
+    # both are optional and off by default, workers use them if they exist (e.g. from yap prepare-reference),
+    # and read the fasta if they can not be written, such as a read only reference dir
+    try:
+        if config['callMethylation'].getboolean('prepare_reference', fallback=False):
+            # one time encoded reference shared by all workers through memmap
+            prepare_reference(reference_fasta)
+        if config['callMethylation'].getboolean('context_table', fallback=False):
+            prepare_context_table(reference_fasta,
+                                  int(config['callMethylation']['num_upstr_bases']),
+                                  int(config['callMethylation']['num_downstr_bases']))
+    except FileNotFoundError:
+        # fasta not indexed, workers need the fai too
+        raise
+    except OSError as e:
+        log.warning(f'Can not prepare reference next to {reference_fasta}, ALLC workers read the fasta. {e}')
+    return
+
+
+def _get_call_worker(config):
+    """ALLC calling worker of the engine in config, call it as worker(bam_path, regions=..., output_path=...)"""
+    engine = config['callMethylation'].get('engine', 'mpileup')
+    if engine == 'mpileup':
+        worker = _call_methylated_sites_worker
+    elif engine == 'pysam':
+        worker = _call_methylated_sites_pysam_worker
+    else:
+        raise ValueError(f'Unknown ALLC calling engine {engine}, use mpileup or pysam.')
+    return functools.partial(worker,
+                             reference_fasta=config['callMethylation']['reference_fasta'],
+                             num_upstr_bases=int(config['callMethylation']['num_upstr_bases']),
+                             num_downstr_bases=int(config['callMethylation']['num_downstr_bases']),
+                             buffer_line_number=int(config['callMethylation']['buffer_line_number']),
+                             min_mapq=int(config['callMethylation']['min_mapq']),
+                             min_base_quality=int(config['callMethylation']['min_base_quality']),
+                             bgzip=config['callMethylation'].getboolean('bgzip', fallback=True),
+                             compress_threads=int(config['callMethylation'].get('compress_threads', '1')))
+
+
+def _get_allc_part_paths(final_bam_path, shard_number):
+    """ALLC path of the cell and the part path of each shard, a single shard write the ALLC directly"""
+    allc_path = _get_allc_path(final_bam_path)
+    if shard_number == 1:
+        return allc_path, [allc_path]
+    return allc_path, [f'{allc_path}.part{i}' for i in range(shard_number)]
+
+
+def call_methylated_sites(bam_result_df, out_dir, config, stat_dir=None):
     """
     Parallel function for ALLC calling.
 
@@ -444,36 +900,61 @@ def call_methylated_sites(bam_result_df, out_dir, config):
         universal pipeline out_dir
     config
         universal pipeline config
+    stat_dir
+        if not None, site level stats tables collected during calling are written into it,
+        see allc_stats.write_site_stats_tables
     Returns
     -------
     allc_count_df
         id columns are: uid, index_name
     """
-    reference_fasta = config['callMethylation']['reference_fasta']
-    num_upstr_bases = int(config['callMethylation']['num_upstr_bases'])
-    num_downstr_bases = int(config['callMethylation']['num_downstr_bases'])
-    buffer_line_number = int(config['callMethylation']['buffer_line_number'])
-    min_mapq = int(config['callMethylation']['min_mapq'])
-    min_base_quality = int(config['callMethylation']['min_base_quality'])
     cores = int(config['callMethylation']['cores'])
+    worker = _get_call_worker(config)
+    _prepare_call_reference(config)
+    shard_number = int(config['callMethylation'].get('shard_number', '1'))
+
+    # large cells first, so they don't decide the wall time at the end
+    cell_reads = bam_result_df.groupby(['uid', 'index_name'])['out_reads'] \
+        .apply(lambda i: i.astype(int).sum()).sort_values(ascending=False)
 
     pool = multiprocessing.Pool(cores)
+    cell_shards = {}
+    for (uid, index_name) in cell_reads.index:
+        final_bam_path = str(pathlib.Path(out_dir) / f'{uid}_{index_name}.final.bam')
+        if shard_number > 1:
+            with usage_unit('allc', uid, index_name):
+                shards = _split_chrom_shards(_read_bam_chroms(final_bam_path), shard_number)
+        else:
+            shards = [None]
+        cell_shards[(uid, index_name)] = (final_bam_path, shards)
+    if shard_number > 1:
+        # region query need bam index, make it before any shard start
+        pool.starmap(run_in_unit, [(('allc', uid, index_name), _index_bam, bam_path)
+                                   for (uid, index_name), (bam_path, _) in cell_shards.items()])
+
+    # each (cell, shard) is one unit in the pool
     results = {}
-    for (uid, index_name), _ in bam_result_df.groupby(['uid', 'index_name']):
-        final_bam_path = pathlib.Path(out_dir) / f'{uid}_{index_name}.final.bam'
-        result = pool.apply_async(_call_methylated_sites_worker,
-                                  (str(final_bam_path), reference_fasta,
-                                   num_upstr_bases, num_downstr_bases,
-                                   buffer_line_number, min_mapq, min_base_quality))
-        results[(uid, index_name)] = result
+    for (uid, index_name), (final_bam_path, shards) in cell_shards.items():
+        allc_path, part_paths = _get_allc_part_paths(final_bam_path, len(shards))
+        shard_results = []
+        for regions, part_path in zip(shards, part_paths):
+            result = pool.apply_async(run_in_unit, (('allc', uid, index_name), worker, final_bam_path),
+                                      {'regions': regions, 'output_path': part_path})
+            shard_results.append(result)
+        results[(uid, index_name)] = (allc_path, part_paths, shard_results)
     pool.close()
     pool.join()
 
     total_results = []
-    for (uid, index_name), result in results.items():
-        count_df = result.get()
+    cell_stats = {}
+    for (uid, index_name), (allc_path, part_paths, shard_results) in results.items():
+        count_df, site_stats = _stitch_allc_shards(allc_path, part_paths,
+                                                   [result.get() for result in shard_results])
         count_df['uid'] = uid
         count_df['index_name'] = index_name
         total_results.append(count_df)
+        cell_stats[(uid, index_name)] = site_stats
     allc_count_df = pd.concat(total_results).reset_index(drop=False)
+    if stat_dir is not None:
+        write_site_stats_tables(cell_stats, stat_dir)
     return allc_count_df
@@ -0,0 +1,198 @@
+"""
+Site level statistics of one cell, collected by the ALLC workers in the same pass as calling.
+
+For each mC context, SiteStats keep a coverage histogram, a mC rate histogram and the sums needed by
+tools.allc.get_allc_profile (site count, mc, cov, cov^2, rate, rate^2). For each chromosome, it keeps
+site, mc and cov totals of all contexts, CG and CH. All accumulators are fixed size numpy arrays,
+shards of the same cell are combined by SiteStats.update.
+"""
+
+import pathlib
+import collections
+import numpy as np
+import pandas as pd
+from ..tools.allc import _profile_from_sums
+
+# coverage histogram bins are 0 to MAX_HIST_COV, the last bin count all sites with cov >= MAX_HIST_COV
+MAX_HIST_COV = 100
+# mC rate histogram bins are [0, 0.05), [0.05, 0.1), ..., [0.95, 1], the last bin include rate 1
+RATE_HIST_BINS = 20
+
+# rows of the chromosome totals
+_CHROM_GROUPS = ['', 'CG_', 'CH_']
+_CH_BASES = {'CA', 'CC', 'CT'}
+
+# names of the site_stats_tables, also the file names in the stats dir
+SITE_STATS_TABLES = ['allc_profile_result', 'allc_cov_hist_result', 'allc_rate_hist_result', 'allc_chrom_result']
+
+
+class SiteStats:
+    """
+    Accumulate site level statistics of ALLC records.
+
+    Parameters
+    ----------
+    num_upstr_bases
+        number of base before mC in the context, used to decide CG or CH
+    """
+
+    def __init__(self, num_upstr_bases=0):
+        self.num_upstr_bases = num_upstr_bases
+        # context: cov histogram, int64 [MAX_HIST_COV + 1]
+        self.cov_hist = {}
+        # context: rate histogram, int64 [RATE_HIST_BINS]
+        self.rate_hist = {}
+        # context: int64 [count, mc, cov, cov2]
+        self.int_sums = {}
+        # context: float64 [rate, rate2]
+        self.rate_sums = {}
+        # chrom: int64 [all, CG, CH] x [sites, mc, cov]
+        self.chroms = collections.OrderedDict()
+
+    def context_group(self, context):
+        """CG, CH or None for contexts with N after the mC"""
+        bases = context[self.num_upstr_bases:self.num_upstr_bases + 2]
+        if bases == 'CG':
+            return 'CG'
+        elif bases in _CH_BASES:
+            return 'CH'
+        return None
+
+    def add(self, chrom, context, mc, cov):
+        """Add a batch of sites of one chromosome, context is a str array, mc and cov are int arrays"""
+        if len(context) == 0:
+            return
+        codes, unique_context = pd.factorize(np.asarray(context))
+        n_context = len(unique_context)
+        mc = np.asarray(mc, dtype=np.int64)
+        cov = np.asarray(cov, dtype=np.int64)
+        rate = mc / cov
+
+        cov_bin = np.minimum(cov, MAX_HIST_COV)
+        rate_bin = np.minimum((rate * RATE_HIST_BINS).astype(np.int64), RATE_HIST_BINS - 1)
+        cov_hist = np.bincount(codes * (MAX_HIST_COV + 1) + cov_bin,
+                               minlength=n_context * (MAX_HIST_COV + 1)).reshape(n_context, -1)
+        rate_hist = np.bincount(codes * RATE_HIST_BINS + rate_bin,
+                                minlength=n_context * RATE_HIST_BINS).reshape(n_context, -1)
+        int_sums = np.stack([np.bincount(codes, minlength=n_context),
+                             np.bincount(codes, weights=mc, minlength=n_context),
+                             np.bincount(codes, weights=cov, minlength=n_context),
+                             np.bincount(codes, weights=cov ** 2, minlength=n_context)], axis=1).astype(np.int64)
+        rate_sums = np.stack([np.bincount(codes, weights=rate, minlength=n_context),
+                              np.bincount(codes, weights=rate ** 2, minlength=n_context)], axis=1)
+
+        chrom_totals = self.chroms.setdefault(chrom, np.zeros((len(_CHROM_GROUPS), 3), dtype=np.int64))
+        for i, c in enumerate(unique_context):
+            if c not in self.cov_hist:
+                self.cov_hist[c] = np.zeros(MAX_HIST_COV + 1, dtype=np.int64)
+                self.rate_hist[c] = np.zeros(RATE_HIST_BINS, dtype=np.int64)
+                self.int_sums[c] = np.zeros(4, dtype=np.int64)
+                self.rate_sums[c] = np.zeros(2, dtype=np.float64)
+            self.cov_hist[c] += cov_hist[i]
+            self.rate_hist[c] += rate_hist[i]
+            self.int_sums[c] += int_sums[i]
+            self.rate_sums[c] += rate_sums[i]
+            chrom_totals[0] += int_sums[i, :3]
+            group = self.context_group(c)
+            if group is not None:
+                chrom_totals[_CHROM_GROUPS.index(group + '_')] += int_sums[i, :3]
+        return
+
+    def update(self, other):
+        """Add all statistics of another SiteStats, such as another shard of the same cell"""
+        for c in other.cov_hist:
+            if c not in self.cov_hist:
+                self.cov_hist[c] = other.cov_hist[c].copy()
+                self.rate_hist[c] = other.rate_hist[c].copy()
+                self.int_sums[c] = other.int_sums[c].copy()
+                self.rate_sums[c] = other.rate_sums[c].copy()
+            else:
+                self.cov_hist[c] += other.cov_hist[c]
+                self.rate_hist[c] += other.rate_hist[c]
+                self.int_sums[c] += other.int_sums[c]
+                self.rate_sums[c] += other.rate_sums[c]
+        for chrom, totals in other.chroms.items():
+            if chrom in self.chroms:
+                self.chroms[chrom] += totals
+            else:
+                self.chroms[chrom] = totals.copy()
+        return
+
+    def _sum_df(self):
+        contexts = list(self.int_sums.keys())
+        sum_df = pd.DataFrame(np.array([self.int_sums[c] for c in contexts]).reshape(-1, 4),
+                              index=contexts, columns=['count', 'mc', 'cov', 'cov2'])
+        rate_sums = np.array([self.rate_sums[c] for c in contexts]).reshape(-1, 2)
+        sum_df['rate'] = rate_sums[:, 0]
+        sum_df['rate2'] = rate_sums[:, 1]
+        return sum_df
+
+    def count_df(self):
+        """mc, cov and mc_rate of each context, same as the count_df of ALLC workers"""
+        sum_df = self._sum_df()
+        count_df = sum_df[['mc', 'cov']].copy()
+        count_df['mc_rate'] = count_df['mc'] / count_df['cov']
+        return count_df
+
+    def profile_df(self):
+        """
+        Same columns as tools.allc.get_allc_profile on the whole ALLC (drop_n=False, n_rows=None),
+        with two more rows, CG and CH, for all contexts in each group.
+        """
+        sum_df = self._sum_df()
+        group = sum_df.index.map(self.context_group)
+        group_df = sum_df[group.notna()].groupby(group[group.notna()]).sum()
+        return _profile_from_sums(pd.concat([sum_df, group_df]))
+
+    def cov_hist_df(self):
+        """Number of sites of each context and cov, cov == MAX_HIST_COV count all deeper sites"""
+        records = [(c, cov, n) for c, hist in self.cov_hist.items()
+                   for cov, n in zip(np.flatnonzero(hist).tolist(), hist[hist > 0].tolist())]
+        return pd.DataFrame(records, columns=['context', 'cov', 'sites'])
+
+    def rate_hist_df(self):
+        """Number of sites of each context and mC rate bin, rate_bin is the bin start"""
+        records = [(c, b / RATE_HIST_BINS, n) for c, hist in self.rate_hist.items()
+                   for b, n in zip(np.flatnonzero(hist).tolist(), hist[hist > 0].tolist())]
+        return pd.DataFrame(records, columns=['context', 'rate_bin', 'sites'])
+
+    def chrom_df(self):
+        """sites, mc and cov totals of each chromosome for all contexts, CG and CH"""
+        columns = [group + name for group in _CHROM_GROUPS for name in ['sites', 'mc', 'cov']]
+        chroms = list(self.chroms.keys())
+        data = np.array([self.chroms[chrom].ravel() for chrom in chroms]).reshape(-1, len(columns))
+        chrom_df = pd.DataFrame(data, index=pd.Index(chroms, name='chrom'), columns=columns)
+        return chrom_df.reset_index()
+
+
+def site_stats_tables(cell_stats):
+    """
+    Turn SiteStats of each cell into stats tables, id columns are: uid, index_name
+
+    Parameters
+    ----------
+    cell_stats
+        dict of (uid, index_name): SiteStats
+    Returns
+    -------
+    dict of table name: dataframe, the name is also the file name in the stats dir
+    """
+    tables = collections.defaultdict(list)
+    for (uid, index_name), stats in cell_stats.items():
+        cell_tables = {'allc_profile_result': stats.profile_df().rename_axis('context').reset_index(),
+                       'allc_cov_hist_result': stats.cov_hist_df(),
+                       'allc_rate_hist_result': stats.rate_hist_df(),
+                       'allc_chrom_result': stats.chrom_df()}
+        for name, df in cell_tables.items():
+            df.insert(0, 'index_name', index_name)
+            df.insert(0, 'uid', uid)
+            tables[name].append(df)
+    return {name: pd.concat(dfs, ignore_index=True) for name, dfs in tables.items()}
+
+
+def write_site_stats_tables(cell_stats, stat_dir):
+    """Write site_stats_tables of cell_stats into stat_dir as {name}.tsv.gz, next to allc_total_result"""
+    for name, stat_df in site_stats_tables(cell_stats).items():
+        stat_df.to_csv(pathlib.Path(stat_dir) / f'{name}.tsv.gz',
+                       sep='\t', compression='gzip', index=None)
+    return
@@ -2,27 +2,388 @@
 Input: bismark_result dataframe
 Processes: sort, dedup and mapq filter on bam; merge R1 R2 bam.
 Output: bam_result dataframe
+
+bam_to_allc is the fused version of bam_qc + call_methylated_sites,
+sorted and deduplicated reads are filtered, merged and streamed into the ALLC caller without writing
+dedup, filter and final BAM.
 """
 
+import sys
+import heapq
 import pathlib
+import collections
 import pandas as pd
 import subprocess
-import multiprocessing
 import shlex
-import glob
+import tempfile
+import contextlib
+import signal
+import logging
+from .allc import _call_sites_from_reads, _get_allc_path, _stitch_allc_shards, _prepare_call_reference
+from .allc_stats import write_site_stats_tables
+from .usage import run, run_in_unit, ProcessUsage
+from .scheduler import CoreScheduler
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# the clipped bases of a read are less than its length, so the unclipped 5' end of a later read is at most
+# this many bases before its start. Reads much longer than trimmed illumina reads widen the window when seen.
+DEDUP_MAX_READ_LENGTH = 1000
+# picard cap the duplicate score of a read at Short.MAX_VALUE / 2, so the pair score of two reads fit in a short
+_DEDUP_MAX_SCORE = 16383
+
+
+def _start_pipe(cmds, stdin=None):
+    """
+    Start commands connected by pipes, return [(ProcessUsage, stderr temp file)] of each command,
+    the stdout of the last command is a pipe for the caller to read.
+    stderr go to temp files, so a long log can not block the pipe.
+    """
+    procs = []
+    for cmd in cmds:
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(shlex.split(cmd), stdin=stdin, stdout=subprocess.PIPE, stderr=stderr)
+        if stdin is not None:
+            # only the next command hold the pipe
+            stdin.close()
+        stdin = proc.stdout
+        procs.append((ProcessUsage(proc), stderr))
+    return procs
+
+
+def _wait_pipe(procs, kill=False):
+    """
+    Wait for the commands started by _start_pipe, kill them first if kill.
+    Return the CalledProcessError of the first command failed by itself, None if there is no such command.
+    """
+    # when killed, a command may also die of the closed pipe before the kill
+    killed = (-signal.SIGKILL, -signal.SIGPIPE) if kill else ()
+    error = None
+    for usage, stderr in procs:
+        if kill and usage.proc.returncode is None:
+            usage.proc.kill()
+        returncode = usage.wait()
+        stderr.seek(0)
+        message = stderr.read().decode()
+        stderr.close()
+        if error is None and returncode != 0 and returncode not in killed:
+            error = subprocess.CalledProcessError(returncode, usage.proc.args, stderr=message)
+    return error
+
+
+def _run_pipe(cmds):
+    """
+    Run commands connected by pipes, like cmd1 | cmd2 | cmd3.
+    Return the subprocess.CompletedProcess of the last command, raise CalledProcessError if any command failed.
+    """
+    procs = _start_pipe(cmds[:-1])
+    stdin = procs[-1][0].proc.stdout
+    finished = False
+    try:
+        last = run(shlex.split(cmds[-1]), stdin=stdin,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+        finished = True
+    finally:
+        stdin.close()
+        # if the last command failed, the others may die of the closed pipe, its own error is raised
+        error = _wait_pipe(procs, kill=not finished or last.returncode != 0)
+    if error is not None:
+        raise error
+    last.check_returncode()
+    return last
+
+
+@contextlib.contextmanager
+def _open_bam_pipe(cmds):
+    """
+    Run commands connected by pipes and open the bam written to the stdout of the last one by pysam.
+    If the reading fail or stop early, the commands are killed.
+    CalledProcessError is raised if any command failed, it is also the cause of a failed reading (e.g. empty stream).
+    """
+    import pysam
+
+    procs = _start_pipe(cmds)
+    stdout = procs[-1][0].proc.stdout
+    finished = False
+    try:
+        with pysam.AlignmentFile(stdout, 'rb') as bam:
+            yield bam
+        finished = True
+    finally:
+        stdout.close()
+        error = _wait_pipe(procs, kill=not finished)
+        if error is not None:
+            raise error
 
 
 def _process_bam(cmd_list):
-    """wrapper of bam processing commands"""
-    return [subprocess.run(shlex.split(cmd),
-                           stdout=subprocess.PIPE,
-                           stderr=subprocess.PIPE,
-                           encoding='utf8',
-                           check=True)
+    """wrapper of bam processing commands, a list in cmd_list is run as a pipe"""
+    return [_run_pipe(cmd) if isinstance(cmd, list) else
+            run(shlex.split(cmd),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                encoding='utf8',
+                check=True)
             for cmd in cmd_list]
 
 
-def bam_qc(bismark_result, out_dir, config):
+def _sort_cmd(bismark_bam, threads=2, uncompressed=False, to_stdout=False):
+    """
+    samtools sort command of one bismark bam, return (sort_cmd, sort_bam).
+    The sorted bam is uncompressed if uncompressed, written to stdout if to_stdout (sort_bam is '-').
+    """
+    sort_bam = '-' if to_stdout else bismark_bam[:-3] + 'sort.bam'
+    if to_stdout:
+        # temp files of sort are not put in the working dir
+        options = f'-u -T {bismark_bam[:-3]}sort.tmp '
+    elif uncompressed:
+        options = '-l 0 '
+    else:
+        options = ''
+    return f'samtools sort {options}-o {sort_bam} --threads {threads} {bismark_bam}', sort_bam
+
+
+def _sort_dedup_cmds(bismark_bam, threads=2, uncompressed=False):
+    """
+    sort and picard dedup commands of one bismark bam, return (cmd_list, dedup_bam, dedup_matrix).
+    If uncompressed, the sorted bam and the dedup bam are not compressed.
+    """
+    sort_cmd, sort_bam = _sort_cmd(bismark_bam, threads, uncompressed)
+    dedup_bam = bismark_bam[:-3] + 'dedup.bam'
+    dedup_matrix = bismark_bam[:-3] + 'dedup.matrix.txt'
+    dedup_cmd = f'picard MarkDuplicates I={sort_bam} O={dedup_bam} M={dedup_matrix} REMOVE_DUPLICATES=true'
+    if uncompressed:
+        dedup_cmd += ' COMPRESSION_LEVEL=0'
+    return [sort_cmd, dedup_cmd], dedup_bam, dedup_matrix
+
+
+def _sort_dedup_filter_cmds(bismark_bam, filter_bam, mapq_threshold, threads=2, pipe=False):
+    """
+    sort, picard dedup and MAPQ filter commands of one bismark bam, return (cmd_list, temp_files, dedup_matrix).
+    If pipe, picard write uncompressed bam into the filter by a pipe and the sorted bam is not compressed,
+    only the filter bam is compressed.
+    """
+    cmd_list, dedup_bam, dedup_matrix = _sort_dedup_cmds(bismark_bam, threads, uncompressed=pipe)
+    sort_bam = _sort_cmd(bismark_bam)[1]
+    if pipe:
+        # picard read the input twice, so the sorted bam is still a file
+        dedup_cmd = cmd_list[1].replace(f'O={dedup_bam}', 'O=/dev/stdout') + ' QUIET=true'
+        filter_cmd = f'samtools view -b -h -q {mapq_threshold} -@ {threads} -o {filter_bam} -'
+        return [cmd_list[0], [dedup_cmd, filter_cmd]], [sort_bam, dedup_matrix], dedup_matrix
+    filter_cmd = f'samtools view -b -h -q {mapq_threshold} -o {filter_bam} {dedup_bam}'
+    return cmd_list + [filter_cmd], [sort_bam, dedup_bam, dedup_matrix], dedup_matrix
+
+
+def _parse_dedup_matrix(dedup_matrix):
+    """Read the metrics line of picard MarkDuplicates into a series"""
+    header = True
+    lines = []
+    for _line in pathlib.Path(dedup_matrix).open().read().split('\n'):
+        if _line.startswith('LIBRARY'):
+            header = False
+        if header:
+            continue
+        ll = _line.strip().split('\t')
+        if len(ll) != 1:
+            lines.append(ll)
+    return pd.Series({k: v for k, v in zip(*lines)})
+
+
+def _unclipped_five_prime(read):
+    """5' end of the read on the reference including clipped bases, same as picard"""
+    cigar = read.cigartuples
+    if read.is_reverse:
+        clip = cigar[-1][1] if cigar[-1][0] in (4, 5) else 0
+        return read.reference_end - 1 + clip, clip
+    clip = cigar[0][1] if cigar[0][0] in (4, 5) else 0
+    return read.reference_start - clip, clip
+
+
+def _dedup_reads(reads, stats):
+    """
+    Remove duplicates from coordinate sorted single end reads, the same as picard MarkDuplicates
+    REMOVE_DUPLICATES=true on unpaired reads: mapped reads with the same reference, strand and
+    unclipped 5' end are duplicates, the one with the highest sum of base qualities (>= 15) is kept,
+    the first one if tie. Kept reads are yielded in the input order.
+    A group is yielded only when the reads start DEDUP_MAX_READ_LENGTH after its 5' end, so a later read
+    with a long soft clip still joins it.
+    stats count reads in the same names as the picard metrics.
+    """
+    # [read, keep, key] of reads not yielded yet, in input order
+    pending = collections.deque()
+    # key: (score, entry) of the best read
+    groups = {}
+    window = DEDUP_MAX_READ_LENGTH
+    # (reference_id, 5' end) of the last yielded group
+    yielded_end = (-1, -1)
+    warned = False
+    for read in reads:
+        if read.is_unmapped:
+            stats['UNMAPPED_READS'] += 1
+            entry = [read, True, None]
+        elif read.is_secondary or read.is_supplementary:
+            stats['SECONDARY_OR_SUPPLEMENTARY_RDS'] += 1
+            entry = [read, True, None]
+        else:
+            stats['UNPAIRED_READS_EXAMINED'] += 1
+            five_prime, clip = _unclipped_five_prime(read)
+            window = max(window, clip)
+            key = (read.reference_id, read.is_reverse, five_prime)
+            if not warned and (key[0], five_prime) <= yielded_end:
+                log.warning(f'Read {read.query_name} is clipped more than {DEDUP_MAX_READ_LENGTH} bases, '
+                            f'duplicates of such reads may be kept.')
+                warned = True
+            # reads without base qualities score 0
+            qualities = read.query_qualities
+            score = min(sum(q for q in qualities if q >= 15), _DEDUP_MAX_SCORE) if qualities is not None else 0
+            entry = [read, True, key]
+            best = groups.get(key)
+            if best is None:
+                groups[key] = (score, entry)
+            else:
+                stats['UNPAIRED_READ_DUPLICATES'] += 1
+                if score > best[0]:
+                    best[1][1] = False
+                    groups[key] = (score, entry)
+                else:
+                    entry[1] = False
+        pending.append(entry)
+
+        # groups with 5' end before this read minus the window can not get more reads
+        reference_id = read.reference_id
+        boundary = read.reference_start - window if reference_id >= 0 else sys.maxsize
+        while len(pending) > 0:
+            key = pending[0][2]
+            if key is not None and key[0] == reference_id and key[2] >= boundary:
+                break
+            entry = pending.popleft()
+            if key is not None:
+                yielded_end = max(yielded_end, (key[0], key[2]))
+                if groups.get(key, (None, None))[1] is entry:
+                    del groups[key]
+            if entry[1]:
+                yield entry[0]
+    for read, keep, _ in pending:
+        if keep:
+            yield read
+
+
+def _dedup_stats_series(stats):
+    """Builtin dedup stats in the same fields as _parse_dedup_matrix"""
+    examined = stats['UNPAIRED_READS_EXAMINED']
+    duplicates = stats['UNPAIRED_READ_DUPLICATES']
+    return pd.Series({'LIBRARY': 'Unknown Library',
+                      'UNPAIRED_READS_EXAMINED': str(examined),
+                      'READ_PAIRS_EXAMINED': '0',
+                      'SECONDARY_OR_SUPPLEMENTARY_RDS': str(stats['SECONDARY_OR_SUPPLEMENTARY_RDS']),
+                      'UNMAPPED_READS': str(stats['UNMAPPED_READS']),
+                      'UNPAIRED_READ_DUPLICATES': str(duplicates),
+                      'READ_PAIR_DUPLICATES': '0',
+                      'READ_PAIR_OPTICAL_DUPLICATES': '0',
+                      'PERCENT_DUPLICATION': f'{duplicates / examined if examined > 0 else 0:.6f}',
+                      'ESTIMATED_LIBRARY_SIZE': ''})
+
+
+def _builtin_process_bam(sort_cmd, sort_bam, filter_bam, mapq_threshold, threads=1):
+    """
+    Sort by samtools, then dedup and MAPQ filter in one pass without picard,
+    return the dedup stats series with out_reads.
+    If sort_bam is '-', the sorted reads are read from the stdout of sort_cmd.
+    """
+    import pysam
+
+    stats = collections.defaultdict(int)
+    out_reads = 0
+    with contextlib.ExitStack() as stack:
+        if sort_bam == '-':
+            # the sort is killed and waited if the pass fail, its error is raised instead of the reading error
+            in_bam = stack.enter_context(_open_bam_pipe([sort_cmd]))
+        else:
+            _process_bam([sort_cmd])
+            in_bam = stack.enter_context(pysam.AlignmentFile(sort_bam, 'rb'))
+        out_bam = stack.enter_context(pysam.AlignmentFile(filter_bam, 'wb', template=in_bam, threads=threads))
+        for read in _dedup_reads(in_bam.fetch(until_eof=True), stats):
+            if read.mapping_quality >= mapq_threshold:
+                out_bam.write(read)
+                out_reads += 1
+    s = _dedup_stats_series(stats)
+    s['out_reads'] = out_reads
+    return s
+
+
+def _bismark_bam_path(out_dir, uid, index_name, read_type):
+    """bismark output bam of the trimmed fastq, named by bismark from {uid}_{index_name}_{read_type}.trimed.fq.gz"""
+    return str((pathlib.Path(out_dir) / f'{uid}_{index_name}_{read_type}.trimed_bismark_bt2.bam').absolute())
+
+
+def _bismark_report_path(bismark_bam):
+    """bismark report of the single end bismark bam"""
+    return bismark_bam[:-len('.bam')] + '_SE_report.txt'
+
+
+def _picard_process_bam(cmd_list, dedup_matrix, filter_bam):
+    """Run sort, picard dedup and filter commands, return the dedup matrix series with out_reads"""
+    _process_bam(cmd_list)
+    count_result = _process_bam([f'samtools view -c {filter_bam}'])[0]
+    s = _parse_dedup_matrix(dedup_matrix)
+    s['out_reads'] = int(count_result.stdout.strip())
+    return s
+
+
+def _bam_process_job(bismark_bam, mapq_threshold, dedup_engine, threads=2, pipe=False):
+    """
+    Sort, dedup and MAPQ filter job of one bismark bam, return (fn, args, filter_bam, temp_files),
+    fn(*args) return the qc stats series with out_reads, temp_files are removed after the merge.
+    """
+    filter_bam = bismark_bam[:-3] + 'filter.bam'
+    if dedup_engine == 'builtin':
+        # with pipe, the sorted reads are streamed into the dedup and filter pass
+        sort_cmd, sort_bam = _sort_cmd(bismark_bam, threads, to_stdout=pipe)
+        fn, args = _builtin_process_bam, (sort_cmd, sort_bam, filter_bam, int(mapq_threshold), threads)
+        temp_files = [] if pipe else [sort_bam]
+    else:
+        cmd_list, temp_files, dedup_matrix = _sort_dedup_filter_cmds(bismark_bam, filter_bam, mapq_threshold,
+                                                                     threads, pipe)
+        fn, args = _picard_process_bam, (cmd_list, dedup_matrix, filter_bam)
+    # only keep the final bam, same as removing {uid}_{index_name}_R*.*bismark*
+    temp_files += [bismark_bam, _bismark_report_path(bismark_bam), filter_bam]
+    return fn, args, filter_bam, temp_files
+
+
+def _merge_cell_bams(filter_bams, merge_bam):
+    """Merge R1 R2 filter bams of one cell into the final bam"""
+    _process_bam([f'samtools merge -f {merge_bam} ' + ' '.join(filter_bams)])
+    return
+
+
+def _merge_cell_job(manifest, uid, index_name, filter_jobs, merge_bam, remove_files):
+    """
+    Merge job of one cell, submitted after its filter jobs. Merge the filter bams into the final bam,
+    record the cell in the manifest, then remove all other bam files of the cell,
+    so the input of an unrecorded cell is never removed. Return the qc stats series of the cell.
+    filter_jobs is a list of (read_type, future of the filter job, filter_bam).
+    """
+    cell_results = []
+    for read_type, future, _ in filter_jobs:
+        # get qc stats, out_reads is counted in the job
+        s = future.result()
+        s['uid'] = uid
+        s['index_name'] = index_name
+        s['read_type'] = read_type
+        cell_results.append(s)
+    run_in_unit(('bam_qc', uid, index_name), _merge_cell_bams,
+                [filter_bam for _, _, filter_bam in filter_jobs], merge_bam)
+    if manifest is not None:
+        manifest.record('bam', uid, index_name, [merge_bam],
+                        result=[s.to_dict() for s in cell_results])
+    for path in remove_files:
+        pathlib.Path(path).unlink(missing_ok=True)
+    return cell_results
+
+
+def bam_qc(bismark_result, out_dir, config, manifest=None):
     """
     Parallel function for bam sorting, deduplication, quality filtering and merging (R1, R2) step.
 
@@ -34,6 +395,8 @@ def bam_qc(bismark_result, out_dir, config):
         universal pipeline out_dir
     config
         universal pipeline config
+    manifest
+        checkpoint.Manifest of the pipeline, cells finished in a previous run are not processed again
     Returns
     -------
     bam_result_df
@@ -42,68 +405,260 @@ def bam_qc(bismark_result, out_dir, config):
     """
     cores = int(config['bamFilter']['cores'])
     mapq_threshold = config['bamFilter']['mapq_threshold']
+    dedup_engine = config['bamFilter'].get('dedup_engine', 'picard')
+    threads = int(config['bamFilter'].get('threads', '2'))
+    pipe = config['bamFilter'].getboolean('pipe', fallback=False)
+
+    # qc stats of the cells finished in a previous run
+    qc_dict = {}
+    if manifest is not None:
+        for (uid, index_name), _ in bismark_result.groupby(['uid', 'index_name']):
+            cell_result = manifest.cell_result('bam', uid, index_name)
+            if cell_result is not None:
+                log.info(f'In  uid {uid}: index {index_name} processed in previous run')
+                if isinstance(cell_result, dict):
+                    # recorded by the cell DAG, with the stats of the earlier stages
+                    cell_result = cell_result['bam']
+                for row in cell_result:
+                    qc_dict[(uid, index_name, row['read_type'])] = pd.Series(row)
+
+    # process bam, files of each cell are tracked from here
+    cell_jobs = collections.defaultdict(list)
+    with CoreScheduler(cores) as scheduler:
+        for i, line in bismark_result.iterrows():
+            uid, index_name, read_type = line[['uid', 'index_name', 'read_type']]
+            if (uid, index_name, read_type) in qc_dict:
+                continue
+            bismark_bam = _bismark_bam_path(out_dir, uid, index_name, read_type)
+            fn, args, filter_bam, temp_files = _bam_process_job(bismark_bam, mapq_threshold, dedup_engine,
+                                                                threads, pipe)
+            future = scheduler.submit(run_in_unit, ('bam_qc', uid, index_name, read_type), fn, *args,
+                                      process=True)
+            cell_jobs[(uid, index_name)].append((read_type, future, filter_bam, temp_files))
+
+        # merge R1 R2 bam of each cell once its own filter jobs are done
+        merge_jobs = []
+        for (uid, index_name), jobs in cell_jobs.items():
+            merge_bam = str(pathlib.Path(out_dir) / f'{uid}_{index_name}.final.bam')
+            remove_files = [path for _, _, _, temp_files in jobs for path in temp_files]
+            filter_jobs = [(read_type, future, filter_bam) for read_type, future, filter_bam, _ in jobs]
+            merge_jobs.append(scheduler.submit(_merge_cell_job, manifest, uid, index_name, filter_jobs,
+                                               merge_bam, remove_files,
+                                               after=[future for _, future, _ in filter_jobs]))
+    # the scheduler wait for all jobs before raising the first error,
+    # so the cells that did not fail are all recorded for the next run
+    for future in merge_jobs:
+        for s in future.result():
+            qc_dict[(s['uid'], s['index_name'], s['read_type'])] = s
+
+    qc_result = [qc_dict[tuple(line[['uid', 'index_name', 'read_type']])] for i, line in bismark_result.iterrows()]
+    bam_result_df = pd.DataFrame(qc_result)
+    return bam_result_df
+
+
+def _stream_cmds(bismark_bam, dedup_engine, threads=2, uncompressed=False):
+    """
+    Commands of one bismark bam in bam_to_allc, return (sort_cmd, stream_cmds, temp_files, dedup_matrix).
+    stream_cmds write the sorted (and picard deduplicated) uncompressed bam to stdout.
+    builtin: sort_cmd is None, sort stream into the reader, dedup is done in the stream, no bam file;
+    picard: sort_cmd write the sorted bam (picard read its input twice), picard stream into the reader,
+    the sorted bam is not compressed if uncompressed.
+    """
+    if dedup_engine == 'builtin':
+        sort_cmd, _ = _sort_cmd(bismark_bam, threads, to_stdout=True)
+        return None, [sort_cmd], [], None
+    cmd_list, dedup_bam, dedup_matrix = _sort_dedup_cmds(bismark_bam, threads, uncompressed)
+    dedup_cmd = cmd_list[1].replace(f'O={dedup_bam}', 'O=/dev/stdout') + ' QUIET=true'
+    if not uncompressed:
+        dedup_cmd += ' COMPRESSION_LEVEL=0'
+    return cmd_list[0], [dedup_cmd], [_sort_cmd(bismark_bam)[1]], dedup_matrix
+
+
+def _iter_filtered_reads(bam_paths, mapq_threshold, read_counts, final_bam_path=None, dedup_stats=None,
+                         bam_cmds=None):
+    """
+    Stream reads of coordinate sorted bams (R1 and R2 of one cell) with MAPQ >= mapq_threshold,
+    merged in coordinate order, same as samtools view -q and then samtools merge.
+    Kept reads of each bam are counted in read_counts[bam_path].
+    If final_bam_path is not None, the merged reads are also written into it.
+    If dedup_stats is not None, bams are only sorted and deduplicated in the stream by _dedup_reads,
+    with stats in dedup_stats[bam_path].
+    If bam_cmds is not None, each bam is read from the stdout of the piped commands bam_cmds[bam_path]
+    instead of the file.
+    """
+    import pysam
+
+    def _filter_reads(bam, bam_path):
+        reads = bam.fetch(until_eof=True)
+        if dedup_stats is not None:
+            reads = _dedup_reads(reads, dedup_stats[bam_path])
+        for read in reads:
+            if read.mapping_quality >= mapq_threshold:
+                read_counts[bam_path] += 1
+                yield read
+
+    def _read_order(read):
+        # unmapped reads are at the end of sorted bam
+        return read.reference_id if read.reference_id >= 0 else sys.maxsize, read.reference_start
+
+    with contextlib.ExitStack() as stack:
+        # all the commands start here, so R1 and R2 are sorted at the same time
+        bams = [stack.enter_context(_open_bam_pipe(bam_cmds[bam_path]) if bam_cmds is not None
+                                    else pysam.AlignmentFile(bam_path, 'rb'))
+                for bam_path in bam_paths]
+        final_bam = None
+        if final_bam_path is not None:
+            final_bam = stack.enter_context(pysam.AlignmentFile(final_bam_path, 'wb', template=bams[0]))
+        for read in heapq.merge(*[_filter_reads(bam, bam_path) for bam, bam_path in zip(bams, bam_paths)],
+                                key=_read_order):
+            if final_bam is not None:
+                final_bam.write(read)
+            yield read
+
+
+def _bam_to_allc_worker(bam_paths, mapq_threshold, final_bam_path, allc_path, reference_fasta,
+                        num_upstr_bases, num_downstr_bases, min_mapq, min_base_quality,
+                        bgzip, compress_threads, keep_final_bam, builtin_dedup=False, bam_cmds=None,
+                        temp_files=()):
+    """
+    Filter and merge the sorted bams of one cell and call ALLC from the read stream.
+    If builtin_dedup, bams are deduplicated in the same stream.
+    If bam_cmds is not None, bams are read from the stdout of bam_cmds, see _iter_filtered_reads.
+    temp_files are removed once the ALLC is written.
+
+    Returns
+    -------
+    count_df
+        mC context summary counts, same as call_methylated_sites
+    site_stats
+        SiteStats of the cell
+    read_counts
+        dict of bam path: reads after MAPQ filter
+    dedup_stats
+        dict of bam path: dedup stats series, None if not builtin_dedup
+    """
+    read_counts = {bam_path: 0 for bam_path in bam_paths}
+    dedup_stats = {bam_path: collections.defaultdict(int) for bam_path in bam_paths} if builtin_dedup else None
+    read_iter = _iter_filtered_reads(bam_paths, mapq_threshold, read_counts,
+                                     final_bam_path if keep_final_bam else None, dedup_stats, bam_cmds)
+    result = _call_sites_from_reads(read_iter, allc_path, reference_fasta,
+                                    num_upstr_bases, num_downstr_bases, min_mapq, min_base_quality,
+                                    bgzip=bgzip, compress_threads=compress_threads)
+    # write the idx and tbi
+    count_df, site_stats = _stitch_allc_shards(allc_path, [allc_path], [result])
+    if builtin_dedup:
+        dedup_stats = {bam_path: _dedup_stats_series(stats) for bam_path, stats in dedup_stats.items()}
+    for path in temp_files:
+        pathlib.Path(path).unlink(missing_ok=True)
+    return count_df, site_stats, read_counts, dedup_stats
+
+
+def bam_to_allc(bismark_result, out_dir, config, stat_dir=None):
+    """
+    Fused bam_qc and call_methylated_sites. Bams are sorted and deduplicated the same way as bam_qc,
+    then MAPQ filter, R1 R2 merge and ALLC calling are done in one stream for each cell,
+    filter bam and final bam are not written (final bam is optional) and the caller don't need a bai.
+    With the builtin dedup engine, samtools sort stream into the caller and no bam is written at all;
+    with picard, only the sorted bam is written, picard stream into the caller.
+    Each cell start as soon as its own sort jobs are done. ALLC is called by the pysam engine.
+
+    Parameters
+    ----------
+    bismark_result
+        dataframe from bismark mapping step
+    out_dir
+        universal pipeline out_dir
+    config
+        universal pipeline config
+    stat_dir
+        same as call_methylated_sites
+    Returns
+    -------
+    bam_result_df
+        same as bam_qc
+    allc_count_df
+        same as call_methylated_sites
+    """
+    cores = int(config['bamFilter']['cores'])
+    mapq_threshold = int(config['bamFilter']['mapq_threshold'])
+    keep_final_bam = config['bamFilter'].getboolean('final_bam', fallback=False)
+    reference_fasta = config['callMethylation']['reference_fasta']
+    num_upstr_bases = int(config['callMethylation']['num_upstr_bases'])
+    num_downstr_bases = int(config['callMethylation']['num_downstr_bases'])
+    min_mapq = int(config['callMethylation']['min_mapq'])
+    min_base_quality = int(config['callMethylation']['min_base_quality'])
+    bgzip = config['callMethylation'].getboolean('bgzip', fallback=True)
+    compress_threads = int(config['callMethylation'].get('compress_threads', '1'))
+    dedup_engine = config['bamFilter'].get('dedup_engine', 'picard')
+    builtin_dedup = dedup_engine == 'builtin'
+    threads = int(config['bamFilter'].get('threads', '2'))
+    # the sorted bam of picard is only read once
+    uncompressed = config['bamFilter'].getboolean('pipe', fallback=False)
+    _prepare_call_reference(config)
 
-    # process bam
-    pool = multiprocessing.Pool(cores)
-    results = []
+    cell_bams = collections.defaultdict(dict)
     for i, line in bismark_result.iterrows():
         uid, index_name, read_type = line[['uid', 'index_name', 'read_type']]
-        # file path
-        bismark_bam = str(
-            list(pathlib.Path(out_dir).glob(f'{uid}_{index_name}_{read_type}*_bismark_bt2.bam'))[0].absolute())
-        sort_bam = bismark_bam[:-3] + 'sort.bam'
-        dedup_bam = bismark_bam[:-3] + 'dedup.bam'
-        dedup_matrix = bismark_bam[:-3] + 'dedup.matrix.txt'
-        filter_bam = bismark_bam[:-3] + 'filter.bam'
-        # command
-        sort_cmd = f'samtools sort -o {sort_bam} --threads 2 {bismark_bam}'
-        dedup_cmd = f'picard MarkDuplicates I={sort_bam} O={dedup_bam} M={dedup_matrix} REMOVE_DUPLICATES=true'
-        filter_cmd = f'samtools view -b -h -q {mapq_threshold} -o {filter_bam} {dedup_bam}'
-        cmd_list = [sort_cmd, dedup_cmd, filter_cmd]
-        result = pool.apply_async(_process_bam, (cmd_list,))
-        results.append(result)
-    pool.close()
-    pool.join()
-
-    # get qc stats
+        cell_bams[(uid, index_name)][read_type] = _bismark_bam_path(out_dir, uid, index_name, read_type)
+
+    # large cells first
+    cell_order = sorted(cell_bams.keys(),
+                        key=lambda k: sum(pathlib.Path(bam).stat().st_size for bam in cell_bams[k].values()),
+                        reverse=True)
+    cell_jobs = {}
+    with CoreScheduler(cores) as scheduler:
+        for uid, index_name in cell_order:
+            bam_paths = list(cell_bams[(uid, index_name)].values())
+            bam_cmds = {}
+            sort_jobs = []
+            temp_files = []
+            dedup_matrices = {}
+            for read_type, bismark_bam in cell_bams[(uid, index_name)].items():
+                sort_cmd, bam_cmds[bismark_bam], bam_temp_files, dedup_matrices[bismark_bam] = \
+                    _stream_cmds(bismark_bam, dedup_engine, threads, uncompressed)
+                temp_files += bam_temp_files
+                if sort_cmd is not None:
+                    sort_jobs.append(scheduler.run_cmd(sort_cmd, cores=threads,
+                                                       unit=('bam_qc', uid, index_name, read_type)))
+            # the stream commands run in the worker, builtin sort use threads each, picard count as one core
+            worker_cores = 1 + len(bam_paths) * (threads if builtin_dedup else 1)
+            final_bam_path = str(pathlib.Path(out_dir) / f'{uid}_{index_name}.final.bam')
+            result = scheduler.submit(
+                run_in_unit, ('bam_qc', uid, index_name), _bam_to_allc_worker,
+                bam_paths, mapq_threshold, final_bam_path, _get_allc_path(final_bam_path), reference_fasta,
+                num_upstr_bases, num_downstr_bases, min_mapq, min_base_quality,
+                bgzip, compress_threads, keep_final_bam, builtin_dedup, bam_cmds, temp_files,
+                cores=worker_cores, process=True, after=sort_jobs)
+            cell_jobs[(uid, index_name)] = (result, dedup_matrices)
+
     qc_result = []
-    for i, line in bismark_result.iterrows():
-        uid, index_name, read_type = line[['uid', 'index_name', 'read_type']]
-        dedup_matrix = list(pathlib.Path(out_dir).glob(f'{uid}_{index_name}_{read_type}*dedup.matrix.txt'))[0]
-        filter_bam = list(pathlib.Path(out_dir).glob(f'{uid}_{index_name}_{read_type}*filter.bam'))[0]
-        count_filter_bam_cmd = f'samtools view -c {filter_bam}'
-        count_result = subprocess.run(shlex.split(count_filter_bam_cmd),
-                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-        remain_reads = int(count_result.stdout.strip())
-        header = True
-        lines = []
-        for _line in dedup_matrix.open().read().split('\n'):
-            if _line.startswith('LIBRARY'):
-                header = False
-            if header:
-                continue
-            ll = _line.strip().split('\t')
-            if len(ll) != 1:
-                lines.append(ll)
-        s = pd.Series({k: v for k, v in zip(*lines)})
-        s['uid'] = uid
-        s['index_name'] = index_name
-        s['read_type'] = read_type
-        s['out_reads'] = remain_reads
-        qc_result.append(s)
-    bam_result_df = pd.DataFrame(qc_result)
+    total_results = []
+    cell_stats = {}
+    for (uid, index_name), (result, dedup_matrices) in cell_jobs.items():
+        count_df, cell_stats[(uid, index_name)], read_counts, dedup_stats = result.result()
+        for read_type, bismark_bam in cell_bams[(uid, index_name)].items():
+            if builtin_dedup:
+                s = dedup_stats[bismark_bam]
+            else:
+                s = _parse_dedup_matrix(dedup_matrices[bismark_bam])
+            # same column order as bam_qc
+            s['out_reads'] = read_counts[bismark_bam]
+            s['uid'] = uid
+            s['index_name'] = index_name
+            s['read_type'] = read_type
+            qc_result.append(s)
+        count_df['uid'] = uid
+        count_df['index_name'] = index_name
+        total_results.append(count_df)
 
-    for (uid, index_name), sub_df in bam_result_df.groupby(['uid', 'index_name']):
-        # merge R1 R2 bam
-        merge_bam = pathlib.Path(out_dir) / f'{uid}_{index_name}.final.bam'
-        bam_list = ' '.join(glob.glob(f'{out_dir}/{uid}_{index_name}_R*filter.bam'))
-        merge_cmd = f'samtools merge -f {merge_bam} {bam_list}'
-        subprocess.run(shlex.split(merge_cmd),
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
-        # clean up
-        # only keep filtered bam and bismark report
-        remove_file_list = [str(p) for p in pathlib.Path(out_dir).glob(f'{uid}_{index_name}_R*.*bismark*')]
-        remove_file_str = ' '.join(remove_file_list)
-        rm_cmd = f'rm -f {remove_file_str}'
-        subprocess.run(shlex.split(rm_cmd), encoding='utf8')
-    return bam_result_df
+    # clean up once all cells are called, same as bam_qc
+    for (uid, index_name), (_, dedup_matrices) in cell_jobs.items():
+        for bismark_bam in cell_bams[(uid, index_name)].values():
+            for path in [bismark_bam, _bismark_report_path(bismark_bam), dedup_matrices[bismark_bam]]:
+                if path is not None:
+                    pathlib.Path(path).unlink(missing_ok=True)
+    bam_result_df = pd.DataFrame(qc_result)
+    allc_count_df = pd.concat(total_results).reset_index(drop=False)
+    if stat_dir is not None:
+        write_site_stats_tables(cell_stats, stat_dir)
+    return bam_result_df, allc_count_df
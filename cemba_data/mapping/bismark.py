@@ -12,62 +12,234 @@ import shlex
 import functools
 import operator
 import logging
+import collections
+import shutil
+from ..tools.methylpy_utilities import split_fastq_file
+from ..tools.bgzf import BgzfWriter
+from .fastq import _iter_fastq_records
+from .report import BISMARK_REPORT_TERMS, read_bismark_report, bismark_report_df
+from .usage import run, usage_unit
 
 # logger
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# number of reads buffered before writing the batch fastq
+_BATCH_BUFFER_READS = 100000
+
+
+# rate terms of the report: (numerator terms, denominator terms)
+_BISMARK_RATE_TERMS = {
+    'mapping_rate': (['unique_map'], ['total_reads']),
+    'total_mcg_rate': (['total_mcg'], ['total_mcg', 'total_cg']),
+    'total_mchg_rate': (['total_mchg'], ['total_mchg', 'total_chg']),
+    'total_mchh_rate': (['total_mchh'], ['total_mchh', 'total_chh']),
+    'total_mcn_rate': (['total_mcn'], ['total_mcn', 'total_cn'])}
+
+
+# strand terms of the report, from the XR (read conversion) and XG (genome conversion) tags
+_BISMARK_STRAND_TERMS = {('CT', 'CT'): 'OT', ('CT', 'GA'): 'OB', ('GA', 'CT'): 'CTOT', ('GA', 'GA'): 'CTOB'}
+
+# methylation call of the XM tag: count term, unknown context (u, U) is not in total_c
+_BISMARK_CALL_TERMS = {'Z': 'total_mcg', 'X': 'total_mchg', 'H': 'total_mchh', 'U': 'total_mcn',
+                       'z': 'total_cg', 'x': 'total_chg', 'h': 'total_chh', 'u': 'total_cn'}
+
 
 def _parse_bismark_report(report_path_list):
+    """Bismark report dataframe, uid, index_name and read_type are taken from the report file names"""
+    return bismark_report_df([read_bismark_report(report) for report in report_path_list])
+
+
+_CANNOT_DETERMINE = "Can't determine percentage of methylated Cs in "
+
+
+def _write_bismark_report(template_path, counts, out_path, input_name=None):
+    """
+    Write a bismark report with the count terms in counts, rate terms are calculated from the counts,
+    other lines are copied from template_path, a report of the same bismark setting.
+    If input_name is given, the input fastq of the template is replaced by input_name.
+    """
+    lines = []
+    with open(template_path) as rep:
+        for line in rep:
+            if input_name is not None and line.startswith('Bismark report for: '):
+                version = line[line.rfind(' (version'):]
+                lines.append(f'Bismark report for: {input_name}{version}')
+                continue
+            if line.startswith(_CANNOT_DETERMINE):
+                # bismark write this line instead of the rate when no C in the context
+                start = 'C methylated in ' + line[len(_CANNOT_DETERMINE):].rstrip('\n')[:-len(' if value was 0')]
+            else:
+                start, _, rest = line.partition(':')
+            term = BISMARK_REPORT_TERMS.get(start)
+            if term is None:
+                lines.append(line)
+            elif term in _BISMARK_RATE_TERMS:
+                numerator, denominator = _BISMARK_RATE_TERMS[term]
+                total = sum(counts[t] for t in denominator)
+                if total > 0:
+                    rate = sum(counts[t] for t in numerator) / total * 100
+                    lines.append(f'{start}:\t{rate:.1f}%\n')
+                elif term == 'mapping_rate':
+                    lines.append(f'{start}:\t0.0%\n')
+                else:
+                    lines.append(_CANNOT_DETERMINE + start[len('C methylated in '):] + ' if value was 0\n')
+            else:
+                fields = rest.strip().split('\t')
+                fields[0] = str(counts[term])
+                lines.append(f'{start}:\t' + '\t'.join(fields) + '\n')
+    with open(out_path, 'w') as f:
+        f.writelines(lines)
+    return
+
+
+def _merge_bismark_report(report_path_list, out_path, input_name=None):
     """
-    Some ugly parser for bismark report... Hope Bismark won't change...
-    # TODO make this independent to bismark
+    Merge bismark reports of fastq chunks into one report of the whole fastq.
+    Count terms are summed and rate terms are recalculated from the sums,
+    other lines are kept from the first report, so read_bismark_report read it as a normal report.
+    If input_name is given, it replace the chunk fastq in the report header.
     """
-    term_dict = {'Sequences analysed in total': 'total_reads',
-                 'Number of alignments with a unique best hit from the different alignments': 'unique_map',
-                 'Mapping efficiency': 'mapping_rate',
-                 'Sequences with no alignments under any condition': 'unmap',
-                 'Sequences did not map uniquely': 'ununique_map',
-                 'Sequences which were discarded because genomic sequence could not be extracted': 'no_genome',
-                 'CT/CT': 'OT', 'CT/GA': 'OB', 'GA/CT': 'CTOT', 'GA/GA': 'CTOB',
-                 'Number of alignments to (merely theoretical) complementary strands being rejected in total': 'reject',
-                 "Total number of C's analysed": 'total_c',
-                 "Total methylated C's in CpG context": 'total_mcg',
-                 "Total methylated C's in CHG context": 'total_mchg',
-                 "Total methylated C's in CHH context": 'total_mchh',
-                 "Total methylated C's in Unknown context": 'total_mcn',
-                 "Total unmethylated C's in CpG context": 'total_cg',
-                 "Total unmethylated C's in CHG context": 'total_chg',
-                 "Total unmethylated C's in CHH context": 'total_chh',
-                 "Total unmethylated C's in Unknown context": 'total_cn',
-                 'C methylated in CpG context': 'total_mcg_rate',
-                 'C methylated in CHG context': 'total_mchg_rate',
-                 'C methylated in CHH context': 'total_mchh_rate',
-                 'C methylated in Unknown context (CN or CHN)': 'total_mcn_rate'}
-
-    total_list = []
+    sums = collections.defaultdict(int)
     for report in report_path_list:
-        uid, index_name, read_type = report.name.split('.')[0].split('_')
-        with report.open() as rep:
-            report_dict = {}
-            for line in rep:
-                try:
-                    start, rest = line.split(':')
-                except ValueError:
-                    continue  # more or less than 2 after split
-                try:
-                    report_dict[term_dict[start]] = rest.strip().split('\t')[0].strip('%')
-                except KeyError:
-                    pass
-        report_dict['uid'] = uid
-        report_dict['index_name'] = index_name
-        report_dict['read_type'] = read_type
-        total_list.append(pd.Series(report_dict))
-    total_result = pd.DataFrame(total_list)
-    return total_result
-
-
-def bismark(fastq_final_result, out_dir, config):
+        report = read_bismark_report(report)
+        for term in BISMARK_REPORT_TERMS.values():
+            if term not in _BISMARK_RATE_TERMS and getattr(report, term) is not None:
+                sums[term] += getattr(report, term)
+    _write_bismark_report(report_path_list[0], sums, out_path, input_name=input_name)
+    return
+
+
+def _split_bismark_chunks(fastq_path, chunk_dir, num_chunks):
+    """Split a trimmed fastq into chunk_dir/{fastq name}.chunk{i} for mapping in parallel"""
+    chunk_dir.mkdir(exist_ok=True)
+    output_prefix = str(chunk_dir / (fastq_path.name[:-len('.fq.gz')] + '.chunk'))
+    split_fastq_file(num_chunks, str(fastq_path), output_prefix)
+    return [output_prefix + str(i) for i in range(num_chunks)]
+
+
+def _merge_bismark_chunks(fastq_path, chunk_dir, out_dir):
+    """
+    Merge the chunk BAMs and reports into the same files bismark make for the whole fastq,
+    then remove chunk_dir.
+    """
+    base_name = fastq_path.name[:-len('.fq.gz')]
+    chunk_bams = sorted(chunk_dir.glob('*_bismark_bt2.bam'))
+    chunk_reports = sorted(chunk_dir.glob('*_bismark_bt2_SE_report.txt'))
+    merge_bam = pathlib.Path(out_dir) / f'{base_name}_bismark_bt2.bam'
+    # bismark BAM are not sorted, and bam_qc will sort it
+    run(['samtools', 'cat', '-o', str(merge_bam)] + [str(bam) for bam in chunk_bams], check=True)
+    _merge_bismark_report(chunk_reports, pathlib.Path(out_dir) / f'{base_name}_bismark_bt2_SE_report.txt',
+                          input_name=str(fastq_path))
+    shutil.rmtree(chunk_dir)
+    return
+
+
+def _write_bismark_batch(cells, batch_path):
+    """
+    Concatenate trimmed fastq of small cells into one fastq for a single bismark run.
+    Read names are tagged with the cell as @{uid}_{index_name}|{read name}.
+
+    Parameters
+    ----------
+    cells
+        list of (uid, index_name, fastq_path)
+    batch_path
+        output fastq.gz
+    Returns
+    -------
+    dict of cell tag: number of reads
+    """
+    batch_path.parent.mkdir(exist_ok=True)
+    cell_reads = {}
+    # the batch fastq is only read once by bismark, so use fast compression
+    with BgzfWriter(str(batch_path), level=1) as out:
+        for uid, index_name, fastq_path in cells:
+            tag = f'@{uid}_{index_name}|'.encode()
+            n_reads = 0
+            records = []
+            for name, seq, plus, qual in _iter_fastq_records(fastq_path):
+                records.append(b'\n'.join((tag + name[1:], seq, plus, qual)))
+                if len(records) == _BATCH_BUFFER_READS:
+                    out.write(b'\n'.join(records) + b'\n')
+                    n_reads += len(records)
+                    records = []
+            if len(records) > 0:
+                out.write(b'\n'.join(records) + b'\n')
+                n_reads += len(records)
+            cell_reads[f'{uid}_{index_name}'] = n_reads
+    return cell_reads
+
+
+def _split_bismark_batch(batch_path, cell_reads, read_type, out_dir):
+    """
+    Split the BAM of a batched bismark run into {uid}_{index_name}_{read_type}.trimed_bismark_bt2.bam,
+    read names are restored. The report of each cell is written in the same format as a single cell run,
+    counts come from the reads of each cell in the BAM (unique mapped reads, strands and methylation calls
+    in the XM tag) and in the --un and --ambiguous fastq. Alignments rejected to complementary strands
+    can not be assigned to cells, they are counted as no_genome. Then the batch directory is removed.
+    """
+    import pysam
+
+    batch_dir = batch_path.parent
+    base_name = batch_path.name[:-len('.fq.gz')]
+    counts = {tag: collections.defaultdict(int) for tag in cell_reads}
+    with pysam.AlignmentFile(str(batch_dir / f'{base_name}_bismark_bt2.bam')) as batch_bam:
+        out_bams = {tag: pysam.AlignmentFile(str(pathlib.Path(out_dir) /
+                                                 f'{tag}_{read_type}.trimed_bismark_bt2.bam'),
+                                             'wb', template=batch_bam)
+                    for tag in cell_reads}
+        for read in batch_bam:
+            tag, read.query_name = read.query_name.split('|', 1)
+            out_bams[tag].write(read)
+            cell_counts = counts[tag]
+            cell_counts['unique_map'] += 1
+            cell_counts[_BISMARK_STRAND_TERMS[(read.get_tag('XR'), read.get_tag('XG'))]] += 1
+            calls = read.get_tag('XM')
+            for call, term in _BISMARK_CALL_TERMS.items():
+                cell_counts[term] += calls.count(call)
+        for out_bam in out_bams.values():
+            out_bam.close()
+
+    for pattern, term in [('*unmapped_reads*', 'unmap'), ('*ambiguous_reads*', 'ununique_map')]:
+        for fastq_path in batch_dir.glob(pattern):
+            for name, _, _, _ in _iter_fastq_records(fastq_path):
+                counts[name[1:].split(b'|', 1)[0].decode()][term] += 1
+
+    report_path = batch_dir / f'{base_name}_bismark_bt2_SE_report.txt'
+    for tag, cell_counts in counts.items():
+        cell_counts['total_reads'] = cell_reads[tag]
+        cell_counts['no_genome'] = cell_reads[tag] - cell_counts['unique_map'] - \
+            cell_counts['unmap'] - cell_counts['ununique_map']
+        cell_counts['total_c'] = sum(cell_counts[t] for t in _BISMARK_CALL_TERMS.values()
+                                      if t not in ('total_mcn', 'total_cn'))
+        fastq_name = f'{tag}_{read_type}.trimed.fq.gz'
+        _write_bismark_report(report_path, cell_counts,
+                              pathlib.Path(out_dir) / f'{tag}_{read_type}.trimed_bismark_bt2_SE_report.txt',
+                              input_name=str(pathlib.Path(out_dir) / fastq_name))
+    shutil.rmtree(batch_dir)
+    return
+
+
+def _bismark_cmd(bismark_reference, fastq_path, read_type, bismark_out_dir, options=''):
+    """bismark command of one fastq, R1 is mapped with --pbat"""
+    pbat = '--pbat ' if read_type == 'R1' else ''
+    return f'bismark {bismark_reference} --bowtie2 {fastq_path} {pbat}{options}' \
+           f'-o {bismark_out_dir} --temp_dir {bismark_out_dir}'
+
+
+def _filter_cell_reads(uid, index_name, total_reads, read_min, read_max):
+    """Whether a cell with total_reads trimmed reads is mapped"""
+    if total_reads < read_min:
+        log.info(f'Drop cell due to too less reads: {uid} {index_name} {total_reads}')
+        return False
+    if total_reads > read_max:
+        log.info(f'Drop cell due to too many reads: {uid} {index_name} {total_reads}')
+        return False
+    return True
+
+
+def bismark(fastq_final_result, out_dir, config, manifest=None):
     """
     bismark mapping using Bowtie2.
 
@@ -79,6 +251,9 @@ def bismark(fastq_final_result, out_dir, config):
         universal pipeline out_dir
     config
         universal pipeline config
+    manifest
+        checkpoint.Manifest of the pipeline, cells finished in a previous run are not mapped again,
+        each cell is recorded once its R1 and R2 bam and report are written
 
     Returns
     -------
@@ -89,8 +264,12 @@ def bismark(fastq_final_result, out_dir, config):
     cores = int(config['bismark']['cores'])
     read_min = int(config['bismark']['read_min'])
     read_max = int(config['bismark']['read_max'])
+    split_reads = int(config['bismark'].get('split_reads', '0'))
+    split_chunks = int(config['bismark'].get('split_chunks', '4'))
+    batch_reads = int(config['bismark'].get('batch_reads', '0'))
+    batch_cells = int(config['bismark'].get('batch_cells', '100'))
 
-    bismark_run = functools.partial(subprocess.run,
+    bismark_run = functools.partial(run,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE,
                                     encoding='utf8',
@@ -100,37 +279,109 @@ def bismark(fastq_final_result, out_dir, config):
     for (uid, index_name), sub_df in fastq_final_result.sort_values('out_reads').groupby(['uid', 'index_name']):
         sample_dict[(uid, index_name)] = sub_df['out_reads'].astype(int).sum()
     sorted_sample = sorted(sample_dict.items(), key=operator.itemgetter(1), reverse=True)
+    read_type_reads = fastq_final_result.set_index(['uid', 'index_name', 'read_type'])['out_reads'].astype(int)
 
     ran_samples = []
-    r1_results = []
-    r2_results = []
-    pool = multiprocessing.Pool(cores)
+    # number of unfinished read types of each cell
+    cell_pending = collections.Counter()
+    # (fastq, out_dir of bismark, read_type, extra options, cell), large fastq is split into chunks
+    map_jobs = []
+    chunk_jobs = []
+    # read_type: list of (uid, index_name, fastq), small fastq is mapped in batches
+    batch_cells_dict = {'R1': [], 'R2': []}
     for (uid, index_name), total_reads in sorted_sample:
-        if total_reads < read_min:
-            log.info("Drop cell due to too less reads:", uid, index_name, total_reads)
-            continue
-        if total_reads > read_max:
-            log.info("Drop cell due to too many reads:", uid, index_name, total_reads)
+        if not _filter_cell_reads(uid, index_name, total_reads, read_min, read_max):
             continue
         ran_samples.append((uid, index_name))
-        r1_fastq = pathlib.Path(out_dir) / f'{uid}_{index_name}_R1.trimed.fq.gz'
-        r1_cmd = f'bismark {bismark_reference} --bowtie2 {r1_fastq} --pbat -o {out_dir} --temp_dir {out_dir}'
-        # each bismark job actually use 250%
-        result = pool.apply_async(bismark_run, (shlex.split(r1_cmd),))
-        r1_results.append(result)
-
-        r2_fastq = pathlib.Path(out_dir) / f'{uid}_{index_name}_R2.trimed.fq.gz'
-        r2_cmd = f'bismark {bismark_reference} --bowtie2 {r2_fastq} -o {out_dir} --temp_dir {out_dir}'
-        result = pool.apply_async(bismark_run, (shlex.split(r2_cmd),))
-        r2_results.append(result)
+        if manifest is not None and manifest.cell_done('bismark', uid, index_name):
+            log.info(f'In  uid {uid}: index {index_name} mapped in previous run')
+            continue
+        for read_type in ['R1', 'R2']:
+            cell_pending[(uid, index_name)] += 1
+            fastq_path = pathlib.Path(out_dir) / f'{uid}_{index_name}_{read_type}.trimed.fq.gz'
+            if 0 < split_reads < read_type_reads[(uid, index_name, read_type)]:
+                chunk_dir = pathlib.Path(out_dir) / f'{uid}_{index_name}_{read_type}.bismark_chunks'
+                chunk_jobs.append((fastq_path, chunk_dir, read_type, (uid, index_name)))
+            elif read_type_reads[(uid, index_name, read_type)] < batch_reads:
+                batch_cells_dict[read_type].append((uid, index_name, fastq_path))
+            else:
+                map_jobs.append((fastq_path, out_dir, read_type, '', (uid, index_name)))
+
+    def _read_type_finished(cell, *_):
+        # called in the main process, also as the callback of the map jobs
+        cell_pending[cell] -= 1
+        if cell_pending[cell] == 0 and manifest is not None:
+            uid, index_name = cell
+            files = []
+            for read_type in ['R1', 'R2']:
+                base_path = pathlib.Path(out_dir) / f'{uid}_{index_name}_{read_type}.trimed_bismark_bt2'
+                files += [f'{base_path}.bam', f'{base_path}_SE_report.txt']
+            manifest.record('bismark', uid, index_name, files)
+        return
+
+    # batches of small cells, each batch is one bismark run
+    batch_jobs = []
+    for read_type, cells in batch_cells_dict.items():
+        for i in range(0, len(cells), batch_cells):
+            batch_path = pathlib.Path(out_dir) / f'bismark_batch{i // batch_cells}_{read_type}' / \
+                         f'batch_{read_type}.fq.gz'
+            batch_jobs.append((cells[i:i + batch_cells], batch_path, read_type))
+
+    pool = multiprocessing.Pool(cores)
+    # split large fastq and concatenate small fastq first, the chunks and batches are mapped before other samples
+    split_results = [pool.apply_async(_split_bismark_chunks, (fastq_path, chunk_dir, split_chunks))
+                     for fastq_path, chunk_dir, _, _ in chunk_jobs]
+    batch_results = [pool.apply_async(_write_bismark_batch, (cells, batch_path))
+                     for cells, batch_path, _ in batch_jobs]
+    chunk_map_jobs = []
+    for (fastq_path, chunk_dir, read_type, cell), result in zip(chunk_jobs, split_results):
+        chunk_map_jobs += [(chunk_path, chunk_dir, read_type, '', cell) for chunk_path in result.get()]
+    # reads not unique mapped are counted for each cell of a batch
+    chunk_map_jobs += [(batch_path, batch_path.parent, read_type, '--un --ambiguous ', None)
+                       for _, batch_path, read_type in batch_jobs]
+    batch_cell_reads = [result.get() for result in batch_results]
+    map_jobs = chunk_map_jobs + map_jobs
+
+    results = []
+    for i, (fastq_path, bismark_out_dir, read_type, options, cell) in enumerate(map_jobs):
+        cmd = _bismark_cmd(bismark_reference, fastq_path, read_type, bismark_out_dir, options)
+        # batch usage is recorded under the batch dir name
+        unit = ('bismark',) + (cell if cell is not None else (None, bismark_out_dir.name)) + (read_type,)
+        # each bismark job actually use 250%, chunk and batch cells are finished after merge and split
+        callback = None if i < len(chunk_map_jobs) else functools.partial(_read_type_finished, cell)
+        results.append(pool.apply_async(bismark_run, (shlex.split(cmd),), {'unit': unit}, callback=callback))
     pool.close()
     pool.join()
 
+    # raise the error of any failed bismark run, the callback is not called for it,
+    # and a failed chunk or batch also make the merged or split BAMs incomplete
+    for result in results:
+        try:
+            result.get()
+        except subprocess.CalledProcessError as e:
+            log.error(f'bismark failed: {" ".join(e.cmd)}\n{e.stderr}')
+            raise
+    for fastq_path, chunk_dir, read_type, cell in chunk_jobs:
+        with usage_unit('bismark', *cell, read_type):
+            _merge_bismark_chunks(fastq_path, chunk_dir, out_dir)
+        _read_type_finished(cell)
+    if len(batch_jobs) != 0:
+        with multiprocessing.Pool(min(cores, len(batch_jobs))) as pool:
+            pool.starmap(_split_bismark_batch, [(batch_path, cell_reads, read_type, out_dir)
+                                                for (_, batch_path, read_type), cell_reads
+                                                in zip(batch_jobs, batch_cell_reads)])
+        for cells, _, _ in batch_jobs:
+            for uid, index_name, _ in cells:
+                _read_type_finished((uid, index_name))
+
     if len(ran_samples) != 0:
-        report_path_list = []
+        # report paths are known, no need to glob out_dir for each cell
+        reports = []
         for (uid, index_name) in ran_samples:
-            report_path_list += list(pathlib.Path(out_dir).glob(f'{uid}_{index_name}*bismark_bt2*report.txt'))
-        bismark_result_df = _parse_bismark_report(report_path_list)
+            for read_type in ['R1', 'R2']:
+                report_path = pathlib.Path(out_dir) / f'{uid}_{index_name}_{read_type}.trimed_bismark_bt2_SE_report.txt'
+                reports.append(read_bismark_report(report_path, uid, index_name, read_type))
+        bismark_result_df = bismark_report_df(reports)
         return bismark_result_df
     else:
         # in rare case that all cells are dropped
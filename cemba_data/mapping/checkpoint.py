@@ -0,0 +1,112 @@
+"""
+Checkpoint manifest of the mapping pipeline, so a rerun in the same out_dir resume from where it stopped.
+
+Each uid has a JSON lines manifest {stat_dir}/{uid}.manifest.jsonl, one line per finished unit:
+a whole stage of the uid (index_name is null) or one cell of a stage. A line record the output files
+with their sizes, and optionally the result rows of the cell, so the stage result can be rebuilt
+without running the cell again. A unit is done only if all its files still exist with the recorded size.
+Lines are appended as soon as a unit finish, a truncated last line (the run was killed while writing) is ignored.
+"""
+
+import json
+import pathlib
+import threading
+import logging
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _to_json_value(value):
+    """numpy scalars in the result rows"""
+    return value.item()
+
+
+class Manifest:
+    """
+    Finished stages and cells of one pipeline out_dir.
+
+    Parameters
+    ----------
+    stat_dir
+        stats dir of the pipeline, manifests are {stat_dir}/{uid}.manifest.jsonl
+    """
+
+    def __init__(self, stat_dir):
+        self.stat_dir = pathlib.Path(stat_dir)
+        # uid: {(stage, index_name): record}, loaded when the uid is first used
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def _path(self, uid):
+        return self.stat_dir / f'{uid}.manifest.jsonl'
+
+    def _uid_records(self, uid):
+        if uid not in self._records:
+            records = {}
+            path = self._path(uid)
+            if path.exists():
+                with path.open() as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            log.warning(f'Skip broken line in {path}')
+                            continue
+                        # the last record of a unit win
+                        records[(record['stage'], record['index_name'])] = record
+            self._records[uid] = records
+        return self._records[uid]
+
+    def record(self, stage, uid, index_name=None, files=(), result=None):
+        """
+        Record a finished stage of uid, or a finished cell if index_name is given.
+
+        Parameters
+        ----------
+        files
+            output files of the unit, their sizes are recorded
+        result
+            json serializable result of the unit, such as a list of result rows
+        """
+        record = {'stage': stage, 'uid': uid, 'index_name': index_name,
+                  'files': {str(path): pathlib.Path(path).stat().st_size for path in files},
+                  'result': result}
+        line = json.dumps(record, default=_to_json_value) + '\n'
+        with self._lock:
+            self._uid_records(uid)[(stage, index_name)] = record
+            with self._path(uid).open('a') as f:
+                f.write(line)
+        return
+
+    def _valid_record(self, stage, uid, index_name):
+        with self._lock:
+            record = self._uid_records(uid).get((stage, index_name))
+        if record is None:
+            return None
+        for path, size in record['files'].items():
+            path = pathlib.Path(path)
+            if not path.exists() or path.stat().st_size != size:
+                log.info(f'{path} of {stage} changed since it was recorded, run {uid} {index_name} again')
+                return None
+        return record
+
+    def cell_done(self, stage, uid, index_name):
+        """Whether the cell is finished in stage and its files are intact"""
+        return self._valid_record(stage, uid, index_name) is not None
+
+    def cell_result(self, stage, uid, index_name):
+        """Recorded result of a finished cell, None if the cell need to run again"""
+        record = self._valid_record(stage, uid, index_name)
+        return None if record is None else record['result']
+
+    def stage_done(self, stage, uids):
+        """Whether the stage is finished for all uids"""
+        return all(self._valid_record(stage, uid, None) is not None for uid in uids)
+
+    def stage_finished(self, stage, uids, files=()):
+        """Record the stage as finished for all uids, files are usually the stats tables of the stage"""
+        for uid in uids:
+            self.record(stage, uid, files=files)
+        return
@@ -0,0 +1,434 @@
+"""
+Per-cell streaming executor of the mapping stages after demultiplex.
+
+Each cell is a chain of dependent jobs on one CoreScheduler:
+trim R1, R2 -> map R1, R2 -> sort, dedup and filter R1, R2 -> merge -> call ALLC (each shard) -> stitch.
+A job start as soon as the jobs it depend on are done, so one cell can be deduplicated while other cells
+are still trimmed or mapped, and the cores are not idle at the stage boundaries.
+Cells are dropped by the same rules as fastq_qc and bismark, and the same stats tables as the stage
+functions are returned. Large fastq split and small cell batch of the bismark stage are not used here,
+every read type is mapped by its own bismark job.
+With a scratch work dir (see scratch.py), the final outputs of each cell are moved to out_dir as soon as
+the cell finish, and a cell only start if the scratch dir still has free space for it after the running cells.
+With a manifest, each cell is recorded after trimming, mapping, bam processing and calling, together with its
+stats rows so far. A rerun restore the stats of the recorded cells and continue each cell after its last
+recorded stage, so a killed run does not process the finished cells again.
+A failed cell release its space and the other cells still run to the end, then all failed cells are raised.
+"""
+
+import pathlib
+import shutil
+import threading
+import logging
+import pandas as pd
+from .fastq import _cells_to_trim, _trim_cell_cmd, _read_trim_report, _make_fastq_final_result
+from .bismark import _bismark_cmd, _filter_cell_reads
+from .bam import _bismark_bam_path, _bismark_report_path, _bam_process_job, _merge_cell_bams
+from .allc import _get_call_worker, _get_allc_part_paths, _stitch_allc_shards, _prepare_call_reference, \
+    _read_bam_chroms, _split_chrom_shards, _index_bam
+from .allc_stats import site_stats_tables
+from .report import read_bismark_report, bismark_report_df, BismarkReport
+from .usage import run_in_unit, usage_unit
+from .scratch import move_cell_outputs
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# scratch space reserved for a running cell, times its lane fastq size
+# (trimmed fastq, bismark bam, sorted and filtered bams are all in the work dir at some point)
+CELL_SPACE_FACTOR = 3
+# manifest stages of a cell, the last one first
+_CELL_STAGES = ['allc', 'bam', 'bismark', 'fastq']
+
+
+class CellDAG:
+    """
+    Submit the job chain of each cell to the scheduler and collect the stats of each stage.
+
+    Parameters
+    ----------
+    demultiplex_result
+        dataframe from demultiplex step, the lane fastq of each cell are removed once the cell is trimmed
+    out_dir
+        work dir of the intermediate files, pipeline universal out_dir if there is no scratch dir
+    config
+        pipeline universal config
+    scheduler
+        CoreScheduler shared by all jobs
+    final_dir
+        dir of the final outputs if out_dir is a scratch work dir
+    min_free
+        bytes kept free in out_dir, cells wait until the running cells leave enough space, 0 to start all cells
+    manifest
+        checkpoint.Manifest of the pipeline, cells recorded by a previous run continue after their recorded stage
+    """
+
+    def __init__(self, demultiplex_result, out_dir, config, scheduler, final_dir=None, min_free=0, manifest=None):
+        self.demultiplex_result = demultiplex_result
+        self.out_dir = pathlib.Path(out_dir)
+        self.config = config
+        self.scheduler = scheduler
+        self.final_dir = self.out_dir if final_dir is None else pathlib.Path(final_dir)
+        self.min_free = min_free
+        self.manifest = manifest
+
+        self.bismark_reference = config['bismark']['bismark_reference']
+        self.read_min = int(config['bismark']['read_min'])
+        self.read_max = int(config['bismark']['read_max'])
+        self.mapq_threshold = config['bamFilter']['mapq_threshold']
+        self.dedup_engine = config['bamFilter'].get('dedup_engine', 'picard')
+        self.bam_threads = int(config['bamFilter'].get('threads', '2'))
+        self.bam_pipe = config['bamFilter'].getboolean('pipe', fallback=False)
+        self.call_worker = _get_call_worker(config)
+        self.shard_number = int(config['callMethylation'].get('shard_number', '1'))
+
+        self._lanes = demultiplex_result.groupby('uid')['lane'].unique().to_dict()
+        # stats of each stage, key is (uid, index_name) or (uid, index_name, read_type)
+        self._lock = threading.Lock()
+        self.trim_results = {}
+        self.bismark_reports = {}
+        self.bam_results = {}
+        self.allc_results = {}
+        # (uid, index_name): dict of site stats table name: dataframe of the cell
+        self.site_tables = {}
+        # cells not started yet and the space reserved by the running cells
+        self._queue = []
+        self._reserved = {}
+        # (uid, index_name): error of the failed cells
+        self.failed_cells = {}
+        # (uid, index_name): last stage recorded by a previous run
+        self._resume_stages = {}
+
+    def _lane_fastq_paths(self, uid, index_name):
+        return [self.out_dir / f'{uid}_{lane}_{index_name}_{read_type}.fq.gz'
+                for lane in self._lanes[uid] for read_type in ['R1', 'R2']]
+
+    def _record(self, stage, uid, index_name, files):
+        """Record the cell in the manifest with all its stats rows so far"""
+        if self.manifest is None:
+            return
+        read_type_keys = [(uid, index_name, read_type) for read_type in ['R1', 'R2']]
+        with self._lock:
+            result = {'trim': [self.trim_results[k].to_dict() for k in read_type_keys]}
+            if stage != 'fastq':
+                result['bismark'] = [self.bismark_reports[k]._asdict() for k in read_type_keys]
+            if stage in ('bam', 'allc'):
+                result['bam'] = [self.bam_results[k].to_dict() for k in read_type_keys]
+            if stage == 'allc':
+                result['allc'] = self.allc_results[(uid, index_name)].reset_index().to_dict('records')
+                result['site_tables'] = {name: df.to_dict('records')
+                                         for name, df in self.site_tables[(uid, index_name)].items()}
+        self.manifest.record(stage, uid, index_name, files, result=result)
+        return
+
+    def _restore(self, uid, index_name, result):
+        """Put the stats rows of a recorded cell back"""
+        with self._lock:
+            for row in result['trim']:
+                self.trim_results[(uid, index_name, row['read_type'])] = pd.Series(row)
+            for row in result.get('bismark', []):
+                self.bismark_reports[(uid, index_name, row['read_type'])] = BismarkReport(**row)
+            for row in result.get('bam', []):
+                self.bam_results[(uid, index_name, row['read_type'])] = pd.Series(row)
+            if 'allc' in result:
+                count_df = pd.DataFrame(result['allc']).set_index('index')
+                count_df.index.name = None
+                self.allc_results[(uid, index_name)] = count_df
+                self.site_tables[(uid, index_name)] = {name: pd.DataFrame(rows)
+                                                       for name, rows in result['site_tables'].items()}
+        return
+
+    def resume(self, cells):
+        """
+        Restore the cells recorded by a previous run, each cell from its last valid record
+
+        Returns
+        -------
+        cells to start, the cells finished in a previous run are not included
+        """
+        if self.manifest is None:
+            return list(cells)
+        cells_to_start = []
+        for uid, index_name in cells:
+            for stage in _CELL_STAGES:
+                result = self.manifest.cell_result(stage, uid, index_name)
+                # records of the stage functions do not have the stats of the earlier stages
+                if isinstance(result, dict):
+                    log.info(f'In  uid {uid}: index {index_name} finished {stage} in previous run')
+                    self._restore(uid, index_name, result)
+                    self._resume_stages[(uid, index_name)] = stage
+                    break
+            if self._resume_stages.get((uid, index_name)) != 'allc':
+                cells_to_start.append((uid, index_name))
+        return cells_to_start
+
+    def start(self, cells):
+        """Start cells in order, as many as the free space allow"""
+        self._queue = list(cells)
+        self._start_ready()
+        return
+
+    def _start_ready(self):
+        while True:
+            with self._lock:
+                if len(self._queue) == 0:
+                    return
+                uid, index_name = self._queue[0]
+                cell_space = CELL_SPACE_FACTOR * sum(path.stat().st_size for path
+                                                     in self._lane_fastq_paths(uid, index_name) if path.exists())
+                # at least one cell is running, so the queue always move
+                if self.min_free > 0 and len(self._reserved) != 0:
+                    free = shutil.disk_usage(self.out_dir).free - sum(self._reserved.values())
+                    if free - cell_space < self.min_free:
+                        return
+                self._queue.pop(0)
+                self._reserved[(uid, index_name)] = cell_space
+            # submitted without the lock, a step that fail at once release the cell in this thread
+            self.submit_cell(uid, index_name)
+
+    def _cell_finished(self, uid, index_name):
+        # called by the last job of a cell, before its cores are released, so join wait for the next cells
+        with self._lock:
+            self._reserved.pop((uid, index_name))
+        self._start_ready()
+        return
+
+    def _cell_failed(self, uid, index_name, error):
+        log.error(f'In  uid {uid}: index {index_name} failed: {error!r}')
+        with self._lock:
+            self.failed_cells[(uid, index_name)] = error
+            self._reserved.pop((uid, index_name), None)
+        self._start_ready()
+        return
+
+    def _submit_step(self, fn, uid, index_name, *args, after=()):
+        """
+        Submit a step of the cell chain. Each step submit the next one before it return,
+        so if the step or a job it wait for fail, the chain stop here and the cell is released as failed.
+        """
+        def _step_done(future):
+            # run before the cores of the step are released, same as _cell_finished
+            if future.exception() is not None:
+                self._cell_failed(uid, index_name, future.exception())
+            return
+
+        future = self.scheduler.submit(fn, uid, index_name, *args, after=after)
+        future.add_done_callback(_step_done)
+        return future
+
+    def join(self):
+        """
+        Wait for all cells, raise RuntimeError with all failed cells if any,
+        the cells recorded in the manifest continue in a rerun.
+        """
+        try:
+            self.scheduler.join()
+        except Exception:
+            # errors of the cells are collected in failed_cells, the scheduler only raise the first one
+            if len(self.failed_cells) == 0:
+                raise
+        if len(self.failed_cells) != 0:
+            cells = ', '.join(f'{uid} {index_name}' for uid, index_name in self.failed_cells)
+            raise RuntimeError(f'{len(self.failed_cells)} cells failed: {cells}') \
+                from next(iter(self.failed_cells.values()))
+        if len(self._queue) != 0:
+            cells = ', '.join(f'{uid} {index_name}' for uid, index_name in self._queue)
+            raise RuntimeError(f'{len(self._queue)} cells never started: {cells}')
+        return
+
+    def submit_cell(self, uid, index_name):
+        """
+        Submit the trimming jobs of a cell, the following jobs are submitted when their input exist.
+        A cell recorded by a previous run start from the job after its recorded stage.
+        """
+        resume_stage = self._resume_stages.get((uid, index_name))
+        if resume_stage is not None:
+            next_step = {'fastq': self._map_cell, 'bismark': self._process_cell_bams, 'bam': self._call_cell}
+            self._submit_step(next_step[resume_stage], uid, index_name)
+            return
+        trim_jobs = [self.scheduler.run_cmd(_trim_cell_cmd(self.out_dir, uid, index_name, read_type, self.config),
+                                            shell=True, unit=('fastq_qc', uid, index_name, read_type))
+                     for read_type in ['R1', 'R2']]
+        self._submit_step(self._trimmed, uid, index_name, after=trim_jobs)
+        return
+
+    def _trimmed(self, uid, index_name):
+        for read_type in ['R1', 'R2']:
+            s = _read_trim_report(self.out_dir / f'{uid}_{index_name}_{read_type}.trimed.fq.gz')
+            s['uid'] = uid
+            s['index_name'] = index_name
+            s['read_type'] = read_type
+            with self._lock:
+                self.trim_results[(uid, index_name, read_type)] = s
+        # recorded before the lane fastq are removed
+        self._record('fastq', uid, index_name, [self.out_dir / f'{uid}_{index_name}_{read_type}.trimed.fq.gz'
+                                                for read_type in ['R1', 'R2']])
+        for path in self._lane_fastq_paths(uid, index_name):
+            path.unlink(missing_ok=True)
+        self._map_cell(uid, index_name)
+        return
+
+    def _map_cell(self, uid, index_name):
+        with self._lock:
+            total_reads = sum(int(self.trim_results[(uid, index_name, read_type)]['out_reads'])
+                              for read_type in ['R1', 'R2'])
+        if not _filter_cell_reads(uid, index_name, total_reads, self.read_min, self.read_max):
+            self._cell_finished(uid, index_name)
+            return
+        map_jobs = []
+        for read_type in ['R1', 'R2']:
+            fastq_path = self.out_dir / f'{uid}_{index_name}_{read_type}.trimed.fq.gz'
+            cmd = _bismark_cmd(self.bismark_reference, fastq_path, read_type, self.out_dir)
+            map_jobs.append(self.scheduler.run_cmd(cmd, unit=('bismark', uid, index_name, read_type)))
+        self._submit_step(self._mapped, uid, index_name, after=map_jobs)
+        return
+
+    def _mapped(self, uid, index_name):
+        files = []
+        for read_type in ['R1', 'R2']:
+            bismark_bam = _bismark_bam_path(self.out_dir, uid, index_name, read_type)
+            report = read_bismark_report(_bismark_report_path(bismark_bam), uid, index_name, read_type)
+            with self._lock:
+                self.bismark_reports[(uid, index_name, read_type)] = report
+            files += [bismark_bam, _bismark_report_path(bismark_bam)]
+        self._record('bismark', uid, index_name, files)
+        self._process_cell_bams(uid, index_name)
+        return
+
+    def _process_cell_bams(self, uid, index_name):
+        bam_jobs = []
+        for read_type in ['R1', 'R2']:
+            bismark_bam = _bismark_bam_path(self.out_dir, uid, index_name, read_type)
+            fn, args, filter_bam, temp_files = _bam_process_job(bismark_bam, self.mapq_threshold,
+                                                                self.dedup_engine, self.bam_threads, self.bam_pipe)
+            # the builtin dedup is python, it need its own process
+            future = self.scheduler.submit(run_in_unit, ('bam_qc', uid, index_name, read_type), fn, *args,
+                                           cores=self.bam_threads, process=self.dedup_engine == 'builtin')
+            bam_jobs.append((read_type, future, filter_bam, temp_files))
+        self._submit_step(self._deduped, uid, index_name, bam_jobs, after=[future for _, future, _, _ in bam_jobs])
+        return
+
+    def _deduped(self, uid, index_name, bam_jobs):
+        for read_type, future, _, _ in bam_jobs:
+            s = future.result()
+            s['uid'] = uid
+            s['index_name'] = index_name
+            s['read_type'] = read_type
+            with self._lock:
+                self.bam_results[(uid, index_name, read_type)] = s
+        final_bam_path = str(self.out_dir / f'{uid}_{index_name}.final.bam')
+        with usage_unit('bam_qc', uid, index_name):
+            _merge_cell_bams([filter_bam for _, _, filter_bam, _ in bam_jobs], final_bam_path)
+        # recorded before the bismark bams are removed
+        self._record('bam', uid, index_name, [final_bam_path])
+        for _, _, _, temp_files in bam_jobs:
+            for path in temp_files:
+                pathlib.Path(path).unlink(missing_ok=True)
+        self._call_cell(uid, index_name)
+        return
+
+    def _call_cell(self, uid, index_name):
+        final_bam_path = str(self.out_dir / f'{uid}_{index_name}.final.bam')
+        if self.shard_number > 1:
+            with usage_unit('allc', uid, index_name):
+                _index_bam(final_bam_path)
+                shards = _split_chrom_shards(_read_bam_chroms(final_bam_path), self.shard_number)
+        else:
+            shards = [None]
+        allc_path, part_paths = _get_allc_part_paths(final_bam_path, len(shards))
+        call_jobs = [self.scheduler.submit(run_in_unit, ('allc', uid, index_name), self.call_worker, final_bam_path,
+                                           regions=regions, output_path=part_path, process=True)
+                     for regions, part_path in zip(shards, part_paths)]
+        self._submit_step(self._called, uid, index_name, allc_path, part_paths, call_jobs, after=call_jobs)
+        return
+
+    def _called(self, uid, index_name, allc_path, part_paths, call_jobs):
+        count_df, site_stats = _stitch_allc_shards(allc_path, part_paths, [future.result() for future in call_jobs])
+        count_df['uid'] = uid
+        count_df['index_name'] = index_name
+        with self._lock:
+            self.allc_results[(uid, index_name)] = count_df
+            self.site_tables[(uid, index_name)] = site_stats_tables({(uid, index_name): site_stats})
+        move_cell_outputs(self.out_dir, self.final_dir, uid, index_name)
+        self._record('allc', uid, index_name, [self.final_dir / f'{uid}_{index_name}.final.bam',
+                                               self.final_dir / pathlib.Path(allc_path).name])
+        self._cell_finished(uid, index_name)
+        return
+
+    def stats_tables(self, cells):
+        """
+        Stats tables of all stages in the same format as the stage functions, cells are in the given order.
+
+        Returns
+        -------
+        dict of table name: dataframe, the name is also the file name in the stats dir
+        """
+        trim_keys = sorted(self.trim_results.keys())
+        tables = {'fastq_trim_result': _make_fastq_final_result([self.trim_results[k] for k in trim_keys])}
+        read_type_keys = [(uid, index_name, read_type) for uid, index_name in cells
+                          for read_type in ['R1', 'R2'] if (uid, index_name, read_type) in self.bismark_reports]
+        tables['bismark_result'] = bismark_report_df([self.bismark_reports[k] for k in read_type_keys])
+        tables['bam_process_result'] = pd.DataFrame([self.bam_results[k] for k in read_type_keys
+                                                     if k in self.bam_results])
+        called_cells = [cell for cell in cells if cell in self.allc_results]
+        if len(called_cells) != 0:
+            tables['allc_total_result'] = pd.concat([self.allc_results[cell] for cell in called_cells]) \
+                .reset_index(drop=False)
+            for name in self.site_tables[called_cells[0]].keys():
+                tables[name] = pd.concat([self.site_tables[cell][name] for cell in called_cells],
+                                         ignore_index=True)
+        return tables
+
+
+def _remove_lane_fastq(demultiplex_result, out_dir, keep_cells=()):
+    """Remove the lane fastq of all cells but keep_cells, and the unknown reads"""
+    out_dir = pathlib.Path(out_dir)
+    keep_cells = set(keep_cells)
+    for (uid, lane), sub_df in demultiplex_result.groupby(['uid', 'lane']):
+        for index_name in sub_df['index_name'].tolist() + ['unknown']:
+            if (uid, index_name) in keep_cells:
+                continue
+            for read_type in ['R1', 'R2']:
+                (out_dir / f'{uid}_{lane}_{index_name}_{read_type}.fq.gz').unlink(missing_ok=True)
+    return
+
+
+def run_cell_dag(demultiplex_result, out_dir, config, scheduler, exclude_cells=(), final_dir=None, min_free=0,
+                 manifest=None):
+    """
+    Trim, map, deduplicate and call mC sites of all demultiplexed cells, each cell as a chain of jobs.
+
+    Parameters
+    ----------
+    demultiplex_result
+        dataframe from demultiplex step
+    out_dir
+        work dir of the intermediate files, pipeline universal out_dir if there is no scratch dir
+    config
+        pipeline universal config
+    scheduler
+        CoreScheduler shared by the pipeline
+    exclude_cells
+        (uid, index_name) excluded by preflight, they are not trimmed
+    final_dir
+        dir of the final bam and ALLC if out_dir is a scratch work dir
+    min_free
+        bytes kept free in out_dir, see CellDAG
+    manifest
+        checkpoint.Manifest of the pipeline, see CellDAG
+    Returns
+    -------
+    dict of stats table name: dataframe, same tables as fastq_qc, bismark, bam_qc and call_methylated_sites
+    """
+    _prepare_call_reference(config)
+    cell_dag = CellDAG(demultiplex_result, out_dir, config, scheduler, final_dir, min_free, manifest)
+    # large cells first
+    cells = _cells_to_trim(demultiplex_result, config, exclude_cells)
+    cells_to_start = cell_dag.resume(cells)
+    # lane fastq of skipped, finished cells and unknown reads are not needed, free the space before any cell start
+    _remove_lane_fastq(demultiplex_result, out_dir, keep_cells=cells_to_start)
+    cell_dag.start(cells_to_start)
+    cell_dag.join()
+    _remove_lane_fastq(demultiplex_result, out_dir)
+    return cell_dag.stats_tables(cells)
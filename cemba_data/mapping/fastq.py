@@ -7,17 +7,25 @@ Output: fastq_final_result dataframe
 import pathlib
 import pandas as pd
 import subprocess
-import re
-import locale
-import functools
-import multiprocessing
 import shlex
 import logging
+import gzip
+import zlib
+import itertools
+import collections
+import concurrent.futures
+from ..tools.bgzf import BgzfWriter
+from .usage import ProcessUsage
+from .scheduler import get_scheduler, get_command_cores
+from .report import read_cutadapt_json, cutadapt_demultiplex_df, cutadapt_trim_series
 
 # logger
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# number of read pairs buffered before writing by the builtin demultiplex
+_DEMULTIPLEX_BUFFER_PAIRS = 100000
+
 
 def _make_command_dataframe(fastq_dataframe, out_dir, config):
     """
@@ -50,46 +58,345 @@ def _make_command_dataframe(fastq_dataframe, out_dir, config):
         r2_in = tmp_sub_df.loc['R2', 'fastq_path']
         r1_out = pathlib.Path(out_dir) / (f"{uid}_{lane}" + "_{name}_R1.fq.gz")
         r2_out = pathlib.Path(out_dir) / (f"{uid}_{lane}" + "_{name}_R2.fq.gz")
-        cmd = f"cutadapt {adapter_parms} -O {overlap} -o {r1_out.absolute()} -p {r2_out.absolute()} {r1_in} {r2_in}"
-        records.append([uid, lane, cmd])
+        report = pathlib.Path(out_dir) / f"{uid}_{lane}.demultiplex.json"
+        cmd = f"cutadapt {adapter_parms} -O {overlap} -o {r1_out.absolute()} -p {r2_out.absolute()} " \
+              f"--json {report.absolute()} {r1_in} {r2_in}"
+        records.append([uid, lane, cmd, str(report.absolute())])
 
-    cmd_df = pd.DataFrame(records, columns=['uid', 'lane', 'cmd'])
+    cmd_df = pd.DataFrame(records, columns=['uid', 'lane', 'cmd', 'report'])
     return cmd_df
 
 
-def _read_cutadapt_result(result):
+def _make_index_lookup_table(multiplex_index_dict, max_mismatch):
+    """
+    Map every possible index length read prefix (ACGTN) to its index name by Hamming distance.
+    Prefixes within max_mismatch of more than one index are not in the table, same as prefixes
+    that are too far from any index, so they go to unknown. N in reads is a mismatch.
+    """
+    index_length = {len(seq) for seq in multiplex_index_dict.values()}
+    if len(index_length) != 1:
+        raise ValueError('All multiplexIndex need to have the same length for builtin demultiplex.')
+    index_length = index_length.pop()
+    table = {}
+    for prefix in itertools.product('ACGTN', repeat=index_length):
+        prefix = ''.join(prefix)
+        matches = [name for name, seq in multiplex_index_dict.items()
+                   if sum(a != b for a, b in zip(prefix, seq.upper())) <= max_mismatch]
+        if len(matches) == 1:
+            table[prefix.encode()] = matches[0]
+    return table, index_length
+
+
+def _iter_fastq_records(fastq_path, block_size=1 << 22):
+    """
+    Yield (name, seq, plus, qual) byte lines of a gzip fastq, newline removed.
+    The file is decompressed in large blocks and split together, much faster than reading line by line.
+    """
+    with gzip.open(fastq_path, 'rb') as f:
+        rest = b''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines = (rest + block).split(b'\n')
+            # incomplete record go to the next block
+            n_lines = (len(lines) - 1) // 4 * 4
+            rest = b'\n'.join(lines[n_lines:])
+            yield from zip(*[iter(lines[:n_lines])] * 4)
+        lines = rest.split(b'\n')
+        yield from zip(*[iter(lines[:len(lines) // 4 * 4])] * 4)
+
+
+def _demultiplex_reads(r1_in, r2_in, writers, lookup_table, index_length, adapter_pos):
+    """
+    Core of the builtin demultiplex, route read pairs of one lane to writers by the R1 index.
+    R1 is matched at the 5' (or 3') end, the index is trimmed from R1 and R2 is kept as it is.
+
+    Parameters
+    ----------
+    writers
+        dict of index name: (R1 handle, R2 handle), handles only need a write(bytes) method.
+        Pairs of names not in writers (such as unknown) are counted but not written.
+    Returns
+    -------
+    trimmed
+        dict of index name (and unknown): number of pairs
+    total_pairs
+        number of pairs in the lane
+    """
+    trimmed = collections.defaultdict(int)
+    total_pairs = 0
+    buffers = collections.defaultdict(lambda: ([], []))
+
+    def _flush_buffers():
+        for buffer_name, (r1_buffer, r2_buffer) in buffers.items():
+            if len(r1_buffer) > 0:
+                if buffer_name in writers:
+                    writers[buffer_name][0].write(b'\n'.join(r1_buffer) + b'\n')
+                    writers[buffer_name][1].write(b'\n'.join(r2_buffer) + b'\n')
+                trimmed[buffer_name] += len(r1_buffer)
+                r1_buffer.clear()
+                r2_buffer.clear()
+        return
+
+    for (name1, seq1, plus1, qual1), r2_record in zip(_iter_fastq_records(r1_in), _iter_fastq_records(r2_in)):
+        if adapter_pos == 5:
+            name = lookup_table.get(seq1[:index_length], 'unknown')
+            if name != 'unknown':
+                seq1 = seq1[index_length:]
+                qual1 = qual1[index_length:]
+        else:
+            name = lookup_table.get(seq1[-index_length:], 'unknown')
+            if name != 'unknown':
+                seq1 = seq1[:-index_length]
+                qual1 = qual1[:-index_length]
+        r1_buffer, r2_buffer = buffers[name]
+        r1_buffer.append(b'\n'.join((name1, seq1, plus1, qual1)))
+        r2_buffer.append(b'\n'.join(r2_record))
+        total_pairs += 1
+        if total_pairs % _DEMULTIPLEX_BUFFER_PAIRS == 0:
+            _flush_buffers()
+    _flush_buffers()
+    return trimmed, total_pairs
+
+
+def _demultiplex_result_df(multiplex_index_dict, trimmed, total_pairs, index_length, adapter_pos):
+    """Builtin demultiplex counts of one lane in the same columns as report.cutadapt_demultiplex_df"""
+    adapter_type = f"non-internal {adapter_pos}'"
+    result_df = pd.DataFrame({'Sequence': list(multiplex_index_dict.values()),
+                              'Type': adapter_type,
+                              'Length': str(index_length),
+                              'Trimmed': [trimmed[name] for name in multiplex_index_dict.keys()]})
+    result_df['TotalPair'] = total_pairs
+    result_df['Ratio'] = result_df['Trimmed'] / total_pairs
+    return result_df
+
+
+def _demultiplex_lane(r1_in, r2_in, r1_out, r2_out, multiplex_index_dict, lookup_table, index_length,
+                      adapter_pos, compress_threads, skip_names=()):
     """
-    Ugly parser of cutadapt output
-    TODO: make this nicer, add example output
+    Builtin demultiplex of one lane, replace cutadapt with anchored multiplexIndex adapters.
+    Pairs are written to {name} R1 R2 files or unknown, pairs of skip_names are counted but not written.
+
+    Returns
+    -------
+    result_df
+        same columns as report.cutadapt_demultiplex_df
     """
-    p = re.compile(r"Sequence: .+; Type: .+; Length: \d+; Trimmed: \d+ times.")
-    series = []
-    total_pairs = -1
-    for line in result.stdout.split('\n'):
-        if line.startswith('Total read pairs processed'):
-            # some weird transform of cutadapt outputs...
-            locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
-            total_pairs = locale.atoi(line.split(' ')[-1])
+    names = list(multiplex_index_dict.keys()) + ['unknown']
+    executor = concurrent.futures.ThreadPoolExecutor(compress_threads) if compress_threads > 1 else None
+    # output is only read once by fastq_qc, so use fast compression
+    writers = {name: (BgzfWriter(r1_out.format(name=name), threads=compress_threads, level=1, executor=executor),
+                      BgzfWriter(r2_out.format(name=name), threads=compress_threads, level=1, executor=executor))
+               for name in names if name not in skip_names}
+    trimmed, total_pairs = _demultiplex_reads(r1_in, r2_in, writers, lookup_table, index_length, adapter_pos)
+    for r1_writer, r2_writer in writers.values():
+        r1_writer.close()
+        r2_writer.close()
+    if executor is not None:
+        executor.shutdown()
+    return _demultiplex_result_df(multiplex_index_dict, trimmed, total_pairs, index_length, adapter_pos)
 
-        m = p.search(line)
-        if m is not None:
-            result_dict = {}
-            for i in m.group().split('; '):
-                k, v = i.split(': ')
-                result_dict[k] = v
-            result_series = pd.Series(result_dict)
-            series.append(result_series)
 
-    total_df = pd.DataFrame(series)
-    total_df['Trimmed'] = total_df['Trimmed'].apply(lambda c: c.split(' ')[0]).astype(int)
-    total_df['TotalPair'] = total_pairs
-    total_df['Ratio'] = total_df['Trimmed'] / total_pairs
-    return total_df
+def _builtin_demultiplex_setting(config):
+    """multiplexIndex dict, lookup table, index length and adapter position of the builtin demultiplex"""
+    multiplex_index_dict = dict(config['multiplexIndex'])
+    anchor = config['demultiplex'].getboolean('anchor')
+    adapter_pos = int(config['demultiplex']['adapter_pos'])
+    max_mismatch = int(config['demultiplex'].get('max_mismatch', '0'))
+    if not anchor:
+        raise ValueError('Builtin demultiplex only support anchored multiplexIndex, '
+                         'use engine = cutadapt in demultiplex config.')
+    lookup_table, index_length = _make_index_lookup_table(multiplex_index_dict, max_mismatch)
+    return multiplex_index_dict, lookup_table, index_length, adapter_pos
 
 
-def demultiplex(fastq_dataframe, out_dir, config):
+def _iter_lane_fastq(fastq_dataframe):
+    """Yield (uid, lane, r1_path, r2_path) of the fastq dataframe, read_type is standardized in place"""
+    required_cols = ('uid', 'lane', 'read_type', 'fastq_path')
+    for col in required_cols:
+        if col not in fastq_dataframe.columns:
+            raise ValueError(col, 'not in fastq dataframe')
+    # standardize read_type
+    fastq_dataframe['read_type'] = fastq_dataframe['read_type'].apply(lambda i: 'R2' if '2' in str(i) else 'R1')
+    for (uid, lane), sub_df in fastq_dataframe.groupby(['uid', 'lane']):
+        tmp_sub_df = sub_df.set_index('read_type')
+        yield uid, lane, tmp_sub_df.loc['R1', 'fastq_path'], tmp_sub_df.loc['R2', 'fastq_path']
+
+
+def _demultiplex_builtin(fastq_dataframe, out_dir, config, scheduler, exclude_cells=()):
+    """
+    Builtin version of demultiplex, read R1 R2 of each lane once and match the index prefix with
+    a precomputed Hamming distance table. Output files and result dataframe are the same as cutadapt,
+    except that fastq of exclude_cells are not written.
+    """
+    multiplex_index_dict, lookup_table, index_length, adapter_pos = _builtin_demultiplex_setting(config)
+    compress_threads = int(config['demultiplex'].get('compress_threads', '1'))
+    multiplex_index_map = {v: k for k, v in multiplex_index_dict.items()}
+
+    results = []
+    for uid, lane, r1_in, r2_in in _iter_lane_fastq(fastq_dataframe):
+        r1_out = str((pathlib.Path(out_dir) / (f"{uid}_{lane}" + "_{name}_R1.fq.gz")).absolute())
+        r2_out = str((pathlib.Path(out_dir) / (f"{uid}_{lane}" + "_{name}_R2.fq.gz")).absolute())
+        # reading and routing reads use one core, compression use the rest
+        cores = 1 + (compress_threads if compress_threads > 1 else 0)
+        skip_names = [name for name in multiplex_index_dict.keys() if (uid, name) in exclude_cells]
+        result = scheduler.submit(_demultiplex_lane, r1_in, r2_in, r1_out, r2_out, multiplex_index_dict,
+                                  lookup_table, index_length, adapter_pos, compress_threads, skip_names,
+                                  cores=cores, process=True)
+        results.append((uid, lane, result))
+    scheduler.join()
+
+    total_results = []
+    for uid, lane, result in results:
+        result_df = result.result()
+        result_df['lane'] = lane
+        result_df['uid'] = uid
+        result_df['index_name'] = result_df['Sequence'].apply(lambda ind: multiplex_index_map[ind])
+        total_results.append(result_df)
+    total_result_df = pd.concat(total_results, ignore_index=True)
+    return total_result_df
+
+
+def _sample_lane_index(r1_in, lookup_table, index_length, adapter_pos, sample_pairs, chunk_size=1 << 16):
+    """
+    Count the index of the first sample_pairs R1 reads of a lane.
+
+    Returns
+    -------
+    counts
+        dict of index name (and unknown): number of sampled reads
+    fraction
+        fraction of the lane covered by the sampled reads, estimated from the compressed bytes read
+    """
+    # decompress by zlib to know how many compressed bytes the sampled reads come from,
+    # gzip.GzipFile read ahead an unknown size
+    decompressor = zlib.decompressobj(wbits=31)
+    blocks = []
+    n_lines = 0
+    compressed_size = 0
+    with open(r1_in, 'rb') as f:
+        while n_lines <= sample_pairs * 4:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            compressed_size += len(data)
+            block = decompressor.decompress(data)
+            # multi-member gzip, such as bgzip
+            while decompressor.eof and decompressor.unused_data:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                block += decompressor.decompress(data)
+            blocks.append(block)
+            n_lines += block.count(b'\n')
+    text = b''.join(blocks)
+    lines = text.split(b'\n', sample_pairs * 4)
+    records = lines[:min(sample_pairs, (len(lines) - 1) // 4) * 4]
+
+    counts = collections.defaultdict(int)
+    for seq in records[1::4]:
+        key = seq[:index_length] if adapter_pos == 5 else seq[-index_length:]
+        counts[lookup_table.get(key, 'unknown')] += 1
+    if len(records) == 0:
+        fraction = 1.
+    else:
+        # compressed size of the sampled reads over the file size, it is 1 if the whole file is sampled
+        used_size = sum(len(line) + 1 for line in records)
+        fraction = min(1., compressed_size * used_size / len(text) / pathlib.Path(r1_in).stat().st_size)
+    return dict(counts), fraction
+
+
+def _preflight_exclude(cell_pairs, config, margin, check_max=True):
+    """
+    Cells that will be dropped by total_reads_threshold, bismark read_min or read_max.
+
+    Parameters
+    ----------
+    cell_pairs
+        series of (uid, index_name): number of read pairs, exact or estimated
+    margin
+        between 0 and 1, the thresholds are loosened by margin for estimated pairs,
+        use 1 for exact pairs.
+    check_max
+        trimming only remove reads, so read_max can only be decided from estimated reads after trimming,
+        set False to check total_reads_threshold and read_min only.
+    Returns
+    -------
+    dict of (uid, index_name): reason
+    """
+    total_reads_threshold = int(config['fastqTrim']['total_reads_threshold'])
+    read_min = int(config['bismark']['read_min'])
+    read_max = int(config['bismark']['read_max'])
+
+    exclude = {}
+    for cell, pairs in cell_pairs.items():
+        # bismark count reads of R1 and R2
+        if pairs < total_reads_threshold * margin:
+            exclude[cell] = 'total_reads_threshold'
+        elif pairs * 2 < read_min * margin:
+            exclude[cell] = 'read_min'
+        elif check_max and pairs * 2 * margin > read_max:
+            exclude[cell] = 'read_max'
+    return exclude
+
+
+def preflight(fastq_dataframe, config, scheduler=None):
+    """
+    Estimate read pairs of each (uid, index_name) from a sampled prefix of each lane R1,
+    before any per-cell work. The prefix size and the margin of thresholds are set in
+    [demultiplex] preflight_sample_pairs and preflight_margin.
+
+    Parameters
+    ----------
+    fastq_dataframe
+        pipeline input fastq_dataframe
+    config
+        pipeline universal config
+    scheduler
+        CoreScheduler shared by the pipeline, if None, make one from config
+    Returns
+    -------
+    preflight_result
+        columns: uid, index_name, sampled_pairs, estimated_pairs, exclude (reason or empty string)
+    """
+    multiplex_index_dict = dict(config['multiplexIndex'])
+    adapter_pos = int(config['demultiplex']['adapter_pos'])
+    max_mismatch = int(config['demultiplex'].get('max_mismatch', '0'))
+    sample_pairs = int(config['demultiplex'].get('preflight_sample_pairs', '100000'))
+    margin = float(config['demultiplex'].get('preflight_margin', '0.5'))
+    lookup_table, index_length = _make_index_lookup_table(multiplex_index_dict, max_mismatch)
+    if scheduler is None:
+        scheduler = get_scheduler(config)
+
+    results = []
+    for uid, lane, r1_in, r2_in in _iter_lane_fastq(fastq_dataframe):
+        results.append((uid, scheduler.submit(_sample_lane_index, r1_in, lookup_table, index_length,
+                                              adapter_pos, sample_pairs, process=True)))
+    scheduler.join()
+
+    records = []
+    for uid, result in results:
+        counts, fraction = result.result()
+        for index_name in multiplex_index_dict.keys():
+            sampled = counts.get(index_name, 0)
+            records.append([uid, index_name, sampled, sampled / fraction])
+    preflight_result = pd.DataFrame(records, columns=['uid', 'index_name', 'sampled_pairs', 'estimated_pairs']) \
+        .groupby(['uid', 'index_name'], sort=False).sum().reset_index()
+    preflight_result['estimated_pairs'] = preflight_result['estimated_pairs'].round().astype(int)
+
+    exclude = _preflight_exclude(preflight_result.set_index(['uid', 'index_name'])['estimated_pairs'],
+                                 config, margin)
+    preflight_result['exclude'] = [exclude.get(cell, '') for cell in
+                                   zip(preflight_result['uid'], preflight_result['index_name'])]
+    for (uid, index_name), reason in exclude.items():
+        log.info(f'In  uid {uid}: index {index_name} excluded by pre-flight due to {reason}')
+    return preflight_result
+
+
+def demultiplex(fastq_dataframe, out_dir, config, scheduler=None, exclude_cells=()):
     """
     demultiplex of AD index using cutadapt. R1 R2 together, and each lane separately.
+    All (uid, lane) jobs share the core budget of the scheduler.
 
     Parameters
     ----------
@@ -99,44 +406,133 @@ def demultiplex(fastq_dataframe, out_dir, config):
         pipeline universal out_dir
     config
         pipeline universal config
+    scheduler
+        CoreScheduler shared by the pipeline, if None, make one from config
+    exclude_cells
+        (uid, index_name) excluded by preflight, only the builtin engine can skip writing their fastq
 
     Returns
     -------
     demultiplex result dataframe, id columns: uid, index_name, lane.
 
     """
+    if scheduler is None:
+        scheduler = get_scheduler(config)
+    if config['demultiplex'].get('engine', 'cutadapt') == 'builtin':
+        return _demultiplex_builtin(fastq_dataframe, out_dir, config, scheduler, exclude_cells)
+
     multiplex_index_dict = config['multiplexIndex']
     multiplex_index_map = {v: k for k, v in multiplex_index_dict.items()}
     cmd_df = _make_command_dataframe(fastq_dataframe, out_dir, config)
 
-    cutadapt_run = functools.partial(subprocess.run,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     encoding='utf8',
-                                     check=True)
+    # all lanes of all uids are submitted together
+    results = []
+    for i, row in cmd_df.iterrows():
+        results.append(scheduler.run_cmd(row['cmd'], unit=('demultiplex', row['uid'])))
+    scheduler.join()
+
     total_results = []
-    for uid, single_uid_df in cmd_df.groupby('uid'):
-        pool = multiprocessing.Pool(cmd_df.shape[0])
-        results = []
-        for i, row in single_uid_df.iterrows():
-            result = pool.apply_async(cutadapt_run, (shlex.split(row['cmd']),))
-            results.append(result)
-        pool.close()
-        pool.join()
-
-        for result, lane in zip(results, single_uid_df['lane']):
-            result_df = _read_cutadapt_result(result.get())
-            result_df['lane'] = lane
-            result_df['uid'] = uid
-            result_df['index_name'] = result_df['Sequence'].apply(lambda ind: multiplex_index_map[ind])
-            total_results.append(result_df)
+    for result, (i, row) in zip(results, cmd_df.iterrows()):
+        result.result()
+        result_df = cutadapt_demultiplex_df(read_cutadapt_json(row['report']))
+        pathlib.Path(row['report']).unlink()
+        result_df['lane'] = row['lane']
+        result_df['uid'] = row['uid']
+        result_df['index_name'] = result_df['Sequence'].apply(lambda ind: multiplex_index_map[ind])
+        total_results.append(result_df)
     total_result_df = pd.concat(total_results, ignore_index=True)
     return total_result_df
 
 
-def fastq_qc(demultiplex_result, out_dir, config):
+def _trim_report_path(out_path):
+    """cutadapt JSON report of the trimmed fastq out_path"""
+    return str(out_path)[:-len('.fq.gz')] + '.json'
+
+
+def _make_trim_cmd(config, read_type, out_path, cores):
+    """
+    cutadapt quality and adapter trimming command of R1 or R2, read fastq from stdin,
+    the report is written to _trim_report_path(out_path)
+    """
+    r1_adapter = config['fastqTrim']['r1_adapter']
+    r2_adapter = config['fastqTrim']['r1_adapter']
+    length_threshold = config['fastqTrim']['length_threshold']
+    quality_threshold = config['fastqTrim']['quality_threshold']
+    overlap = config['fastqTrim']['overlap']
+    if read_type == 'R1':
+        left_cut = config['fastqTrim']['r1_left_cut']
+        right_cut = config['fastqTrim']['r1_right_cut']
+        adapter = r1_adapter
+    else:
+        left_cut = config['fastqTrim']['r2_left_cut']
+        right_cut = config['fastqTrim']['r2_right_cut']
+        adapter = r2_adapter
+    return f'cutadapt -j {cores} --report=minimal -O {overlap} ' \
+           f'-q {quality_threshold} -u {left_cut} ' \
+           f'-u -{right_cut} -m {length_threshold} ' \
+           f'-a {adapter} -o {out_path} --json {_trim_report_path(out_path)} -'
+
+
+def _read_trim_report(out_path):
+    """Read and remove the cutadapt JSON report of the trimmed fastq out_path"""
+    report_path = _trim_report_path(out_path)
+    s = cutadapt_trim_series(read_cutadapt_json(report_path))
+    pathlib.Path(report_path).unlink()
+    return s
+
+
+def _make_fastq_final_result(results):
+    fastq_final_result = pd.DataFrame(results)
+    if len(results) == 0:
+        # all sample skipped
+        return fastq_final_result
+    fastq_final_result['out_reads_rate'] = \
+        fastq_final_result['out_reads'].astype(int) / fastq_final_result['in_reads'].astype(int)
+    fastq_final_result['out_bp_rate'] = \
+        fastq_final_result['out_reads'].astype(int) / fastq_final_result['in_reads'].astype(int)
+    return fastq_final_result
+
+
+def _cells_to_trim(demultiplex_result, config, exclude_cells=()):
+    """(uid, index_name) of cells to trim, large cells first, the reason of skipped cells are logged"""
+    total_reads_threshold = int(config['fastqTrim']['total_reads_threshold'])
+    cell_reads = demultiplex_result.groupby(['uid', 'index_name'])['Trimmed'].sum().sort_values(ascending=False)
+    if config['demultiplex'].getboolean('preflight', fallback=False):
+        # demultiplex counts are exact, cells that can not reach bismark read_min are not trimmed
+        exact_exclude = _preflight_exclude(cell_reads, config, margin=1, check_max=False)
+    else:
+        exact_exclude = {}
+    cells = []
+    for (uid, index_name), sample_demultiplex_total in cell_reads.items():
+        if (uid, index_name) in exclude_cells:
+            log.info(f'In  uid {uid}: index {index_name} skipped by pre-flight')
+            continue
+        if (uid, index_name) in exact_exclude:
+            log.info(f'In  uid {uid}: index {index_name} skipped '
+                     f'due to {exact_exclude[(uid, index_name)]}: {sample_demultiplex_total}')
+            continue
+        if sample_demultiplex_total < total_reads_threshold:
+            log.info(f'In  uid {uid}: index {index_name} skipped '
+                     f'due to too less reads: {sample_demultiplex_total}')
+            continue
+        cells.append((uid, index_name))
+    return cells
+
+
+def _trim_cell_cmd(out_dir, uid, index_name, read_type, config):
+    """Merge lanes and trim R1 or R2 of one cell into {uid}_{index_name}_{read_type}.trimed.fq.gz"""
+    pigz_cores = int(config['fastqTrim']['pigz_cores'])
+    cutadapt_cores = int(config['fastqTrim']['cutadapt_cores'])
+    r_path_pattern = f'{out_dir}/{uid}_L*_{index_name}_{read_type}.fq.gz'
+    r_out = f'{out_dir}/{uid}_{index_name}_{read_type}.trimed.fq.gz'
+    return f'pigz -cd -p {pigz_cores} {r_path_pattern} | ' + \
+           _make_trim_cmd(config, read_type, r_out, cutadapt_cores)
+
+
+def fastq_qc(demultiplex_result, out_dir, config, scheduler=None, exclude_cells=()):
     """
     reads level QC and trimming. R1 R2 separately and merge Lane together.
+    All (cell, read_type) jobs share the core budget of the scheduler.
 
     Parameters
     ----------
@@ -146,86 +542,40 @@ def fastq_qc(demultiplex_result, out_dir, config):
         pipeline universal out_dir
     config
         pipeline universal config
+    scheduler
+        CoreScheduler shared by the pipeline, if None, make one from config
+    exclude_cells
+        (uid, index_name) excluded by preflight, they are not trimmed
     Returns
     -------
     fastq_final_result
         id columns: uid, index_name, read_type
     """
 
-    pigz_cores = int(config['fastqTrim']['pigz_cores'])
-    cutadapt_cores = int(config['fastqTrim']['cutadapt_cores'])
+    if scheduler is None:
+        scheduler = get_scheduler(config)
 
-    r1_adapter = config['fastqTrim']['r1_adapter']
-    r2_adapter = config['fastqTrim']['r1_adapter']
-    length_threshold = config['fastqTrim']['length_threshold']
-    quality_threshold = config['fastqTrim']['quality_threshold']
-    r1_left_cut = config['fastqTrim']['r1_left_cut']
-    r1_right_cut = config['fastqTrim']['r1_right_cut']
-    r2_left_cut = config['fastqTrim']['r2_left_cut']
-    r2_right_cut = config['fastqTrim']['r2_right_cut']
-    overlap = config['fastqTrim']['overlap']
-    total_reads_threshold = int(config['fastqTrim']['total_reads_threshold'])
+    jobs = []
+    for uid, index_name in _cells_to_trim(demultiplex_result, config, exclude_cells):
+        for read_type in ['R1', 'R2']:
+            r_cmd = _trim_cell_cmd(out_dir, uid, index_name, read_type, config)
+            jobs.append((uid, index_name, read_type,
+                         scheduler.run_cmd(r_cmd, shell=True, unit=('fastq_qc', uid, index_name, read_type))))
+    scheduler.join()
 
     results = []
-    for (uid, index_name), sub_df in demultiplex_result.groupby(['uid', 'index_name']):
-        sample_demultiplex_total = sub_df['Trimmed'].sum()
-        if sample_demultiplex_total < total_reads_threshold:
-            log.info(f'In  uid {uid}: index {index_name} skipped '
-                     f'due to too less reads: {sample_demultiplex_total}')
-            continue
-        # process R1
-        r1_path_pattern = f'{out_dir}/{uid}_L*_{index_name}_R1.fq.gz'
-        r1_out = f'{out_dir}/{uid}_{index_name}_R1.trimed.fq.gz'
-        r1_cmd = f'pigz -cd -p {pigz_cores} {r1_path_pattern} | ' \
-                 f'cutadapt -j {cutadapt_cores} --report=minimal -O {overlap} ' \
-                 f'-q {quality_threshold} -u {r1_left_cut} ' \
-                 f'-u -{r1_right_cut} -m {length_threshold} ' \
-                 f'-a {r1_adapter} -o {r1_out} -'
-        r1_result = subprocess.run(r1_cmd, stdout=subprocess.PIPE,
-                                   encoding='utf8', shell=True, check=True)
-
-        # get R1 result stat
-        lines = []
-        for line in r1_result.stdout.split('\n'):
-            ll = line.split('\t')
-            if len(ll) > 1:
-                lines.append(ll)
-        s = pd.Series({name: number for name, number in zip(*lines)})
-        s['uid'] = uid
-        s['index_name'] = index_name
-        s['read_type'] = 'R1'
-        results.append(s)
-
-        # process R2
-        r2_path_pattern = f'{out_dir}/{uid}_L*_{index_name}_R2.fq.gz'
-        r2_out = f'{out_dir}/{uid}_{index_name}_R2.trimed.fq.gz'
-        r2_cmd = f'pigz -cd -p {pigz_cores} {r2_path_pattern} | ' \
-                 f'cutadapt -j {cutadapt_cores} --report=minimal -O {overlap} ' \
-                 f'-q {quality_threshold} -u {r2_left_cut} ' \
-                 f'-u -{r2_right_cut} -m {length_threshold} ' \
-                 f'-a {r2_adapter} -o {r2_out} -'
-        r2_result = subprocess.run(r2_cmd, stdout=subprocess.PIPE,
-                                   encoding='utf8', shell=True, check=True)
-        # get R2 result stat
-        lines = []
-        for line in r2_result.stdout.split('\n'):
-            ll = line.split('\t')
-            if len(ll) > 1:
-                lines.append(ll)
-        s = pd.Series({name: number for name, number in zip(*lines)})
+    for uid, index_name, read_type, r_result in sorted(jobs, key=lambda i: i[:3]):
+        # get trim result stat
+        r_result.result()
+        s = _read_trim_report(f'{out_dir}/{uid}_{index_name}_{read_type}.trimed.fq.gz')
         s['uid'] = uid
         s['index_name'] = index_name
-        s['read_type'] = 'R2'
+        s['read_type'] = read_type
         results.append(s)
 
-    fastq_final_result = pd.DataFrame(results)
+    fastq_final_result = _make_fastq_final_result(results)
     if len(results) == 0:
-        # all sample skipped
         return fastq_final_result
-    fastq_final_result['out_reads_rate'] = \
-        fastq_final_result['out_reads'].astype(int) / fastq_final_result['in_reads'].astype(int)
-    fastq_final_result['out_bp_rate'] = \
-        fastq_final_result['out_reads'].astype(int) / fastq_final_result['in_reads'].astype(int)
 
     # clean up
     for (uid, index_name), sub_df in demultiplex_result.groupby(['uid', 'index_name']):
@@ -238,3 +588,195 @@ def fastq_qc(demultiplex_result, out_dir, config):
     subprocess.run(r_rm_cmd, shell=True)
 
     return fastq_final_result
+
+
+class _CellTrim:
+    """
+    R1 and R2 trimming cutadapt of one cell, fed by _demultiplex_reads through the handles of writers().
+    Pairs are kept in memory until the cell have min_pairs, only then cutadapt is started,
+    so cells below total_reads_threshold are never trimmed.
+    """
+
+    def __init__(self, cmds, unit, min_pairs):
+        # read_type: trimming command
+        self.cmds = cmds
+        self.unit = unit
+        self.min_pairs = min_pairs
+        self.pairs = 0
+        self.buffers = {read_type: [] for read_type in cmds.keys()}
+        self.procs = None
+
+    def writers(self):
+        """(R1 handle, R2 handle) with a write(bytes) method, R1 is always written before R2"""
+        return _CellTrimInput(self, 'R1'), _CellTrimInput(self, 'R2')
+
+    def write(self, read_type, data):
+        if self.procs is not None:
+            self.procs[read_type].proc.stdin.write(data)
+            return
+        self.buffers[read_type].append(data)
+        if read_type == 'R1':
+            # fastq records are 4 lines
+            self.pairs += data.count(b'\n') // 4
+        elif self.pairs >= self.min_pairs:
+            self._start()
+        return
+
+    def _start(self):
+        self.procs = {}
+        for read_type, cmd in self.cmds.items():
+            proc = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            self.procs[read_type] = ProcessUsage(proc, self.unit + (read_type,))
+        for read_type, buffer in self.buffers.items():
+            for data in buffer:
+                self.procs[read_type].proc.stdin.write(data)
+        self.buffers = None
+        return
+
+    def close(self):
+        """Wait for cutadapt, return True if the cell is trimmed"""
+        if self.procs is None:
+            return False
+        for usage in self.procs.values():
+            usage.proc.stdin.close()
+        for usage in self.procs.values():
+            if usage.wait() != 0:
+                raise subprocess.CalledProcessError(usage.proc.returncode, usage.proc.args)
+        return True
+
+
+class _CellTrimInput:
+    """write(bytes) handle of one read type of _CellTrim"""
+
+    def __init__(self, cell_trim, read_type):
+        self.cell_trim = cell_trim
+        self.read_type = read_type
+
+    def write(self, data):
+        self.cell_trim.write(self.read_type, data)
+
+
+def _demultiplex_trim_uid(uid, lanes, out_dir, multiplex_index_dict, lookup_table, index_length,
+                          adapter_pos, config, skip_names=()):
+    """
+    Demultiplex all lanes of one uid in lane order and stream the pairs of each index into
+    one cutadapt trimming process for R1 and one for R2, so lanes are merged on the fly.
+    Pairs of skip_names are counted but not trimmed. The cutadapt of a cell start once it reach
+    total_reads_threshold, cells that never reach it are not trimmed.
+
+    Returns
+    -------
+    lane_results
+        list of (lane, demultiplex result_df)
+    trim_results
+        dict of (index_name, read_type): cutadapt report series, only for the trimmed cells
+    """
+    total_reads_threshold = int(config['fastqTrim']['total_reads_threshold'])
+    cell_trims = {}
+    for index_name in multiplex_index_dict.keys():
+        if index_name in skip_names:
+            continue
+        # many cutadapt run at the same time, each one use a single core
+        cmds = {read_type: _make_trim_cmd(config, read_type,
+                                          f'{out_dir}/{uid}_{index_name}_{read_type}.trimed.fq.gz', 1)
+                for read_type in ['R1', 'R2']}
+        cell_trims[index_name] = _CellTrim(cmds, ('fastq_qc', uid, index_name), total_reads_threshold)
+    writers = {index_name: cell_trim.writers() for index_name, cell_trim in cell_trims.items()}
+
+    lane_results = []
+    for lane, r1_in, r2_in in lanes:
+        trimmed, total_pairs = _demultiplex_reads(r1_in, r2_in, writers, lookup_table, index_length, adapter_pos)
+        lane_results.append((lane, _demultiplex_result_df(multiplex_index_dict, trimmed, total_pairs,
+                                                          index_length, adapter_pos)))
+
+    trim_results = {}
+    for index_name, cell_trim in cell_trims.items():
+        if not cell_trim.close():
+            continue
+        for read_type in ['R1', 'R2']:
+            trim_results[(index_name, read_type)] = \
+                _read_trim_report(f'{out_dir}/{uid}_{index_name}_{read_type}.trimed.fq.gz')
+    return lane_results, trim_results
+
+
+def demultiplex_trim(fastq_dataframe, out_dir, config, scheduler=None, exclude_cells=()):
+    """
+    Fused demultiplex and fastq_qc. Reads are demultiplexed by the builtin engine and piped into
+    the trimming cutadapt directly, lanes are merged in the same order as fastq_qc,
+    so only {uid}_{index_name}_R*.trimed.fq.gz are written, no lane or unknown fastq.
+
+    Parameters
+    ----------
+    fastq_dataframe
+        pipeline input fastq_dataframe
+    out_dir
+        pipeline universal out_dir
+    config
+        pipeline universal config
+    scheduler
+        CoreScheduler shared by the pipeline, if None, make one from config
+    exclude_cells
+        (uid, index_name) excluded by preflight, they are counted but not trimmed
+    Returns
+    -------
+    demultiplex_result
+        same as demultiplex
+    fastq_final_result
+        same as fastq_qc
+    """
+    multiplex_index_dict, lookup_table, index_length, adapter_pos = _builtin_demultiplex_setting(config)
+    multiplex_index_map = {v: k for k, v in multiplex_index_dict.items()}
+    total_reads_threshold = int(config['fastqTrim']['total_reads_threshold'])
+
+    uid_lanes = collections.defaultdict(list)
+    for uid, lane, r1_in, r2_in in _iter_lane_fastq(fastq_dataframe):
+        uid_lanes[uid].append((lane, r1_in, r2_in))
+
+    if scheduler is None:
+        scheduler = get_scheduler(config)
+    # cores of one single threaded trimming cutadapt, same command as _demultiplex_trim_uid
+    trim_cores = get_command_cores(_make_trim_cmd(config, 'R1', 'trimed.fq.gz', 1))
+    results = {}
+    for uid, lanes in uid_lanes.items():
+        # same lane order as the L* glob in fastq_qc
+        lanes = sorted(lanes, key=lambda i: f'{uid}_{i[0]}_')
+        skip_names = [name for name in multiplex_index_dict.keys() if (uid, name) in exclude_cells]
+        # one core to demultiplex, and the R1 and R2 cutadapt of every index run at the same time,
+        # the scheduler cap the cores at its budget
+        cores = 1 + 2 * (len(multiplex_index_dict) - len(skip_names)) * trim_cores
+        results[uid] = scheduler.submit(_demultiplex_trim_uid, uid, lanes, out_dir, multiplex_index_dict,
+                                        lookup_table, index_length, adapter_pos, config, skip_names,
+                                        cores=cores, process=True)
+    scheduler.join()
+
+    demultiplex_results = []
+    trim_results = []
+    for uid, result in results.items():
+        lane_results, uid_trim_results = result.result()
+        for lane, result_df in lane_results:
+            result_df['lane'] = lane
+            result_df['uid'] = uid
+            result_df['index_name'] = result_df['Sequence'].apply(lambda ind: multiplex_index_map[ind])
+            demultiplex_results.append(result_df)
+        uid_demultiplex_total = pd.concat([result_df for _, result_df in lane_results]) \
+            .groupby('index_name')['Trimmed'].sum()
+        for index_name in multiplex_index_dict.keys():
+            sample_demultiplex_total = uid_demultiplex_total[index_name]
+            if (uid, index_name) in exclude_cells:
+                log.info(f'In  uid {uid}: index {index_name} skipped by pre-flight')
+                continue
+            if sample_demultiplex_total < total_reads_threshold:
+                # never trimmed, see _CellTrim
+                log.info(f'In  uid {uid}: index {index_name} skipped '
+                         f'due to too less reads: {sample_demultiplex_total}')
+                continue
+            for read_type in ['R1', 'R2']:
+                s = uid_trim_results[(index_name, read_type)]
+                s['uid'] = uid
+                s['index_name'] = index_name
+                s['read_type'] = read_type
+                trim_results.append(s)
+    demultiplex_result = pd.concat(demultiplex_results, ignore_index=True)
+    # same order as fastq_qc
+    trim_results.sort(key=lambda i: (i['uid'], i['index_name'], i['read_type']))
+    return demultiplex_result, _make_fastq_final_result(trim_results)
@@ -2,11 +2,18 @@ import pandas as pd
 import pathlib
 import configparser
 import os
-import collections
-from .fastq import demultiplex, fastq_qc
+from .fastq import demultiplex, fastq_qc, demultiplex_trim, preflight
+from .scheduler import get_scheduler
 from .bismark import bismark
 from .allc import call_methylated_sites
-from .bam import bam_qc
+from .allc_stats import SITE_STATS_TABLES
+from .bam import bam_qc, bam_to_allc
+from .report import read_stat_table
+from .checkpoint import Manifest
+from .dag import run_cell_dag
+from .usage import start_usage_log, stop_usage_log, read_usage
+from .stats_store import scan_out_dir, update_stats_store
+from .scratch import get_work_dir, get_min_free, check_free_space, move_cell_outputs, remove_work_dir
 import logging
 
 # logger
@@ -73,6 +80,7 @@ def validate_fastq_dataframe(fastq_dataframe):
 def summary_pipeline_stat(out_dir):
     """
     Combine all statistics and do some additional computation.
+    The stats of all runs are kept in out_dir/stats/summary_stats.h5, a rerun only read the new or changed runs.
 
     Parameters
     ----------
@@ -87,25 +95,13 @@ def summary_pipeline_stat(out_dir):
     """
     out_dir = pathlib.Path(out_dir)
 
-    # merge all stats dataframe
-    stat_dict = collections.defaultdict(list)
-    for f in out_dir.glob('**/stats/*tsv.gz'):
-        df = pd.read_table(f)
-        stat_dict[f.name.split('.')[0]].append(df)
-    # result df is a dict contain 5 concat dfs for raw metadata
-    result_dfs = {}
-    for k, v in stat_dict.items():
-        result_dfs[k] = pd.concat(v, ignore_index=True, sort=True)
-    # save all concatenated stats into out_dir level stats folder
-    total_stats = out_dir / 'stats'
-    total_stats.mkdir()
-    for k, v in result_dfs.items():
-        k_path = total_stats / f'{k}.tsv.gz'
-        v.to_csv(str(k_path), sep='\t', compression='gzip')
+    # stats of all runs, only new or changed runs are read, see stats_store.py
+    stat_dirs, allc_dict, bam_dict = scan_out_dir(out_dir)
+    result_dfs = update_stats_store(out_dir, stat_dirs)
 
     # demultiplex stat, from cutadapt demultiplex step
-    demultiplex_result = result_dfs['demultiplex_result'].groupby(['uid', 'index_name']) \
-        .sum()[['TotalPair', 'Trimmed']]
+    demultiplex_result = result_dfs['demultiplex_result'].groupby(['uid', 'index_name'])[['TotalPair', 'Trimmed']] \
+        .sum()
     demultiplex_result.rename(columns={'TotalPair': 'MultiplexReadsTotal',
                                        'Trimmed': 'IndexReadsTotal'},
                               inplace=True)
@@ -115,8 +111,8 @@ def summary_pipeline_stat(out_dir):
         'MultiplexReadsTotal'] * 100
 
     # fastq trim stat
-    fastq_trim_result = result_dfs['fastq_trim_result'].groupby(['uid', 'index_name']).sum()[
-        ['in_bp', 'out_bp', 'out_reads', 'qualtrim_bp', 'too_short', 'w/adapters']]
+    fastq_trim_result = result_dfs['fastq_trim_result'].groupby(['uid', 'index_name'])[
+        ['in_bp', 'out_bp', 'out_reads', 'qualtrim_bp', 'too_short', 'w/adapters']].sum()
     fastq_trim_result.rename(columns={'in_bp': 'IndexBpTotal',
                                       'out_bp': 'IndexTrimedBpTotal',
                                       'out_reads': 'IndexTrimedReadsTotal',
@@ -129,7 +125,8 @@ def summary_pipeline_stat(out_dir):
         'IndexReadsTotal']
 
     # bismark stat
-    bismark_r1 = result_dfs['bismark_result'][result_dfs['bismark_result']['read_type'].apply(lambda i: '1' in i)] \
+    bismark_df = result_dfs['bismark_result']
+    bismark_r1 = bismark_df[bismark_df['read_type'].astype(str).str.contains('1')] \
         .set_index(['uid', 'index_name'])[['CTOB', 'CTOT', 'mapping_rate', 'total_c',
                                            'total_reads', 'unique_map', 'unmap', 'ununique_map']]
     bismark_r1.rename(columns={'mapping_rate': 'R1MappedRatio',  # this mapping rate is unique mapping rate
@@ -139,7 +136,7 @@ def summary_pipeline_stat(out_dir):
                                'unmap': 'R1UnmappedReads',
                                'ununique_map': 'R1UnuniqueMappedReads'},
                       inplace=True)
-    bismark_r2 = result_dfs['bismark_result'][result_dfs['bismark_result']['read_type'].apply(lambda i: '2' in i)] \
+    bismark_r2 = bismark_df[bismark_df['read_type'].astype(str).str.contains('2')] \
         .set_index(['uid', 'index_name'])[['OB', 'OT', 'mapping_rate', 'total_c',
                                            'total_reads', 'unique_map', 'unmap', 'ununique_map']]
     bismark_r2.rename(columns={'mapping_rate': 'R2MappedRatio',
@@ -153,30 +150,27 @@ def summary_pipeline_stat(out_dir):
     bismark_result['TotalUniqueMappedReads'] = \
         bismark_result['R1UniqueMappedReads'] + bismark_result['R2UniqueMappedReads']
     bismark_result['TotalMappedRatio'] = bismark_result['TotalUniqueMappedReads'] / bismark_result[
-        'R1TrimmedReads', 'R2TrimmedReads'].sum(axis=1)
+        ['R1TrimmedReads', 'R2TrimmedReads']].sum(axis=1)
 
     bam_result = result_dfs['bam_process_result'].groupby(['uid', 'index_name']) \
-        .sum()[['UNPAIRED_READ_DUPLICATES', 'out_reads']] \
+        [['UNPAIRED_READ_DUPLICATES', 'out_reads']].sum() \
         .rename(columns={'UNPAIRED_READ_DUPLICATES': 'DupReads',
                          'out_reads': 'DeduppedReads'})
     bam_result['DeduppedRatio'] = bam_result['DeduppedReads'] / bam_result.sum(axis=1)
 
-    # ALLC stat
-    cov_df = result_dfs['allc_total_result'] \
-        .set_index(['uid', 'index_name', 'index'])['cov'] \
-        .unstack('index') \
-        .fillna(0).astype(int)
-    ccc_cov = cov_df['CCC']
-    cov_df = cov_df.groupby(lambda i: i[:2], axis=1) \
-        .sum()[['CA', 'CC', 'CG', 'CT']] \
+    # ALLC stat, contexts are summed by their first two bases, such as CAG to CA
+    allc_total = result_dfs['allc_total_result']
+    allc_total = allc_total.assign(context=allc_total['index'].str[:2])
+    context_df = allc_total.pivot_table(index=['uid', 'index_name'], columns='context',
+                                        values=['mc', 'cov'], aggfunc='sum', fill_value=0)
+    ccc_df = allc_total[allc_total['index'] == 'CCC'].groupby(['uid', 'index_name'])[['mc', 'cov']].sum() \
+        .reindex(context_df.index, fill_value=0)
+    ccc_cov = ccc_df['cov']
+    cov_df = context_df['cov'].reindex(columns=['CA', 'CC', 'CG', 'CT'], fill_value=0) \
         .rename(columns={c: c + '_Cov' for c in ['CA', 'CC', 'CG', 'CT']})
     cov_df['CH_Cov'] = cov_df[['CA_Cov', 'CC_Cov', 'CT_Cov']].sum(axis=1)
-    mc_df = result_dfs['allc_total_result'] \
-        .set_index(['uid', 'index_name', 'index'])['mc'] \
-        .unstack('index').fillna(0).astype(int)
-    ccc_mc = mc_df['CCC']
-    mc_df = mc_df.groupby(lambda i: i[:2], axis=1) \
-        .sum()[['CA', 'CC', 'CG', 'CT']] \
+    ccc_mc = ccc_df['mc']
+    mc_df = context_df['mc'].reindex(columns=['CA', 'CC', 'CG', 'CT'], fill_value=0) \
         .rename(columns={c: c + '_Mc' for c in ['CA', 'CC', 'CG', 'CT']})
     mc_df['CH_Mc'] = mc_df[['CA_Mc', 'CC_Mc', 'CT_Mc']].sum(axis=1)
     # add mc rate
@@ -194,24 +188,69 @@ def summary_pipeline_stat(out_dir):
                             bam_result, mc_df, cov_df],
                            sort=True, axis=1).dropna()
 
+    # resource usage, commands of a whole uid (demultiplex) or a bismark batch are not counted in any cell
+    if 'resource_usage' in result_dfs:
+        usage_df = result_dfs['resource_usage'].dropna(subset=['uid', 'index_name'])
+        usage_result = usage_df.groupby(['uid', 'index_name', 'stage'])[['cpu_time', 'wall_time']] \
+            .sum().unstack('stage').fillna(0)
+        usage_result.columns = [stage.title().replace('_', '') + {'cpu_time': 'CpuTime', 'wall_time': 'WallTime'}[col]
+                                for col, stage in usage_result.columns]
+        cell_usage = usage_df.groupby(['uid', 'index_name'])
+        usage_result['TotalCpuTime'] = cell_usage['cpu_time'].sum()
+        usage_result['PeakRss'] = cell_usage['peak_rss'].max()
+        total_meta = total_meta.join(usage_result)
+
     # file paths
-    allc_dict = {}
-    for f in out_dir.glob('**/allc*tsv.gz'):
-        if 'stats' in f.parent.name:
-            continue
-        _, uid, index_name = (f.name.split('.')[0].split('_'))
-        allc_dict[(uid, index_name)] = str(f)
     total_meta['AllcPath'] = pd.Series(allc_dict)
-    bam_dict = {}
-    for f in out_dir.glob('**/*bam'):
-        if 'stats' in f.parent.name:
-            continue
-        uid, index_name = f.name.split('.')[0].split('_')
-        bam_dict[(uid, index_name)] = str(f)
-    total_meta['BamPath'] = pd.Series(allc_dict)
+    total_meta['BamPath'] = pd.Series(bam_dict)
     return total_meta
 
 
+def _cell_dag_pipeline(fastq_dataframe, out_dir, work_dir, config, scheduler, exclude_cells, manifest, uids,
+                       work_files=()):
+    """
+    Demultiplex, then trim, map, deduplicate and call mC sites of each cell as a chain of jobs, see dag.py.
+    The same stats tables as the stage pipeline are written. Demultiplex and each stage of each cell are
+    recorded as soon as they finish, so a killed run continue every cell after its last recorded stage.
+    """
+    stat_dir = out_dir / 'stats'
+    if manifest.stage_done('demultiplex', uids):
+        log.info('Demultiplex finished in previous run.')
+        demultiplex_df = read_stat_table(stat_dir / 'demultiplex_result.tsv.gz')
+    else:
+        log.info('Demultiplex fastq file.')
+        demultiplex_df = demultiplex(fastq_dataframe, work_dir, config, scheduler, exclude_cells)
+        demultiplex_df.to_csv(stat_dir / 'demultiplex_result.tsv.gz',
+                              sep='\t', compression='gzip', index=None)
+        # the lane fastq are in the work dir
+        manifest.stage_finished('demultiplex', uids, [stat_dir / 'demultiplex_result.tsv.gz'] + list(work_files))
+
+    log.info('Trim, map, deduplicate and filter each cell, then calculate its mC sites.')
+    stat_dfs = run_cell_dag(demultiplex_df, work_dir, config, scheduler, exclude_cells,
+                            final_dir=out_dir, min_free=get_min_free(config), manifest=manifest)
+    for name, stat_df in stat_dfs.items():
+        if stat_df.shape[0] != 0:
+            stat_df.to_csv(stat_dir / f'{name}.tsv.gz',
+                           sep='\t', compression='gzip', index=None)
+    if stat_dfs['fastq_trim_result'].shape[0] == 0:
+        log.warning('no sample remained after fastq qc step')
+        return
+    if stat_dfs['bismark_result'].shape[0] == 0:
+        log.warning('no sample remained after bismark step')
+        return
+
+    manifest.stage_finished('fastq', uids, [stat_dir / 'demultiplex_result.tsv.gz',
+                                            stat_dir / 'fastq_trim_result.tsv.gz'])
+    manifest.stage_finished('bismark', uids, [stat_dir / 'bismark_result.tsv.gz'])
+    manifest.stage_finished('bam', uids, [stat_dir / 'bam_process_result.tsv.gz'])
+    manifest.stage_finished('allc', uids, [stat_dir / f'{name}.tsv.gz' for name in stat_dfs.keys()
+                                           if name not in ('fastq_trim_result', 'bismark_result',
+                                                           'bam_process_result')])
+    remove_work_dir(work_dir, out_dir)
+    log.info('Mapping finished.')
+    return 0
+
+
 def pipeline(fastq_dataframe, out_dir, config_path=None):
     """
     Run full pipeline: demultiplex, fastq QC, bismark mapping, bam QC, ALLC calling
@@ -240,44 +279,136 @@ def pipeline(fastq_dataframe, out_dir, config_path=None):
     if not out_dir.exists():
         out_dir.mkdir(parents=True, exist_ok=True)
     stat_dir = out_dir / 'stats'
-    stat_dir.mkdir()
-
-    # fastq demultiplex
-    log.info('Demultiplex fastq file.')
-    demultiplex_df = demultiplex(fastq_dataframe, out_dir, config)
-    demultiplex_df.to_csv(stat_dir / 'demultiplex_result.tsv.gz',
-                          sep='\t', compression='gzip', index=None)
-
-    # fastq qc
-    log.info('Trim fastq file and merge lanes.')
-    fastq_final_df = fastq_qc(demultiplex_df, out_dir, config)
-    if fastq_final_df.shape[0] == 0:
-        log.warning('no sample remained after fastq qc step')
-        return
+    stat_dir.mkdir(exist_ok=True)
+    # stages and cells finished by a previous run in the same out_dir are skipped
+    manifest = Manifest(stat_dir)
+    uids = fastq_dataframe['uid'].unique().tolist()
+    # core budget shared by the fastq stages
+    scheduler = get_scheduler(config)
+
+    # resource usage of the commands of all stages, also written if the run failed
+    start_usage_log(stat_dir / 'resource_usage')
+    try:
+        return _pipeline_stages(fastq_dataframe, out_dir, config, scheduler, manifest, uids)
+    finally:
+        stop_usage_log()
+        # records of a previous run in the same out_dir are kept
+        usage_df = read_usage(stat_dir / 'resource_usage')
+        if usage_df.shape[0] != 0:
+            usage_df.to_csv(stat_dir / 'resource_usage.tsv.gz',
+                            sep='\t', compression='gzip', index=None)
+
+
+def _pipeline_stages(fastq_dataframe, out_dir, config, scheduler, manifest, uids):
+    """Run the stages not finished by a previous run, see pipeline"""
+    stat_dir = out_dir / 'stats'
+    if manifest.stage_done('allc', uids):
+        log.info('Mapping finished in previous run.')
+        return 0
+    # intermediate files are in the scratch work dir if there is one, only final outputs are moved to out_dir.
+    # stages with output in the work dir are recorded with its marker, they run again if the work dir is lost
+    work_dir, scratch_marker = get_work_dir(out_dir, config)
+    work_files = [] if scratch_marker is None else [scratch_marker]
+    if manifest.stage_done('fastq', uids):
+        log.info('Demultiplex and trimming finished in previous run.')
+        fastq_final_df = read_stat_table(stat_dir / 'fastq_trim_result.tsv.gz')
+    else:
+        exclude_cells = set()
+        if config['demultiplex'].getboolean('preflight', fallback=False):
+            # estimate reads of each cell from the fastq prefix, doomed cells are not trimmed and mapped
+            log.info('Estimate reads of each cell.')
+            preflight_df = preflight(fastq_dataframe, config, scheduler)
+            preflight_df.to_csv(stat_dir / 'preflight_result.tsv.gz',
+                                sep='\t', compression='gzip', index=None)
+            excluded = preflight_df[preflight_df['exclude'] != '']
+            exclude_cells = set(zip(excluded['uid'], excluded['index_name']))
+
+        if config.getboolean('scheduler', 'cell_dag', fallback=False):
+            # each cell run from trimming to ALLC without waiting for other cells
+            return _cell_dag_pipeline(fastq_dataframe, out_dir, work_dir, config, scheduler, exclude_cells,
+                                      manifest, uids, work_files)
+        if scratch_marker is not None:
+            check_free_space(work_dir, get_min_free(config))
+        if config['demultiplex'].get('engine', 'cutadapt') == 'builtin' and \
+                config['demultiplex'].getboolean('stream_to_trim', fallback=False):
+            # demultiplex and trim in one stream
+            log.info('Demultiplex fastq file, trim fastq file and merge lanes.')
+            demultiplex_df, fastq_final_df = demultiplex_trim(fastq_dataframe, work_dir, config, scheduler,
+                                                              exclude_cells)
+            demultiplex_df.to_csv(stat_dir / 'demultiplex_result.tsv.gz',
+                                  sep='\t', compression='gzip', index=None)
+        else:
+            # fastq demultiplex
+            log.info('Demultiplex fastq file.')
+            demultiplex_df = demultiplex(fastq_dataframe, work_dir, config, scheduler, exclude_cells)
+            demultiplex_df.to_csv(stat_dir / 'demultiplex_result.tsv.gz',
+                                  sep='\t', compression='gzip', index=None)
+
+            # fastq qc
+            log.info('Trim fastq file and merge lanes.')
+            fastq_final_df = fastq_qc(demultiplex_df, work_dir, config, scheduler, exclude_cells)
+        if fastq_final_df.shape[0] == 0:
+            log.warning('no sample remained after fastq qc step')
+            return
+        else:
+            fastq_final_df.to_csv(stat_dir / 'fastq_trim_result.tsv.gz',
+                                  sep='\t', compression='gzip', index=None)
+        # lane fastq are removed by trimming, so demultiplex and trimming are one stage
+        manifest.stage_finished('fastq', uids, [stat_dir / 'demultiplex_result.tsv.gz',
+                                                stat_dir / 'fastq_trim_result.tsv.gz'] + work_files)
+
+    # bismark, cells mapped in previous run are not mapped again
+    if manifest.stage_done('bismark', uids):
+        log.info('Bismark mapping finished in previous run.')
+        bismark_df = read_stat_table(stat_dir / 'bismark_result.tsv.gz')
     else:
-        fastq_final_df.to_csv(stat_dir / 'fastq_trim_result.tsv.gz',
+        if scratch_marker is not None:
+            check_free_space(work_dir, get_min_free(config))
+        log.info('Use bismark and bowtie2 to do mapping.')
+        bismark_df = bismark(fastq_final_df, work_dir, config, manifest)
+        if bismark_df.shape[0] == 0:
+            log.warning('no sample remained after bismark step')
+            return
+        else:
+            bismark_df.to_csv(stat_dir / 'bismark_result.tsv.gz',
                               sep='\t', compression='gzip', index=None)
-
-    # bismark
-    log.info('Use bismark and bowtie2 to do mapping.')
-    bismark_df = bismark(fastq_final_df, out_dir, config)
-    if bismark_df.shape[0] == 0:
-        log.warning('no sample remained after bismark step')
-        return
+        manifest.stage_finished('bismark', uids, [stat_dir / 'bismark_result.tsv.gz'] + work_files)
+
+    bam_done = manifest.stage_done('bam', uids)
+    fused = config['bamFilter'].getboolean('stream_to_allc', fallback=False) and not bam_done
+    if scratch_marker is not None and not bam_done:
+        check_free_space(work_dir, get_min_free(config))
+    if fused:
+        # bam and allc in one stream, the bam stage is recorded together with the allc stage
+        log.info('Deduplicate and filter bam files, calculate mC sites from the filtered reads.')
+        bam_df, allc_df = bam_to_allc(bismark_df, work_dir, config, stat_dir=stat_dir)
+        bam_df.to_csv(stat_dir / 'bam_process_result.tsv.gz',
+                      sep='\t', compression='gzip', index=None)
     else:
-        bismark_df.to_csv(stat_dir / 'bismark_result.tsv.gz',
+        # bam, cells processed in previous run are not processed again
+        if bam_done:
+            log.info('Deduplicate and filter bam files finished in previous run.')
+            bam_df = read_stat_table(stat_dir / 'bam_process_result.tsv.gz')
+        else:
+            log.info('Deduplicate and filter bam files.')
+            bam_df = bam_qc(bismark_df, work_dir, config, manifest)
+            bam_df.to_csv(stat_dir / 'bam_process_result.tsv.gz',
                           sep='\t', compression='gzip', index=None)
+            manifest.stage_finished('bam', uids, [stat_dir / 'bam_process_result.tsv.gz'] + work_files)
 
-    # bam
-    log.info('Deduplicate and filter bam files.')
-    bam_df = bam_qc(bismark_df, out_dir, config)
-    bam_df.to_csv(stat_dir / 'bam_process_result.tsv.gz',
-                  sep='\t', compression='gzip', index=None)
-
-    # allc
-    log.info('Calculate mC sites.')
-    allc_df = call_methylated_sites(bam_df, out_dir, config)
+        # allc
+        log.info('Calculate mC sites.')
+        # site level profile, histograms and chromosome totals are collected during calling and written in stat_dir
+        allc_df = call_methylated_sites(bam_df, work_dir, config, stat_dir=stat_dir)
     allc_df.to_csv(stat_dir / 'allc_total_result.tsv.gz',
                    sep='\t', compression='gzip', index=None)
+    allc_stat_paths = [stat_dir / 'allc_total_result.tsv.gz'] + \
+                      [stat_dir / f'{name}.tsv.gz' for name in SITE_STATS_TABLES]
+    for uid, index_name in allc_df[['uid', 'index_name']].drop_duplicates().itertuples(index=False):
+        move_cell_outputs(work_dir, out_dir, uid, index_name)
+    if fused:
+        manifest.stage_finished('bam', uids, [stat_dir / 'bam_process_result.tsv.gz'])
+    manifest.stage_finished('allc', uids, allc_stat_paths)
+    remove_work_dir(work_dir, out_dir)
     log.info('Mapping finished.')
     return 0
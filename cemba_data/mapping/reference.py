@@ -0,0 +1,299 @@
+"""
+Prepared reference for ALLC calling.
+
+The reference fasta is encoded once into a flat upper case uint8 file ({reference_fasta}.encoded),
+chromosome offsets are saved in {reference_fasta}.encoded.idx.
+ALLC workers open the file with numpy memmap, so all workers share the same genome through page cache,
+getting a chromosome is just a slice of the map.
+
+The genome wide cytosine context table ({reference_fasta}.context_u{up}_d{down}/) is built from the
+prepared reference. For each chromosome, {chrom}.pos.npy save the sorted 0-based positions of all C and G,
+{chrom}.context.npy save the context code of each position, codes are row numbers in codebook.txt.
+Positions without a complete context get the max value of the code dtype.
+"""
+
+import os
+import pathlib
+import numpy as np
+import pandas as pd
+import logging
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+# uint8 lookup table for reverse complement, 0 means base can not be complemented
+_COMPLEMENT_ARRAY = np.zeros(256, dtype=np.uint8)
+for _base, _complement_base in zip(b'ACGTN', b'TGCAN'):
+    _COMPLEMENT_ARRAY[_base] = _complement_base
+
+# bases of each block when building the context table
+_CONTEXT_TABLE_BLOCK = 10000000
+
+
+def _read_faidx(faidx_path):
+    """
+    Read fadix of reference fasta file
+    samtools fadix ref.fa
+    """
+    return pd.read_table(faidx_path, index_col=0, header=None,
+                         names=['NAME', 'LENGTH', 'OFFSET', 'LINEBASES', 'LINEWIDTH'])
+
+
+def get_prepared_reference_path(reference_fasta):
+    return str(reference_fasta) + '.encoded'
+
+
+def prepare_reference(reference_fasta, overwrite=False):
+    """
+    Encode reference fasta into the prepared reference, skip if it already exist.
+
+    Parameters
+    ----------
+    reference_fasta
+        path of reference fasta, need to be indexed by samtools faidx
+    overwrite
+        whether to rebuild the prepared reference if it already exist
+    Returns
+    -------
+    path of the prepared reference
+    """
+    reference_fasta = str(reference_fasta)
+    encoded_path = get_prepared_reference_path(reference_fasta)
+    index_path = encoded_path + '.idx'
+    if not overwrite and pathlib.Path(index_path).exists():
+        return encoded_path
+
+    faidx_path = pathlib.Path(reference_fasta + '.fai')
+    if not faidx_path.exists():
+        raise FileNotFoundError("Reference fasta not indexed. Use samtools faidx to index it and run again.")
+    fai_df = _read_faidx(faidx_path)
+    log.info(f'Prepare encoded reference for {reference_fasta}')
+
+    # write to tmp file first, other jobs may check the index at the same time
+    tmp_suffix = f'.tmp{os.getpid()}'
+    records = []
+    cur_offset = 0
+    with open(reference_fasta, 'rb') as fasta, open(encoded_path + tmp_suffix, 'wb') as out:
+        for chrom, row in fai_df.iterrows():
+            length = int(row['LENGTH'])
+            n_lines = -(-length // int(row['LINEBASES']))
+            fasta.seek(int(row['OFFSET']))
+            raw = fasta.read(n_lines * int(row['LINEWIDTH']))
+            seq = raw.replace(b'\n', b'').replace(b'\r', b'')[:length].upper()
+            if len(seq) != length:
+                raise ValueError(f'Chromosome {chrom} length in fasta not match the fai file.')
+            out.write(seq)
+            records.append([chrom, cur_offset, length])
+            cur_offset += length
+    chrom_df = pd.DataFrame(records, columns=['chrom', 'offset', 'length'])
+    chrom_df.to_csv(index_path + tmp_suffix, sep='\t', index=None)
+    os.replace(encoded_path + tmp_suffix, encoded_path)
+    os.replace(index_path + tmp_suffix, index_path)
+    return encoded_path
+
+
+def read_prepared_reference(reference_fasta):
+    """
+    Open the prepared reference as a read only uint8 memmap.
+
+    Returns
+    -------
+    (genome, chrom_df), or None if the prepared reference not exist
+    """
+    encoded_path = get_prepared_reference_path(reference_fasta)
+    index_path = encoded_path + '.idx'
+    if not pathlib.Path(index_path).exists():
+        return None
+    chrom_df = pd.read_table(index_path, index_col=0)
+    genome = np.memmap(encoded_path, dtype=np.uint8, mode='r')
+    return genome, chrom_df
+
+
+def get_chromosome_array(prepared_reference, chrom):
+    """
+    Slice one chromosome from the prepared reference, no copy. Return None if chrom not in reference.
+    """
+    genome, chrom_df = prepared_reference
+    if chrom not in chrom_df.index:
+        return None
+    offset = chrom_df.at[chrom, 'offset']
+    return genome[offset:offset + chrom_df.at[chrom, 'length']]
+
+
+def get_site_contexts(seq, pos, minus_strand, num_upstr_bases, num_downstr_bases):
+    """
+    Vectorized version of the context slicing in allc._call_methylated_sites_worker.
+    seq is the uint8 encoded upper case chromosome sequence.
+
+    Returns
+    -------
+    context
+        str array of site contexts, G strand contexts are reverse complemented
+    valid
+        bool array, False if the complete context is not available
+    """
+    context_len = num_upstr_bases + 1 + num_downstr_bases
+    plus_offset = np.arange(-num_upstr_bases, num_downstr_bases + 1)
+    minus_offset = np.arange(num_upstr_bases, -num_downstr_bases - 1, -1)
+    index = pos[:, None] + np.where(minus_strand[:, None], minus_offset[None, :], plus_offset[None, :])
+    valid = (index.min(axis=1) >= 0) & (index.max(axis=1) < seq.size)
+    index[~valid] = 0
+
+    context = seq[index]
+    context[minus_strand] = _COMPLEMENT_ARRAY[context[minus_strand]]
+    # same as the KeyError of complement dict in the mpileup engine
+    valid &= (context != 0).all(axis=1)
+    context = np.ascontiguousarray(context).view(f'S{context_len}').ravel().astype(str)
+    return context, valid
+
+
+def get_context_table_dir(reference_fasta, num_upstr_bases, num_downstr_bases):
+    return f'{reference_fasta}.context_u{num_upstr_bases}_d{num_downstr_bases}'
+
+
+def _save_array(path, array, tmp_suffix):
+    # np.save to a tmp file, then replace path, so np.load never read a half written array
+    tmp_path = str(path) + tmp_suffix
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+    return
+
+
+def prepare_context_table(reference_fasta, num_upstr_bases, num_downstr_bases, overwrite=False):
+    """
+    Precompute positions and context codes of all C and G in the genome, skip if the table already exist.
+    The prepared reference is built first if needed.
+
+    Parameters
+    ----------
+    reference_fasta
+        path of reference fasta, need to be indexed by samtools faidx
+    num_upstr_bases
+        number of base before mC
+    num_downstr_bases
+        number of base after mC
+    overwrite
+        whether to rebuild the table if it already exist
+    Returns
+    -------
+    directory of the context table
+    """
+    table_dir = pathlib.Path(get_context_table_dir(reference_fasta, num_upstr_bases, num_downstr_bases))
+    codebook_path = table_dir / 'codebook.txt'
+    if not overwrite and codebook_path.exists():
+        return str(table_dir)
+    prepare_reference(reference_fasta)
+    prepared_reference = read_prepared_reference(reference_fasta)
+    log.info(f'Prepare context table for {reference_fasta}')
+    table_dir.mkdir(exist_ok=True)
+    # every file is written to a tmp file of this process first, other jobs may build the same table
+    tmp_suffix = f'.tmp{os.getpid()}'
+
+    codebook = {}  # context: code
+    for chrom in prepared_reference[1].index:
+        seq = get_chromosome_array(prepared_reference, chrom)
+        pos_list = []
+        code_list = []
+        for block_start in range(0, seq.size, _CONTEXT_TABLE_BLOCK):
+            block = seq[block_start:block_start + _CONTEXT_TABLE_BLOCK]
+            pos = np.flatnonzero((block == ord('C')) | (block == ord('G'))) + block_start
+            context, valid = get_site_contexts(seq, pos, seq[pos] == ord('G'),
+                                               num_upstr_bases, num_downstr_bases)
+            unique_context, inverse = np.unique(context[valid], return_inverse=True)
+            for c in unique_context:
+                if c not in codebook:
+                    codebook[c] = len(codebook)
+            code = np.full(pos.size, -1, dtype=np.int64)
+            code[valid] = np.array([codebook[c] for c in unique_context], dtype=np.int64)[inverse]
+            pos_list.append(pos.astype(np.uint32))
+            code_list.append(code)
+        _save_array(table_dir / f'{chrom}.pos.npy', np.concatenate(pos_list), tmp_suffix)
+        # int32 first, cast to the final dtype after the codebook finished
+        with open(table_dir / f'{chrom}.context.npy{tmp_suffix}.int32', 'wb') as f:
+            np.save(f, np.concatenate(code_list).astype(np.int32))
+
+    code_dtype = np.uint8 if len(codebook) < np.iinfo(np.uint8).max else np.uint16
+    for chrom in prepared_reference[1].index:
+        tmp_path = table_dir / f'{chrom}.context.npy{tmp_suffix}.int32'
+        code = np.load(tmp_path)
+        code = np.where(code < 0, np.iinfo(code_dtype).max, code).astype(code_dtype)
+        _save_array(table_dir / f'{chrom}.context.npy', code, tmp_suffix)
+        tmp_path.unlink()
+    # codebook is written last, it marks the table is complete
+    with open(str(codebook_path) + tmp_suffix, 'w') as f:
+        for c in sorted(codebook, key=codebook.get):
+            f.write(c + '\n')
+    os.replace(str(codebook_path) + tmp_suffix, codebook_path)
+    return str(table_dir)
+
+
+def read_context_table(reference_fasta, num_upstr_bases, num_downstr_bases):
+    """
+    Open the context table, chromosome arrays are loaded lazily as memmap by get_chromosome_context.
+
+    Returns
+    -------
+    (table_dir, codebook), codebook is a str array of contexts, or None if the table not exist
+    """
+    table_dir = pathlib.Path(get_context_table_dir(reference_fasta, num_upstr_bases, num_downstr_bases))
+    codebook_path = table_dir / 'codebook.txt'
+    if not codebook_path.exists():
+        return None
+    with open(codebook_path) as f:
+        codebook = np.array([line.rstrip('\n') for line in f])
+    return table_dir, codebook
+
+
+def get_chromosome_context(context_table, chrom):
+    """
+    Return (pos, code) memmap arrays of one chromosome, or None if chrom not in table
+    """
+    table_dir = context_table[0]
+    pos_path = table_dir / f'{chrom}.pos.npy'
+    if not pos_path.exists():
+        return None
+    return np.load(pos_path, mmap_mode='r'), np.load(table_dir / f'{chrom}.context.npy', mmap_mode='r')
+
+
+def lookup_site_contexts(context_table, chrom_context, pos):
+    """
+    Assign contexts to sorted C/G positions with searchsorted, positions must be C or G in the reference.
+
+    Returns
+    -------
+    context
+        str array of site contexts
+    valid
+        bool array, False if the complete context is not available
+    """
+    table_pos, table_code = chrom_context
+    code = table_code[np.searchsorted(table_pos, pos)]
+    valid = code != np.iinfo(table_code.dtype).max
+    codebook = context_table[1]
+    if codebook.size == 0:
+        # no C with complete context in the whole genome
+        return np.full(pos.size, ''), valid
+    return codebook[np.where(valid, code, 0)], valid
+
+
+def prepare_allc_reference(reference_fasta, num_upstr_bases=0, num_downstr_bases=2, overwrite=False):
+    """
+    Build the prepared reference and the context table used by ALLC calling.
+
+    Parameters
+    ----------
+    reference_fasta
+        path of reference fasta, need to be indexed by samtools faidx
+    num_upstr_bases
+        number of base before mC, same as callMethylation config
+    num_downstr_bases
+        number of base after mC, same as callMethylation config
+    overwrite
+        whether to rebuild the files if they already exist
+    """
+    prepare_reference(reference_fasta, overwrite=overwrite)
+    prepare_context_table(reference_fasta, num_upstr_bases, num_downstr_bases, overwrite=overwrite)
+    return
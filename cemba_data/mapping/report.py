@@ -0,0 +1,142 @@
+"""
+Structured reports of cutadapt and bismark, each report is parsed once into typed values.
+
+cutadapt write JSON reports (--json, cutadapt >= 3.5), so demultiplex and trimming stats are read
+from the JSON instead of the human readable or minimal report. Bismark only write text reports,
+each one is parsed into a BismarkReport record with int counts and float rates.
+Stats tables in the stats dir are read with their id columns kept as str.
+"""
+
+import json
+import pathlib
+import collections
+import pandas as pd
+
+# JSON adapter types of cutadapt: Type column of the human readable report
+_CUTADAPT_ADAPTER_TYPES = {
+    'regular_five_prime': "regular 5'",
+    'anchored_five_prime': "anchored 5'",
+    'noninternal_five_prime': "non-internal 5'",
+    'regular_three_prime': "regular 3'",
+    'anchored_three_prime': "anchored 3'",
+    'noninternal_three_prime': "non-internal 3'"}
+
+# line start of the bismark report: term
+BISMARK_REPORT_TERMS = {
+    'Sequences analysed in total': 'total_reads',
+    'Number of alignments with a unique best hit from the different alignments': 'unique_map',
+    'Mapping efficiency': 'mapping_rate',
+    'Sequences with no alignments under any condition': 'unmap',
+    'Sequences did not map uniquely': 'ununique_map',
+    'Sequences which were discarded because genomic sequence could not be extracted': 'no_genome',
+    'CT/CT': 'OT', 'CT/GA': 'OB', 'GA/CT': 'CTOT', 'GA/GA': 'CTOB',
+    'Number of alignments to (merely theoretical) complementary strands being rejected in total': 'reject',
+    "Total number of C's analysed": 'total_c',
+    "Total methylated C's in CpG context": 'total_mcg',
+    "Total methylated C's in CHG context": 'total_mchg',
+    "Total methylated C's in CHH context": 'total_mchh',
+    "Total methylated C's in Unknown context": 'total_mcn',
+    "Total unmethylated C's in CpG context": 'total_cg',
+    "Total unmethylated C's in CHG context": 'total_chg',
+    "Total unmethylated C's in CHH context": 'total_chh',
+    "Total unmethylated C's in Unknown context": 'total_cn',
+    'C methylated in CpG context': 'total_mcg_rate',
+    'C methylated in CHG context': 'total_mchg_rate',
+    'C methylated in CHH context': 'total_mchh_rate',
+    'C methylated in Unknown context (CN or CHN)': 'total_mcn_rate'}
+
+# rate terms are percentage, other terms are counts
+_BISMARK_RATE_FIELDS = {'mapping_rate', 'total_mcg_rate', 'total_mchg_rate', 'total_mchh_rate', 'total_mcn_rate'}
+
+# one bismark report, terms not in the report (such as the rate of a context without C) are None
+BismarkReport = collections.namedtuple('BismarkReport',
+                                       ['uid', 'index_name', 'read_type'] + list(BISMARK_REPORT_TERMS.values()),
+                                       defaults=[None] * len(BISMARK_REPORT_TERMS))
+
+# stats tables written by the pipeline, file name in the stats dir is {name}.tsv.gz
+STAT_TABLES = ['preflight_result', 'demultiplex_result', 'fastq_trim_result', 'bismark_result',
+               'bam_process_result', 'allc_total_result', 'allc_profile_result', 'allc_cov_hist_result',
+               'allc_rate_hist_result', 'allc_chrom_result', 'resource_usage']
+# id columns of the stats tables are always str, such as uid 001
+_ID_COLUMNS = {'uid': str, 'index_name': str, 'read_type': str, 'lane': str}
+
+
+def read_cutadapt_json(json_path):
+    """Load a cutadapt --json report"""
+    with open(json_path) as f:
+        return json.load(f)
+
+
+def cutadapt_demultiplex_df(report):
+    """
+    Adapter counts of a paired end demultiplex report, in the same columns as the text report parser:
+    Sequence, Type, Length, Trimmed, TotalPair, Ratio. Only 5' or 3' adapters of R1 are supported.
+    """
+    total_pairs = report['read_counts']['input']
+    records = []
+    for adapter in report['adapters_read1']:
+        end = adapter['five_prime_end'] or adapter['three_prime_end']
+        records.append({'Sequence': end['sequence'],
+                        'Type': _CUTADAPT_ADAPTER_TYPES.get(end['type'], end['type']),
+                        'Length': str(len(end['sequence'])),
+                        'Trimmed': adapter['total_matches']})
+    total_df = pd.DataFrame(records, columns=['Sequence', 'Type', 'Length', 'Trimmed'])
+    total_df['TotalPair'] = total_pairs
+    total_df['Ratio'] = total_df['Trimmed'] / total_pairs
+    return total_df
+
+
+def cutadapt_trim_series(report):
+    """Single end trimming report in the same fields as --report=minimal, filters not used are 0"""
+    read_counts = report['read_counts']
+    bp_counts = report['basepair_counts']
+    filtered = read_counts['filtered']
+    return pd.Series({'status': 'OK',
+                      'in_reads': read_counts['input'],
+                      'in_bp': bp_counts['input'],
+                      'too_short': filtered['too_short'] or 0,
+                      'too_long': filtered['too_long'] or 0,
+                      'too_many_n': filtered['too_many_n'] or 0,
+                      'out_reads': read_counts['output'],
+                      'w/adapters': read_counts['read1_with_adapter'] or 0,
+                      'qualtrim_bp': bp_counts['quality_trimmed'] or 0,
+                      'out_bp': bp_counts['output']})
+
+
+def read_bismark_report(report_path, uid=None, index_name=None, read_type=None):
+    """
+    Parse a bismark SE report into a BismarkReport.
+    uid, index_name and read_type are taken from the file name {uid}_{index_name}_{read_type}.* if not given.
+    """
+    report_path = pathlib.Path(report_path)
+    if uid is None:
+        uid, index_name, read_type = report_path.name.split('.')[0].split('_')
+    values = {}
+    with report_path.open() as rep:
+        for line in rep:
+            start, sep, rest = line.partition(':')
+            if not sep:
+                continue
+            term = BISMARK_REPORT_TERMS.get(start)
+            if term is None:
+                continue
+            value = rest.strip().split('\t')[0]
+            if term in _BISMARK_RATE_FIELDS:
+                values[term] = float(value.rstrip('%'))
+            else:
+                values[term] = int(value)
+    return BismarkReport(uid, index_name, read_type, **values)
+
+
+def bismark_report_df(reports):
+    """Dataframe of BismarkReport, one row per report, terms not in a report are NaN"""
+    report_df = pd.DataFrame(reports, columns=BismarkReport._fields)
+    for term in BISMARK_REPORT_TERMS.values():
+        report_df[term] = report_df[term].astype(float if term in _BISMARK_RATE_FIELDS else 'Int64')
+    return report_df
+
+
+def read_stat_table(path):
+    """Read one stats table, id columns are kept as str"""
+    return pd.read_table(path, dtype=_ID_COLUMNS)
+
@@ -0,0 +1,208 @@
+"""
+Core budget scheduler shared by the mapping stages.
+
+Each job declare how many cores it use (see COMMAND_CORES and get_command_cores),
+the scheduler start pending jobs in submit order as long as the total cores of running jobs
+stay within the budget, a job that does not fit is skipped until cores are released,
+so smaller jobs fill the gaps. Jobs run in threads, most of them are external commands;
+python jobs that need their own process are run in a process pool by submit(..., process=True),
+the pool use forkserver, so it can start while commands are started in other threads.
+A job submitted with after=[futures] wait for those jobs before it become pending, if any of them failed,
+the job fail with the same error without running, so chains of dependent jobs can be submitted up front.
+"""
+
+import os
+import shlex
+import subprocess
+import threading
+import multiprocessing
+import concurrent.futures
+import logging
+from .usage import run
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# cores actually used by one process of each command with its default setting
+COMMAND_CORES = {
+    # cutadapt itself is single threaded, gzip output is compressed by another process
+    'cutadapt': 2,
+    'pigz': 1,
+    # bismark run two bowtie2 (one per strand), each job actually use 250%
+    'bismark': 3,
+}
+
+
+def _set_environ(environ):
+    """Initializer of the process pool workers, use the environment of the scheduler process"""
+    os.environ.clear()
+    os.environ.update(environ)
+    return
+
+
+def get_command_cores(cmd):
+    """
+    Cores used by a command or a pipe of commands, threads given by -j (cutadapt) and -p (pigz)
+    are taken into account. Unknown commands count as 1 core.
+    """
+    total = 0
+    for part in cmd.split('|'):
+        args = shlex.split(part)
+        if len(args) == 0:
+            continue
+        name = os.path.basename(args[0])
+        cores = COMMAND_CORES.get(name, 1)
+        thread_option = {'cutadapt': '-j', 'pigz': '-p'}.get(name)
+        if thread_option is not None and thread_option in args:
+            threads = int(args[args.index(thread_option) + 1])
+            if threads > 0:
+                cores = threads + 1 if name == 'cutadapt' else threads
+        total += cores
+    return total
+
+
+class CoreScheduler:
+    """
+    Run jobs on a fixed core budget.
+
+    Parameters
+    ----------
+    cores
+        total cores of all running jobs
+    """
+
+    def __init__(self, cores):
+        self.cores = max(1, int(cores))
+        self._free = self.cores
+        self._pending = []
+        self._futures = []
+        self._condition = threading.Condition()
+        self._process_executor = None
+
+    def submit(self, fn, *args, cores=1, process=False, after=(), **kwargs):
+        """
+        Submit fn(*args, **kwargs) that use cores, jobs asking for more than the budget use the whole budget.
+        If process is True, fn is run in a separate process, fn and args need to be picklable.
+        If after is given, the job start only after all those futures are done.
+        Return a concurrent.futures.Future.
+        """
+        future = concurrent.futures.Future()
+        cores = min(max(1, int(cores)), self.cores)
+        job = (cores, fn, args, kwargs, process, future)
+        with self._condition:
+            if process and self._process_executor is None:
+                # workers are not forked from this process: a fork while another job thread start a command
+                # inherit the exec pipe of the command, and its Popen wait until the worker exit.
+                # The forkserver may be older than the environment (PATH, usage dir), so it is passed on.
+                self._process_executor = concurrent.futures.ProcessPoolExecutor(
+                    self.cores, mp_context=multiprocessing.get_context('forkserver'),
+                    initializer=_set_environ, initargs=(dict(os.environ),))
+            self._futures.append(future)
+        after = list(after)
+        if len(after) == 0:
+            self._add_pending(job)
+            return future
+
+        remaining = [len(after)]
+        lock = threading.Lock()
+
+        def _after_done(_):
+            # called by the job that finish the dependency, before its cores are released,
+            # so join can not return between the two jobs
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] != 0:
+                    return
+            errors = [f.exception() for f in after if f.exception() is not None]
+            if len(errors) != 0:
+                future.set_exception(errors[0])
+            else:
+                self._add_pending(job)
+            return
+
+        for f in after:
+            f.add_done_callback(_after_done)
+        return future
+
+    def _add_pending(self, job):
+        with self._condition:
+            self._pending.append(job)
+            self._dispatch()
+        return
+
+    def run_cmd(self, cmd, cores=None, shell=False, unit=None):
+        """
+        Submit a command, return a future of the subprocess.CompletedProcess with text stdout and stderr.
+        cores is estimated by get_command_cores if not provided.
+        unit is the (stage, uid, index_name, read_type) of the command in the resource usage, see usage.py.
+        """
+        if cores is None:
+            cores = get_command_cores(cmd)
+        args = cmd if shell else shlex.split(cmd)
+        return self.submit(run, args, cores=cores, unit=unit, shell=shell,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           encoding='utf8', check=True)
+
+    def _dispatch(self):
+        """Start every pending job that fit the free cores, called with the condition held"""
+        i = 0
+        while i < len(self._pending):
+            cores = self._pending[i][0]
+            if cores <= self._free:
+                job = self._pending.pop(i)
+                self._free -= cores
+                threading.Thread(target=self._run, args=job, daemon=True).start()
+            else:
+                i += 1
+        return
+
+    def _run(self, cores, fn, args, kwargs, process, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    if process:
+                        result = self._process_executor.submit(fn, *args, **kwargs).result()
+                    else:
+                        result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            with self._condition:
+                self._free += cores
+                self._dispatch()
+                self._condition.notify_all()
+        return
+
+    def join(self):
+        """Wait for all submitted jobs, raise the first error if any job failed"""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._pending) == 0 and self._free == self.cores)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        return
+
+    def shutdown(self):
+        self.join()
+        if self._process_executor is not None:
+            self._process_executor.shutdown()
+            self._process_executor = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def get_scheduler(config):
+    """Scheduler of the core budget in [scheduler] config, use all cpu of the node if not set"""
+    if config.has_section('scheduler') and 'cores' in config['scheduler']:
+        cores = int(config['scheduler']['cores'])
+    else:
+        cores = os.cpu_count()
+    return CoreScheduler(cores)
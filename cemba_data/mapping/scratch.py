@@ -0,0 +1,93 @@
+"""
+Node local scratch dir for the intermediate files of the mapping pipeline.
+
+With [scheduler] scratch_dir, lane fastq, trimmed fastq, bismark output and the sort, dedup and filter bams
+of a run are written in the work dir {scratch_dir}/{out_dir name}.{hash of out_dir path} instead of out_dir,
+which is usually on a shared file system. Only the final outputs of each cell (final bam and ALLC)
+are moved to out_dir, stats are always written in out_dir/stats.
+A rerun on the same node reuse the work dir. The work dir has a uniquely named marker file,
+which is recorded in the manifest with the stages whose output stay in the work dir,
+if the work dir is lost (another node, tmpfs cleared), those stages run again.
+"""
+
+import uuid
+import hashlib
+import pathlib
+import shutil
+import logging
+from .allc import _get_allc_path
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def get_work_dir(out_dir, config):
+    """
+    Work dir of the intermediate files
+
+    Returns
+    -------
+    work_dir
+        out_dir if scratch_dir is not set
+    marker
+        marker file of the scratch work dir, None if scratch_dir is not set
+    """
+    out_dir = pathlib.Path(out_dir).absolute()
+    scratch_dir = config.get('scheduler', 'scratch_dir', fallback='').strip()
+    if scratch_dir == '':
+        return out_dir, None
+    out_dir_hash = hashlib.md5(str(out_dir).encode()).hexdigest()[:8]
+    work_dir = pathlib.Path(scratch_dir).absolute() / f'{out_dir.name}.{out_dir_hash}'
+    work_dir.mkdir(parents=True, exist_ok=True)
+    # the marker has a new name each time the work dir is created, so a manifest record of a lost work dir
+    # does not match the marker of the new one
+    markers = sorted(work_dir.glob('scratch_work_dir.*.txt'))
+    if markers:
+        marker = markers[0]
+    else:
+        marker = work_dir / f'scratch_work_dir.{uuid.uuid4().hex[:12]}.txt'
+        marker.write_text(f'{out_dir}\n')
+    log.info(f'Intermediate files are written in {work_dir}')
+    return work_dir, marker
+
+
+def get_min_free(config):
+    """Free space (bytes) kept in the scratch dir, 0 if scratch_dir is not set"""
+    if config.get('scheduler', 'scratch_dir', fallback='').strip() == '':
+        return 0
+    return int(float(config.get('scheduler', 'scratch_min_free', fallback='20')) * 1024 ** 3)
+
+
+def check_free_space(work_dir, min_free):
+    """
+    Warn if the work dir has less than min_free bytes, called before each stage without the cell DAG,
+    which can not throttle the cells of a stage.
+    """
+    free = shutil.disk_usage(work_dir).free
+    if free < min_free:
+        log.warning(f'Only {free / 1024 ** 3:.1f} GB free in {work_dir}, '
+                    f'the intermediate files of a whole stage may not fit.')
+    return free
+
+
+def move_cell_outputs(work_dir, out_dir, uid, index_name):
+    """Move the final bam and ALLC (and their index) of a cell from the work dir to out_dir"""
+    work_dir = pathlib.Path(work_dir)
+    out_dir = pathlib.Path(out_dir)
+    if work_dir.absolute() == out_dir.absolute():
+        return
+    final_bam_path = str(work_dir / f'{uid}_{index_name}.final.bam')
+    allc_path = _get_allc_path(final_bam_path)
+    for path in [final_bam_path, final_bam_path + '.bai', allc_path, allc_path + '.idx', allc_path + '.tbi']:
+        path = pathlib.Path(path)
+        if path.exists():
+            shutil.move(str(path), str(out_dir / path.name))
+    return
+
+
+def remove_work_dir(work_dir, out_dir):
+    """Remove the scratch work dir after the run finished, the leftovers are intermediate files"""
+    if pathlib.Path(work_dir).absolute() != pathlib.Path(out_dir).absolute():
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return
@@ -0,0 +1,145 @@
+"""
+Consolidated stats tables of all pipeline runs under a project dir, kept in one HDF5 store.
+
+The store {out_dir}/stats/summary_stats.h5 has one table per stats table name with the rows of all runs,
+the run column is the path of the run dir relative to out_dir. The size and mtime of every stats file read
+are kept in the store too, so update_stats_store only read the stats files that are new or changed
+and drop the runs that are gone, instead of reading the stats of every run on each summary.
+"""
+
+import os
+import pathlib
+import logging
+import pandas as pd
+from .report import STAT_TABLES, read_stat_table
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+STORE_NAME = 'summary_stats.h5'
+# table of the stats files read into the store: run, table, size, mtime
+_FILES_KEY = 'stat_files'
+_FILES_COLUMNS = ['run', 'table', 'size', 'mtime']
+
+
+def scan_out_dir(out_dir):
+    """
+    Walk out_dir once for the stats dirs, ALLC and final bam files of all runs
+
+    Returns
+    -------
+    stat_dirs
+        list of stats dirs
+    allc_paths
+        dict of (uid, index_name): ALLC path
+    bam_paths
+        dict of (uid, index_name): final bam path
+    """
+    out_dir = pathlib.Path(out_dir)
+    stat_dirs = []
+    allc_paths = {}
+    bam_paths = {}
+    for root, dirs, files in os.walk(out_dir):
+        root = pathlib.Path(root)
+        if root.name == 'stats':
+            stat_dirs.append(root)
+            # no run output in the stats dir
+            dirs[:] = []
+            continue
+        for name in files:
+            if name.startswith('allc_') and name.endswith('.tsv.gz'):
+                uid, index_name = name.split('.')[0][len('allc_'):].rsplit('_', 1)
+                allc_paths[(uid, index_name)] = str(root / name)
+            elif name.endswith('.final.bam'):
+                uid, index_name = name.split('.')[0].rsplit('_', 1)
+                bam_paths[(uid, index_name)] = str(root / name)
+    return stat_dirs, allc_paths, bam_paths
+
+
+def _stat_files(out_dir, stat_dirs):
+    records = []
+    for stat_dir in stat_dirs:
+        run = str(stat_dir.parent.relative_to(out_dir))
+        for name in STAT_TABLES:
+            try:
+                stat = (stat_dir / f'{name}.tsv.gz').stat()
+            except FileNotFoundError:
+                continue
+            records.append((run, name, stat.st_size, stat.st_mtime_ns))
+    return pd.DataFrame(records, columns=_FILES_COLUMNS)
+
+
+def _to_store(df):
+    # id columns repeat in every row, stored as categorical they are decoded once per value when read back
+    str_columns = df.select_dtypes(include=['object', 'string']).columns
+    return df.astype({column: 'category' for column in str_columns})
+
+
+def _from_store(df):
+    category_columns = df.select_dtypes(include='category').columns
+    return df.astype({column: 'str' for column in category_columns})
+
+
+def update_stats_store(out_dir, stat_dirs=None):
+    """
+    Update the stats store of out_dir with the new or changed runs
+
+    Parameters
+    ----------
+    out_dir
+        project dir of the runs
+    stat_dirs
+        stats dirs of the runs, default is all stats dirs in out_dir
+
+    Returns
+    -------
+    dict of table name: dataframe of all runs, tables no run has are skipped
+    """
+    out_dir = pathlib.Path(out_dir)
+    if stat_dirs is None:
+        stat_dirs, _, _ = scan_out_dir(out_dir)
+    store_dir = out_dir / 'stats'
+    store_dir.mkdir(exist_ok=True)
+    files_df = _stat_files(out_dir, stat_dirs)
+
+    tables = {}
+    with pd.HDFStore(str(store_dir / STORE_NAME), mode='a') as store:
+        if _FILES_KEY in store:
+            stored_files_df = store[_FILES_KEY]
+        else:
+            stored_files_df = pd.DataFrame(columns=_FILES_COLUMNS)
+        # rows in only one of the file tables are new, changed or removed stats files
+        diff_files = pd.concat([stored_files_df, files_df], ignore_index=True) \
+            .astype({'size': 'int64', 'mtime': 'int64'}) \
+            .drop_duplicates(keep=False)
+        # table name: runs to update
+        changed_runs = diff_files.groupby('table')['run'].agg(set).to_dict()
+        current_files = set(zip(files_df['run'], files_df['table']))
+        log.info(f'{diff_files["run"].nunique()} new or changed runs, '
+                 f'{files_df["run"].nunique()} runs in total.')
+
+        for name in STAT_TABLES:
+            runs = changed_runs.get(name, set())
+            if name in store:
+                stored_df = _from_store(store[name])
+                if not runs:
+                    tables[name] = stored_df
+                    continue
+                dfs = [stored_df[~stored_df['run'].isin(runs)]]
+            else:
+                dfs = []
+            for run in sorted(runs):
+                if (run, name) in current_files:
+                    df = read_stat_table(out_dir / run / 'stats' / f'{name}.tsv.gz')
+                    df['run'] = run
+                    dfs.append(df)
+            dfs = [df for df in dfs if df.shape[0] > 0]
+            if len(dfs) == 0:
+                if name in store:
+                    store.remove(name)
+                continue
+            tables[name] = pd.concat(dfs, ignore_index=True, sort=True)
+            store.put(name, _to_store(tables[name]), format='table', index=False)
+        store.put(_FILES_KEY, files_df)
+    return tables
@@ -0,0 +1,227 @@
+"""
+Resource usage of the external commands run by the mapping stages.
+
+Commands are run by run() or watched by ProcessUsage instead of using subprocess directly.
+For each command the wall time, CPU time (user + system of the command and all its child processes),
+peak RSS (sum of the process tree, sampled by psutil every SAMPLE_INTERVAL seconds) and bytes read and written
+on storage are recorded with the unit of the command, (stage, uid, index_name, read_type) set by usage_unit,
+unused ids are empty.
+Python code of the builtin engines is not a command, it is not recorded.
+
+Nothing is recorded until start_usage_log is called. Records are appended to {usage_dir}/{pid}.jsonl
+of the python process running the command. The usage dir is passed by an environment variable,
+so commands run by the worker processes of the stages are recorded too. read_usage merge all records.
+"""
+
+import os
+import json
+import time
+import pathlib
+import threading
+import subprocess
+import contextlib
+import contextvars
+import logging
+import psutil
+import pandas as pd
+
+# logger
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# usage dir of the running pipeline, inherited by the worker processes
+USAGE_DIR_ENV = 'CEMBA_DATA_USAGE_DIR'
+# seconds between two samples of the process tree
+SAMPLE_INTERVAL = 0.5
+
+USAGE_COLUMNS = ['stage', 'uid', 'index_name', 'read_type', 'command', 'returncode', 'start_time',
+                 'wall_time', 'cpu_time', 'peak_rss', 'read_bytes', 'write_bytes']
+
+# (stage, uid, index_name, read_type) of the commands run in the current thread
+_unit = contextvars.ContextVar('usage_unit', default=(None, None, None, None))
+_write_lock = threading.Lock()
+
+
+def start_usage_log(usage_dir):
+    """Record commands of this process and the worker processes started after this call into usage_dir"""
+    usage_dir = pathlib.Path(usage_dir).absolute()
+    usage_dir.mkdir(parents=True, exist_ok=True)
+    os.environ[USAGE_DIR_ENV] = str(usage_dir)
+    return
+
+
+def stop_usage_log():
+    os.environ.pop(USAGE_DIR_ENV, None)
+    return
+
+
+@contextlib.contextmanager
+def usage_unit(stage, uid=None, index_name=None, read_type=None):
+    """Commands run in this context are recorded under (stage, uid, index_name, read_type)"""
+    token = _unit.set((stage, uid, index_name, read_type))
+    try:
+        yield
+    finally:
+        _unit.reset(token)
+
+
+def run_in_unit(unit, fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) in usage_unit(*unit), used to submit jobs to the worker pools"""
+    with usage_unit(*unit):
+        return fn(*args, **kwargs)
+
+
+class ProcessUsage:
+    """
+    Watch a started subprocess.Popen, call wait() instead of proc.wait() to record its usage.
+    wait() reap the process by os.wait4, which also give the CPU time of the child processes it waited for.
+
+    Parameters
+    ----------
+    proc
+        the started subprocess.Popen
+    unit
+        (stage, uid, index_name, read_type) of the command, default is the current usage_unit
+    """
+
+    def __init__(self, proc, unit=None):
+        self.proc = proc
+        self.unit = _unit.get() if unit is None else tuple(unit) + (None,) * (4 - len(unit))
+        self.usage_dir = os.environ.get(USAGE_DIR_ENV)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.peak_rss = 0
+        # pid: (read_bytes, write_bytes) of the last sample
+        self._io = {}
+        self._stop = threading.Event()
+        self._sampler = None
+        if self.usage_dir is not None:
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        try:
+            root = psutil.Process(self.proc.pid)
+            procs = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    io = proc.io_counters()
+            except (psutil.Error, AttributeError):
+                # exited, or no io counters on this platform
+                continue
+            self._io[proc.pid] = (io.read_bytes, io.write_bytes)
+        self.peak_rss = max(self.peak_rss, rss)
+        return
+
+    def _sample_loop(self):
+        while True:
+            self._sample()
+            if self._stop.wait(SAMPLE_INTERVAL):
+                return
+
+    def wait(self):
+        """Wait for the process like Popen.wait, record its usage and return the returncode"""
+        if self._sampler is None:
+            return self.proc.wait()
+        rusage = None
+        if self.proc.returncode is None:
+            _, status, rusage = os.wait4(self.proc.pid, 0)
+            self.proc.returncode = os.waitstatus_to_exitcode(status)
+        wall_time = time.perf_counter() - self._start
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+        read_bytes = sum(read for read, _ in self._io.values())
+        write_bytes = sum(write for _, write in self._io.values())
+        cpu_time = None
+        if rusage is not None:
+            # rusage is exact for the process and its waited children, samples may miss short processes.
+            # ru_maxrss is not used, it count the memory of this python process copied by the fork
+            cpu_time = rusage.ru_utime + rusage.ru_stime
+            read_bytes = max(read_bytes, rusage.ru_inblock * 512)
+            write_bytes = max(write_bytes, rusage.ru_oublock * 512)
+        args = self.proc.args
+        command = args if isinstance(args, str) else ' '.join(str(arg) for arg in args)
+        stage, uid, index_name, read_type = self.unit
+        _write_record(self.usage_dir, {'stage': stage, 'uid': uid, 'index_name': index_name,
+                                       'read_type': read_type, 'command': command,
+                                       'returncode': self.proc.returncode, 'start_time': self.start_time,
+                                       'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_rss': self.peak_rss,
+                                       'read_bytes': read_bytes, 'write_bytes': write_bytes})
+        return self.proc.returncode
+
+
+def _write_record(usage_dir, record):
+    line = json.dumps(record) + '\n'
+    with _write_lock:
+        with open(pathlib.Path(usage_dir) / f'{os.getpid()}.jsonl', 'a') as f:
+            f.write(line)
+    return
+
+
+def _communicate(proc, input=None):
+    """Read stdout and stderr in threads until EOF, so the process is not reaped by Popen.communicate"""
+    outputs = {}
+
+    def _read(name, pipe):
+        outputs[name] = pipe.read()
+        pipe.close()
+
+    threads = [threading.Thread(target=_read, args=(name, pipe), daemon=True)
+               for name, pipe in [('stdout', proc.stdout), ('stderr', proc.stderr)] if pipe is not None]
+    for thread in threads:
+        thread.start()
+    if proc.stdin is not None:
+        try:
+            if input is not None:
+                proc.stdin.write(input)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    for thread in threads:
+        thread.join()
+    return outputs.get('stdout'), outputs.get('stderr')
+
+
+def run(args, unit=None, input=None, check=False, **kwargs):
+    """
+    subprocess.run that record the usage of the command, see ProcessUsage for unit.
+    Only input, check and the Popen arguments (stdout, stderr, shell, encoding...) are supported.
+    """
+    if os.environ.get(USAGE_DIR_ENV) is None:
+        return subprocess.run(args, input=input, check=check, **kwargs)
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    with subprocess.Popen(args, **kwargs) as proc:
+        usage = ProcessUsage(proc, unit)
+        stdout, stderr = _communicate(proc, input)
+        returncode = usage.wait()
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+
+def read_usage(usage_dir):
+    """
+    Read the usage records in usage_dir
+
+    Returns
+    -------
+    dataframe of USAGE_COLUMNS, one row per command, in start time order
+    """
+    records = []
+    for path in sorted(pathlib.Path(usage_dir).glob('*.jsonl')):
+        with path.open() as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    log.warning(f'Skip broken line in {path}')
+    usage_df = pd.DataFrame(records, columns=USAGE_COLUMNS)
+    return usage_df.sort_values('start_time').reset_index(drop=True)
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of the batched mpileup read bases decoder (allc._count_read_bases)
+against the per character decoder it replaced (_legacy_count_read_bases in test_mapping.py).
+
+Run it on the mpileup text of a real cell, made the same way as the mpileup engine:
+    samtools mpileup -Q 1 -q 0 -B -f genome.fa cell.final.bam > cell.mpileup
+    python cemba_data/test/benchmark_count_read_bases.py cell.mpileup
+
+Only the C/G lines are decoded, same as the engine. Both decoders are checked to give the same counts.
+"""
+
+import re
+import sys
+import gzip
+import time
+import argparse
+import pathlib
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+from cemba_data.mapping.allc import _count_read_bases, _DECODE_BATCH_LINES
+from test_mapping import _legacy_count_read_bases
+
+
+def read_mpileup_bases(mpileup_path, max_lines=None):
+    """Read bases column (5th) of the C/G lines of a mpileup file, gzip is fine"""
+    open_fn = gzip.open if mpileup_path.endswith('.gz') else open
+    read_bases_list = []
+    with open_fn(mpileup_path, 'rt') as f:
+        for line in f:
+            fields = line.split('\t')
+            if fields[2].upper() not in ('C', 'G'):
+                continue
+            read_bases_list.append(fields[4])
+            if max_lines is not None and len(read_bases_list) >= max_lines:
+                break
+    return read_bases_list
+
+
+def _best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchmark(read_bases_list, batch_lines=_DECODE_BATCH_LINES, repeat=3):
+    """
+    Time both decoders on read_bases_list, the batched one in batches of batch_lines like the engine.
+    Return (legacy seconds, batched seconds), the best of repeat runs.
+    """
+    def legacy():
+        return np.array([_legacy_count_read_bases(read_bases) for read_bases in read_bases_list]).reshape(-1, 4)
+
+    def batched():
+        return np.concatenate([_count_read_bases(read_bases_list[i:i + batch_lines])
+                               for i in range(0, len(read_bases_list), batch_lines)] or [np.zeros((0, 4))])
+
+    legacy_time, legacy_counts = _best_time(legacy, repeat)
+    batched_time, batched_counts = _best_time(batched, repeat)
+    # the legacy decoder counted the mapping quality after "^" as a base, compare on stripped text
+    expect = np.array([_legacy_count_read_bases(re.sub(r'\^.', '', read_bases))
+                       for read_bases in read_bases_list]).reshape(-1, 4)
+    if not (batched_counts == expect).all():
+        raise ValueError('Batched decoder counts differ from the legacy decoder.')
+    n_start_marker = int((legacy_counts != expect).any(axis=1).sum())
+    return legacy_time, batched_time, n_start_marker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mpileup', help='samtools mpileup output, can be gzip')
+    parser.add_argument('--max_lines', type=int, default=None, help='only use the first C/G lines')
+    parser.add_argument('--batch_lines', type=int, default=_DECODE_BATCH_LINES,
+                        help='lines decoded together by the batched decoder')
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many runs')
+    args = parser.parse_args()
+
+    read_bases_list = read_mpileup_bases(args.mpileup, args.max_lines)
+    n_bases = sum(map(len, read_bases_list))
+    legacy_time, batched_time, n_start_marker = benchmark(read_bases_list, args.batch_lines, args.repeat)
+    print(f'{len(read_bases_list)} C/G lines, {n_bases} read bases characters, '
+          f'{n_start_marker} lines counted differently by the legacy decoder (read start markers)')
+    for name, seconds in [('legacy', legacy_time), ('batched', batched_time)]:
+        print(f'{name:>8}: {seconds:.3f} s, {len(read_bases_list) / max(seconds, 1e-9):,.0f} lines/s')
+    print(f' speedup: {legacy_time / max(batched_time, 1e-9):.1f}x')
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -5,37 +5,1127 @@ Mapping related functions from FASTQ to ALLC, together with the mapping statisti
 Testing related files should exist in ./_data/mapping
 """
 
-from cemba_data.mapping.fastq import demultiplex, fastq_qc
-from cemba_data.mapping.bam import bam_qc
-from cemba_data.mapping.bismark import bismark
-from cemba_data.mapping.allc import call_methylated_sites
+from cemba_data.mapping.fastq import demultiplex, fastq_qc, demultiplex_trim, _make_index_lookup_table, \
+    _sample_lane_index, _preflight_exclude, _iter_fastq_records
+from cemba_data.mapping.bam import bam_qc, bam_to_allc, _dedup_reads, _bismark_bam_path, _iter_filtered_reads, \
+    _bam_to_allc_worker, _stream_cmds, _bismark_report_path, _run_pipe, _process_bam, _sort_cmd, \
+    _sort_dedup_filter_cmds, _builtin_process_bam
+from cemba_data.mapping.bismark import bismark, _parse_bismark_report, _merge_bismark_report, \
+    _write_bismark_batch, _split_bismark_batch
+from cemba_data.mapping import allc
+from cemba_data.mapping.allc import call_methylated_sites, _count_read_bases, _call_methylated_sites_worker, \
+    _call_methylated_sites_pysam_worker, _stitch_allc_shards, _get_chromosome_sequence
+from cemba_data.mapping.report import cutadapt_demultiplex_df
+from cemba_data.mapping.checkpoint import Manifest
+from cemba_data.mapping.scratch import get_work_dir, get_min_free, check_free_space, move_cell_outputs, \
+    remove_work_dir
+from cemba_data.mapping import usage
+from cemba_data.mapping.stats_store import scan_out_dir, update_stats_store
 from cemba_data.mapping.pipeline import pipeline, validate_fastq_dataframe, summary_pipeline_stat
+from cemba_data.mapping import reference
+from cemba_data.mapping.reference import get_site_contexts, prepare_reference, read_prepared_reference, \
+    get_chromosome_array, _read_faidx, prepare_context_table, read_context_table, get_chromosome_context, \
+    lookup_site_contexts
+from cemba_data.mapping.allc_stats import SiteStats, SITE_STATS_TABLES
+from cemba_data.mapping.scheduler import CoreScheduler, get_command_cores
+from cemba_data.mapping.dag import CellDAG, run_cell_dag
+import re
+import os
+import sys
+import subprocess
+import pathlib
+import shutil
+import collections
+import gzip
+import time
+import configparser
+import threading
+import logging
+import pytest
+import numpy as np
+import pandas as pd
 
 
-def test_demultiplex():
-    return
+def _write_fastq(path, records):
+    with gzip.open(path, 'wt') as f:
+        for name, seq in records:
+            f.write(f'@{name}\n{seq}\n+\n{"I" * len(seq)}\n')
+    return str(path)
+
+
+def test_demultiplex(tmp_path):
+    # index prefix of R1, R2 start with the read name so pairs can be checked
+    r1_prefixes = [('exact', 'CGATGT'), ('mismatch', 'CGATGA'), ('ambiguous', 'ATCACC'), ('unknown', 'TTTTTT'),
+                   ('ad001', 'ATCACG'), ('excluded', 'ATCAGC'), ('n_base', 'NGATGT')]
+    r1_in = _write_fastq(tmp_path / 'L1_R1.fq.gz', [(name, prefix + 'ACGTTGCA') for name, prefix in r1_prefixes])
+    r2_in = _write_fastq(tmp_path / 'L1_R2.fq.gz', [(name, 'GGCCAATT' + name.upper()[:2])
+                                                    for name, _ in r1_prefixes])
+    fastq_df = pd.DataFrame({'uid': ['u', 'u'], 'lane': ['L1', 'L1'], 'read_type': ['R1', 'R2'],
+                             'fastq_path': [r1_in, r2_in]})
+    config = configparser.ConfigParser()
+    config.read_dict({'multiplexIndex': {'ad001': 'ATCACG', 'ad002': 'CGATGT', 'ad003': 'ATCAGC'},
+                      'demultiplex': {'overlap': '6', 'anchor': 'True', 'adapter_pos': '5', 'engine': 'builtin',
+                                      'max_mismatch': '1'}})
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    result_df = demultiplex(fastq_df, out_dir, config, CoreScheduler(2), exclude_cells={('u', 'ad003')})
+
+    # same columns as the cutadapt engine
+    report = {'read_counts': {'input': 7},
+              'adapters_read1': [{'name': 'ad001', 'total_matches': 1, 'three_prime_end': None,
+                                  'five_prime_end': {'type': 'noninternal_five_prime', 'sequence': 'ATCACG'}}]}
+    assert result_df.columns.tolist() == cutadapt_demultiplex_df(report).columns.tolist() + \
+        ['lane', 'uid', 'index_name']
+    assert result_df['index_name'].tolist() == ['ad001', 'ad002', 'ad003']
+    assert result_df['Type'].tolist() == ["non-internal 5'"] * 3
+    assert result_df['Length'].tolist() == ['6'] * 3
+    assert result_df['Trimmed'].tolist() == [1, 3, 1]
+    assert result_df['TotalPair'].tolist() == [7] * 3
+
+    def read_fastq(name, read_type):
+        with gzip.open(out_dir / f'u_L1_{name}_{read_type}.fq.gz', 'rt') as f:
+            lines = f.read().split('\n')
+        return [(lines[i][1:], lines[i + 1], lines[i + 3]) for i in range(0, len(lines) - 1, 4)]
+
+    # exact, 1 mismatch and N in the index, R1 is trimmed and R2 is untouched
+    assert read_fastq('ad002', 'R1') == [(name, 'ACGTTGCA', 'I' * 8) for name in ['exact', 'mismatch', 'n_base']]
+    assert read_fastq('ad002', 'R2') == [(name, 'GGCCAATT' + name.upper()[:2], 'I' * 10)
+                                         for name in ['exact', 'mismatch', 'n_base']]
+    assert read_fastq('ad001', 'R1') == [('ad001', 'ACGTTGCA', 'I' * 8)]
+    # one mismatch to both ad001 and ad003 is unknown, unknown reads are not trimmed
+    assert read_fastq('unknown', 'R1') == [('ambiguous', 'ATCACCACGTTGCA', 'I' * 14),
+                                           ('unknown', 'TTTTTTACGTTGCA', 'I' * 14)]
+    assert [name for name, _, _ in read_fastq('unknown', 'R2')] == ['ambiguous', 'unknown']
+    # excluded cells are counted, but not written
+    assert not (out_dir / 'u_L1_ad003_R1.fq.gz').exists()
+
+
+# stand-in for the trimming cutadapt, cut -u bases, drop reads shorter than -m and write the JSON report.
+# Every run is logged into trim.log next to the script.
+_STUB_CUTADAPT = """
+import sys, gzip, json, pathlib
+args = sys.argv[1:]
+out_path, json_path = args[args.index('-o') + 1], args[args.index('--json') + 1]
+left_cut = int(args[args.index('-u') + 1])
+min_length = int(args[args.index('-m') + 1])
+with open(pathlib.Path(__file__).parent / 'trim.log', 'a') as log:
+    log.write(pathlib.Path(out_path).name + '\\n')
+lines = sys.stdin.buffer.read().split(b'\\n')
+in_reads = out_reads = in_bp = out_bp = too_short = 0
+with gzip.open(out_path, 'wb') as out:
+    for i in range(0, len(lines) - 1, 4):
+        name, seq, plus, qual = lines[i:i + 4]
+        in_reads += 1
+        in_bp += len(seq)
+        seq, qual = seq[left_cut:], qual[left_cut:]
+        if len(seq) < min_length:
+            too_short += 1
+            continue
+        out_reads += 1
+        out_bp += len(seq)
+        out.write(b'\\n'.join([name, seq, plus, qual]) + b'\\n')
+report = {'read_counts': {'input': in_reads, 'output': out_reads, 'read1_with_adapter': 0,
+                          'filtered': {'too_short': too_short, 'too_long': None, 'too_many_n': None}},
+          'basepair_counts': {'input': in_bp, 'output': out_bp, 'quality_trimmed': 0}}
+with open(json_path, 'w') as f:
+    json.dump(report, f)
+"""
+# stand-in for pigz -cd -p N files
+_STUB_PIGZ = """
+import sys, gzip
+for path in [arg for arg in sys.argv[1:] if not arg.startswith('-') and not arg.isdigit()]:
+    with gzip.open(path, 'rb') as f:
+        sys.stdout.buffer.write(f.read())
+"""
+
+
+def _stub_commands(tmp_path, monkeypatch, commands):
+    """Write python scripts named as the commands into a bin dir in front of PATH, return the bin dir"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir(exist_ok=True)
+    for name, code in commands.items():
+        path = bin_dir / name
+        path.write_text(f'#!{sys.executable}\n{code}')
+        path.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}:{os.environ["PATH"]}')
+    return bin_dir
+
+
+def test_demultiplex_trim(tmp_path, monkeypatch):
+    bin_dir = _stub_commands(tmp_path, monkeypatch, {'cutadapt': _STUB_CUTADAPT, 'pigz': _STUB_PIGZ})
+    fastq_paths = []
+    for lane, n_pairs in [('L1', 6), ('L2', 5)]:
+        # ad001 above total_reads_threshold, ad002 below it, a few unknown
+        prefixes = (['ATCACG', 'ATCACG', 'CGATGT', 'TTTTTT'] * n_pairs)[:n_pairs * 2]
+        for read_type in ['R1', 'R2']:
+            records = [(f'{lane}_{i}', (prefix if read_type == 'R1' else '') + 'ACGTTGCAAC'[:4 + i % 6])
+                       for i, prefix in enumerate(prefixes)]
+            fastq_paths.append(_write_fastq(tmp_path / f'{lane}_{read_type}.fq.gz', records))
+    fastq_df = pd.DataFrame({'uid': ['u'] * 4, 'lane': ['L1', 'L1', 'L2', 'L2'], 'read_type': ['R1', 'R2'] * 2,
+                             'fastq_path': fastq_paths})
+    config = configparser.ConfigParser()
+    config.read_dict({'multiplexIndex': {'ad001': 'ATCACG', 'ad002': 'CGATGT'},
+                      'demultiplex': {'overlap': '6', 'anchor': 'True', 'adapter_pos': '5', 'engine': 'builtin'},
+                      'fastqTrim': {'r1_adapter': 'AGATCGGAAGAGCAC', 'r2_adapter': 'AGATCGGAAGAGCGT',
+                                    'length_threshold': '5', 'quality_threshold': '20', 'overlap': '6',
+                                    'r1_left_cut': '1', 'r1_right_cut': '0', 'r2_left_cut': '1',
+                                    'r2_right_cut': '0', 'total_reads_threshold': '6', 'pigz_cores': '1',
+                                    'cutadapt_cores': '1'}})
+
+    # demultiplex into lane fastq, then fastq_qc
+    stage_dir = tmp_path / 'stage'
+    stage_dir.mkdir()
+    demultiplex_df = demultiplex(fastq_df.copy(), stage_dir, config, CoreScheduler(2))
+    fastq_final_df = fastq_qc(demultiplex_df, stage_dir, config, CoreScheduler(2))
+    (bin_dir / 'trim.log').unlink()
+
+    stream_dir = tmp_path / 'stream'
+    stream_dir.mkdir()
+    stream_demultiplex_df, stream_fastq_final_df = demultiplex_trim(fastq_df.copy(), stream_dir, config,
+                                                                    CoreScheduler(4))
+    assert stream_demultiplex_df.equals(demultiplex_df)
+    assert stream_fastq_final_df.columns.tolist() == fastq_final_df.columns.tolist()
+    assert stream_fastq_final_df.equals(fastq_final_df)
+    assert fastq_final_df['index_name'].tolist() == ['ad001', 'ad001']
+    print(fastq_final_df.T)
+    assert fastq_final_df['too_short'].tolist() == [4, 4]
+    for read_type in ['R1', 'R2']:
+        name = f'u_ad001_{read_type}.trimed.fq.gz'
+        with gzip.open(stage_dir / name) as f, gzip.open(stream_dir / name) as stream_f:
+            assert f.read() == stream_f.read()
+    # ad002 has 2 pairs, its cutadapt never start
+    assert sorted((bin_dir / 'trim.log').read_text().split()) == ['u_ad001_R1.trimed.fq.gz',
+                                                                  'u_ad001_R2.trimed.fq.gz']
+    assert sorted(p.name for p in stream_dir.iterdir()) == ['u_ad001_R1.trimed.fq.gz', 'u_ad001_R2.trimed.fq.gz']
+
+
+def test_make_index_lookup_table():
+    index_dict = {'ad001': 'ATCACG', 'ad002': 'CGATGT', 'ad003': 'ATCACC'}
+    table, index_length = _make_index_lookup_table(index_dict, 0)
+    assert index_length == 6
+    assert table[b'CGATGT'] == 'ad002'
+    assert b'CGATGA' not in table
+    table, _ = _make_index_lookup_table(index_dict, 1)
+    assert table[b'CGATGA'] == 'ad002'
+    assert table[b'NGATGT'] == 'ad002'
+    # one mismatch to both ad001 and ad003
+    assert b'ATCACA' not in table
+
+
+def test_preflight(tmp_path):
+    index_dict = {'ad001': 'ATCACG', 'ad002': 'CGATGT'}
+    table, index_length = _make_index_lookup_table(index_dict, 0)
+    fastq_path = tmp_path / 'L1_R1.fq.gz'
+    with gzip.open(fastq_path, 'wb') as f:
+        for i, prefix in enumerate(['ATCACG'] * 30 + ['CGATGT'] * 10 + ['TTTTTT'] * 5):
+            f.write(f'@r{i}\n{prefix}ACGTACGT\n+\nIIIIIIIIIIIIII\n'.encode())
+    counts, fraction = _sample_lane_index(fastq_path, table, index_length, 5, 1000)
+    assert counts == {'ad001': 30, 'ad002': 10, 'unknown': 5}
+    assert fraction == 1
+    counts, fraction = _sample_lane_index(fastq_path, table, index_length, 5, 20)
+    assert counts == {'ad001': 20}
+    assert 0 < fraction < 1
+
+    config = configparser.ConfigParser()
+    config.read_dict({'fastqTrim': {'total_reads_threshold': '100'},
+                      'bismark': {'read_min': '400', 'read_max': '1000'}})
+    cell_pairs = pd.Series({('u', 'ad001'): 60, ('u', 'ad002'): 150, ('u', 'ad003'): 300, ('u', 'ad004'): 1100})
+    assert _preflight_exclude(cell_pairs, config, 0.5) == {('u', 'ad001'): 'read_min', ('u', 'ad004'): 'read_max'}
+    assert _preflight_exclude(cell_pairs, config, 1, check_max=False) == \
+        {('u', 'ad001'): 'total_reads_threshold', ('u', 'ad002'): 'read_min'}
 
 
 def test_fastq_qc():
     return
 
 
-def test_bam_qc():
-    return
+def test_bam_qc(tmp_path):
+    import pysam
+    if shutil.which('samtools') is None:
+        pytest.skip('samtools is not installed')
+    chroms = [('chr1', 'ATCGACCGTTACGCAGGTCGAACCGTAG')]
+    reads = {'R1': [('a1', 0, 10, 'TACGCAGG', [(0, 8)], 0, 60, None),
+                    ('a2', 0, 1, 'TCGACCGT', [(0, 8)], 0, 60, None),
+                    # duplicate of a2 with lower base qualities
+                    ('a2d', 0, 1, 'TCGACCGT', [(0, 8)], 0, 60, [20] * 8)],
+             'R2': [('b1', 0, 3, 'GACCGTTA', [(0, 8)], 16, 60, None),
+                    # MAPQ below the threshold
+                    ('b2', 0, 5, 'CCGTTACG', [(0, 8)], 0, 5, None)]}
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    for index_name in ['A1', 'B1']:
+        for read_type in ['R1', 'R2']:
+            bismark_bam = _bismark_bam_path(out_dir, 'uid', index_name, read_type)
+            _write_test_bam(tmp_path, chroms, reads[read_type], bam_name=bismark_bam, sort=False)
+            pathlib.Path(_bismark_report_path(bismark_bam)).touch()
+    # the R2 bam of B1 is broken, its sort fail
+    broken_bam = pathlib.Path(_bismark_bam_path(out_dir, 'uid', 'B1', 'R2'))
+    broken_bam.write_bytes(b'not a bam')
+    bismark_df = pd.DataFrame({'uid': ['uid'] * 4, 'index_name': ['A1', 'A1', 'B1', 'B1'],
+                               'read_type': ['R1', 'R2'] * 2})
+    config = configparser.ConfigParser()
+    config.read_dict({'bamFilter': {'cores': '2', 'mapq_threshold': '10', 'dedup_engine': 'builtin',
+                                    'threads': '1'}})
+    stat_dir = tmp_path / 'stats'
+    stat_dir.mkdir()
+
+    # the failed cell does not stop the other cell, which is merged, recorded and cleaned up
+    with pytest.raises(subprocess.CalledProcessError):
+        bam_qc(bismark_df, str(out_dir), config, Manifest(stat_dir))
+    manifest = Manifest(stat_dir)
+    assert [row['read_type'] for row in manifest.cell_result('bam', 'uid', 'A1')] == ['R1', 'R2']
+    assert manifest.cell_result('bam', 'uid', 'B1') is None
+    assert sorted(p.name for p in out_dir.glob('uid_A1*')) == ['uid_A1.final.bam']
+    # the input of the failed cell is kept for the next run
+    assert broken_bam.exists()
+    assert pathlib.Path(_bismark_bam_path(out_dir, 'uid', 'B1', 'R1')).exists()
+
+    # resume with the fixed bam, only B1 run again
+    _write_test_bam(tmp_path, chroms, reads['R2'], bam_name=str(broken_bam), sort=False)
+    bam_df = bam_qc(bismark_df, str(out_dir), config, Manifest(stat_dir))
+    assert bam_df[['uid', 'index_name', 'read_type']].values.tolist() == bismark_df.values.tolist()
+    assert bam_df['out_reads'].tolist() == [2, 1, 2, 1]
+    assert bam_df['UNPAIRED_READ_DUPLICATES'].astype(int).tolist() == [1, 0, 1, 0]
+    assert bam_df.columns[-4:].tolist() == ['out_reads', 'uid', 'index_name', 'read_type']
+    assert sorted(p.name for p in out_dir.iterdir()) == ['uid_A1.final.bam', 'uid_B1.final.bam']
+    with pysam.AlignmentFile(str(out_dir / 'uid_B1.final.bam')) as bam:
+        assert [read.query_name for read in bam] == ['a2', 'b1', 'a1']
+
+
+def test_run_pipe(tmp_path):
+    assert _run_pipe(['printf "a\\nb\\n"', 'tac', 'cat']).stdout == 'b\na\n'
+    # a failed command fail the pipe even if the last one succeed
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        _run_pipe(['false', 'cat'])
+    assert e.value.cmd == ['false']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        _process_bam(['true', ['printf a', 'false']])
+    assert e.value.cmd == ['false']
+
+    # pipe mode commands: picard stream into the filter, the sorted bam is uncompressed
+    cmd_list, temp_files, dedup_matrix = _sort_dedup_filter_cmds('c_R1.bam', 'c_R1.filter.bam', 10, pipe=True)
+    assert cmd_list[0] == 'samtools sort -l 0 -o c_R1.sort.bam --threads 2 c_R1.bam'
+    assert cmd_list[1][0].startswith('picard MarkDuplicates I=c_R1.sort.bam O=/dev/stdout')
+    assert cmd_list[1][1] == 'samtools view -b -h -q 10 -@ 2 -o c_R1.filter.bam -'
+    assert temp_files == ['c_R1.sort.bam', dedup_matrix]
+
+    if shutil.which('samtools') is None:
+        pytest.skip('samtools is not installed')
+    # the builtin engine read the sort stream, a failed sort raise its own error
+    sort_cmd, sort_bam = _sort_cmd(str(tmp_path / 'missing.bam'), threads=1, to_stdout=True)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        _builtin_process_bam(sort_cmd, sort_bam, str(tmp_path / 'filter.bam'), 10)
+    assert e.value.cmd[:2] == ['samtools', 'sort']
+    _, bam_path = _write_test_bam(tmp_path, [('chr1', 'ACGT' * 10)],
+                                  [('r1', 0, 5, 'ACGTA', [(0, 5)], 0, 60, None),
+                                   ('r2', 0, 1, 'CGTAC', [(0, 5)], 0, 5, None)], bam_name='in.bam', sort=False)
+    sort_cmd, sort_bam = _sort_cmd(bam_path, threads=1, to_stdout=True)
+    s = _builtin_process_bam(sort_cmd, sort_bam, str(tmp_path / 'filter.bam'), 10)
+    assert s['out_reads'] == 1
+    assert s['UNPAIRED_READS_EXAMINED'] == '2'
+
+
+def test_dedup_reads():
+    import pysam
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+    reads = []
+    # name, start, length, reverse, quality
+    for name, start, length, reverse, quality in [('f1', 10, 30, False, 20), ('f2', 10, 40, False, 30),
+                                                  ('f3', 12, 30, False, 30), ('r1', 15, 30, True, 30),
+                                                  ('r2', 25, 20, True, 30), ('f4', 100, 30, False, 20),
+                                                  ('f5', 100, 30, False, 20)]:
+        read = pysam.AlignedSegment(header)
+        read.query_name = name
+        read.query_sequence = 'A' * length
+        read.query_qualities = [quality] * length
+        read.flag = 16 if reverse else 0
+        read.reference_id = 0
+        read.reference_start = start
+        read.cigartuples = [(0, length)]
+        reads.append(read)
+    stats = collections.defaultdict(int)
+    # f1 f2 same 5' end, f2 has higher score; r1 r2 same 5' end (44), r2 is lower; f4 f5 tie, keep the first
+    assert [read.query_name for read in _dedup_reads(reads, stats)] == ['f2', 'f3', 'r1', 'f4']
+    assert stats['UNPAIRED_READ_DUPLICATES'] == 3
+    assert stats['UNPAIRED_READS_EXAMINED'] == 7
+
+    # c1 start at 60 after f6, but its unclipped 5' end (10) is the same as f1
+    sorted_reads = [reads[0]]
+    for name, cigar, quality in [('f6', [(0, 30)], 20), ('c1', [(4, 50), (0, 30)], 10)]:
+        read = pysam.AlignedSegment(header)
+        read.query_name = name
+        read.query_sequence = 'A' * sum(length for _, length in cigar)
+        read.query_qualities = [quality] * len(read.query_sequence)
+        read.reference_id = 0
+        read.reference_start = 60
+        read.cigartuples = cigar
+        sorted_reads.append(read)
+    stats = collections.defaultdict(int)
+    assert [read.query_name for read in _dedup_reads(sorted_reads, stats)] == ['f1', 'f6']
+    assert stats['UNPAIRED_READ_DUPLICATES'] == 1
+
+    # long reads over the picard score cap (16383) tie, keep the first even if the second has higher qualities
+    long_reads = []
+    for name, quality in [('l1', 30), ('l2', 40)]:
+        read = pysam.AlignedSegment(header)
+        read.query_name = name
+        read.query_sequence = 'A' * 600
+        read.query_qualities = [quality] * 600
+        read.reference_id = 0
+        read.reference_start = 10
+        read.cigartuples = [(0, 600)]
+        long_reads.append(read)
+    assert [read.query_name for read in _dedup_reads(long_reads, collections.defaultdict(int))] == ['l1']
 
 
 def test_bismark():
     return
 
 
-def test_call_methylated_sites():
-    return
+def test_bismark_batch(tmp_path):
+    import pysam
+    out_dir = tmp_path / 'bismark'
+    out_dir.mkdir()
+    cells = [('u', 'ad001', _write_fastq(tmp_path / 'u_ad001_R1.trimed.fq.gz',
+                                         [(f'a{i}', 'ACGTACGTAC') for i in range(5)])),
+             ('u', 'ad002', _write_fastq(tmp_path / 'u_ad002_R1.trimed.fq.gz',
+                                         [(f'b{i}', 'TTGCATGCAA') for i in range(3)]))]
+    batch_path = out_dir / 'bismark_batch0_R1' / 'batch_R1.fq.gz'
+    cell_reads = _write_bismark_batch(cells, batch_path)
+    assert cell_reads == {'u_ad001': 5, 'u_ad002': 3}
+    names = [name.decode() for name, _, _, _ in _iter_fastq_records(batch_path)]
+    assert names == [f'@u_ad001|a{i}' for i in range(5)] + [f'@u_ad002|b{i}' for i in range(3)]
+
+    # bismark output of the batch: a0, a1, b0 unique mapped, a2 and b1 unmapped, a3 ambiguous,
+    # a4 and b2 rejected to complementary strands, which bismark only count in the batch total
+    batch_dir = batch_path.parent
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                                              'SQ': [{'SN': 'chr1', 'LN': 100}]})
+    mapped = [('u_ad001|a0', 'CT', 'CT', 'Z.x.h...'), ('u_ad001|a1', 'GA', 'CT', 'z.X.hH..'),
+              ('u_ad002|b0', 'CT', 'GA', 'u.U.z...')]
+    with pysam.AlignmentFile(str(batch_dir / 'batch_R1_bismark_bt2.bam'), 'wb', header=header) as bam:
+        for i, (name, xr, xg, xm) in enumerate(mapped):
+            read = pysam.AlignedSegment(header)
+            read.query_name = name
+            read.query_sequence = 'ACGTACGT'
+            read.query_qualities = [40] * 8
+            read.reference_id = 0
+            read.reference_start = i * 10
+            read.mapping_quality = 40
+            read.cigartuples = [(0, 8)]
+            read.set_tags([('XM', xm), ('XR', xr), ('XG', xg)])
+            bam.write(read)
+    _write_fastq(batch_dir / 'batch_R1.fq.gz_unmapped_reads.fq.gz', [('u_ad001|a2', 'ACGT'), ('u_ad002|b1', 'TTGC')])
+    _write_fastq(batch_dir / 'batch_R1.fq.gz_ambiguous_reads.fq.gz', [('u_ad001|a3', 'ACGT')])
+    (batch_dir / 'batch_R1_bismark_bt2_SE_report.txt').write_text(
+        f'Bismark report for: {batch_path} (version: v0.16.3)\n'
+        'Sequences analysed in total:\t8\n'
+        'Number of alignments with a unique best hit from the different alignments:\t3\n'
+        'Mapping efficiency:\t37.5%\n'
+        'Sequences with no alignments under any condition:\t2\n'
+        'Sequences did not map uniquely:\t1\n'
+        'Sequences which were discarded because genomic sequence could not be extracted:\t0\n'
+        'CT/CT:\t1\t((converted) top strand)\n'
+        'CT/GA:\t1\t((converted) bottom strand)\n'
+        'GA/CT:\t1\t(complementary to (converted) top strand)\n'
+        'GA/GA:\t0\t(complementary to (converted) bottom strand)\n'
+        'Number of alignments to (merely theoretical) complementary strands being rejected in total:\t2\n'
+        "Total number of C's analysed:\t7\n"
+        "Total methylated C's in CpG context:\t1\n"
+        "Total methylated C's in CHG context:\t1\n"
+        "Total methylated C's in CHH context:\t1\n"
+        "Total methylated C's in Unknown context:\t1\n"
+        "Total unmethylated C's in CpG context:\t2\n"
+        "Total unmethylated C's in CHG context:\t1\n"
+        "Total unmethylated C's in CHH context:\t2\n"
+        "Total unmethylated C's in Unknown context:\t1\n"
+        'C methylated in CpG context:\t33.3%\n'
+        'C methylated in CHG context:\t50.0%\n'
+        'C methylated in CHH context:\t33.3%\n'
+        'C methylated in Unknown context (CN or CHN):\t50.0%\n')
+
+    _split_bismark_batch(batch_path, cell_reads, 'R1', out_dir)
+    assert not batch_dir.exists()
+    for tag, expect in [('u_ad001', ['a0', 'a1']), ('u_ad002', ['b0'])]:
+        with pysam.AlignmentFile(str(out_dir / f'{tag}_R1.trimed_bismark_bt2.bam')) as bam:
+            assert [read.query_name for read in bam] == expect
+    report_paths = sorted(out_dir.glob('*_SE_report.txt'))
+    assert report_paths[0].read_text().startswith(
+        f'Bismark report for: {out_dir / "u_ad001_R1.trimed.fq.gz"} (version: v0.16.3)\n')
+    report_df = _parse_bismark_report(report_paths).set_index('index_name')
+    expect = {'total_reads': [5, 3], 'unique_map': [2, 1], 'unmap': [1, 1], 'ununique_map': [1, 0],
+              'no_genome': [1, 1], 'OT': [1, 0], 'OB': [0, 1], 'CTOT': [1, 0], 'CTOB': [0, 0],
+              'total_mcg': [1, 0], 'total_cg': [1, 1], 'total_mchg': [1, 0], 'total_chg': [1, 0],
+              'total_mchh': [1, 0], 'total_chh': [2, 0], 'total_mcn': [0, 1], 'total_cn': [0, 1],
+              'total_c': [7, 1], 'mapping_rate': [40.0, 100 / 3], 'total_mcg_rate': [50.0, 0.0]}
+    for term, values in expect.items():
+        assert report_df.loc[['ad001', 'ad002'], term].tolist() == pytest.approx(values, abs=0.05), term
+    assert report_df['total_reads'].sum() == 8
+    # no CHG in ad002, bismark write the can not determine line
+    assert pd.isna(report_df.loc['ad002', 'total_mchg_rate'])
+
+
+def test_merge_bismark_report(tmp_path):
+    report_template = 'Bismark report for: {name} (version: v0.16.3)\n' \
+                      'Sequences analysed in total:\t{total}\n' \
+                      'Number of alignments with a unique best hit from the different alignments:\t{unique}\n' \
+                      'Mapping efficiency:\t{rate}%\n' \
+                      'CT/CT:\t{unique}\t((converted) top strand)\n' \
+                      "Total methylated C's in CpG context:\t{mcg}\n" \
+                      "Total unmethylated C's in CpG context:\t{cg}\n" \
+                      'C methylated in CpG context:\t{cg_rate}%\n'
+    chunks = [dict(total=100, unique=50, rate=50.0, mcg=30, cg=10, cg_rate=75.0),
+              dict(total=300, unique=250, rate=83.3, mcg=10, cg=30, cg_rate=25.0)]
+    chunk_paths = []
+    for i, chunk in enumerate(chunks):
+        path = tmp_path / f'u_ad001_R1.trimed.chunk{i}_bismark_bt2_SE_report.txt'
+        path.write_text(report_template.format(name=path.name, **chunk))
+        chunk_paths.append(path)
+    merge_path = tmp_path / 'u_ad001_R1.trimed_bismark_bt2_SE_report.txt'
+    _merge_bismark_report(chunk_paths, merge_path, input_name='u_ad001_R1.trimed.fq.gz')
+    assert merge_path.read_text().startswith('Bismark report for: u_ad001_R1.trimed.fq.gz (version: v0.16.3)\n')
+    result = _parse_bismark_report([merge_path]).iloc[0]
+    assert result['total_reads'] == 400
+    assert result['unique_map'] == 300
+    assert result['OT'] == 300
+    assert result['mapping_rate'] == 75.0
+    assert result['total_mcg_rate'] == 50.0
+    assert pd.isna(result['total_mchg_rate'])
+    assert result['read_type'] == 'R1'
+
+
+def test_cutadapt_demultiplex_df():
+    report = {'read_counts': {'input': 200},
+              'adapters_read1': [{'name': 'ad001', 'total_matches': 50, 'three_prime_end': None,
+                                  'five_prime_end': {'type': 'noninternal_five_prime', 'sequence': 'ATCACG'}},
+                                 {'name': 'ad002', 'total_matches': 30, 'three_prime_end': None,
+                                  'five_prime_end': {'type': 'noninternal_five_prime', 'sequence': 'CGATGT'}}]}
+    result_df = cutadapt_demultiplex_df(report)
+    assert result_df['Sequence'].tolist() == ['ATCACG', 'CGATGT']
+    assert result_df['Type'].tolist() == ["non-internal 5'"] * 2
+    assert result_df['Trimmed'].tolist() == [50, 30]
+    assert result_df['Ratio'].tolist() == [0.25, 0.15]
+
+
+def test_call_methylated_sites(tmp_path):
+    chroms = [('chr1', 'ATCGACCGTTACGCAGGTCGAACCGTAG')]
+    reads = [('f1', 0, 1, 'TCGATCGT', [(0, 8)], 0, 60, None),
+             ('r1', 0, 3, 'GACCATTACGCAA', [(0, 13)], 16, 60, None)]
+    fasta_path, bam_path = _write_test_bam(tmp_path, chroms, reads, bam_name='uid_A1.final.bam')
+    config = configparser.ConfigParser()
+    config.read_dict({'callMethylation': {'reference_fasta': fasta_path, 'num_upstr_bases': '0',
+                                          'num_downstr_bases': '2', 'buffer_line_number': '100', 'min_mapq': '10',
+                                          'min_base_quality': '20', 'cores': '1', 'engine': 'pysam'}})
+    bam_df = pd.DataFrame({'uid': ['uid', 'uid'], 'index_name': ['A1', 'A1'], 'read_type': ['R1', 'R2'],
+                           'out_reads': ['1', '1']})
+    stat_dir = tmp_path / 'stats'
+    stat_dir.mkdir()
+    allc_df = call_methylated_sites(bam_df, str(tmp_path), config, stat_dir=stat_dir)
+    assert isinstance(allc_df, pd.DataFrame)
+    assert allc_df.loc[allc_df['index'] == 'CGA', 'cov'].tolist() == [2]
+    assert set(allc_df['uid']) == {'uid'}
+    # site stats tables are written by the stage
+    for name in SITE_STATS_TABLES:
+        stat_df = pd.read_csv(stat_dir / f'{name}.tsv.gz', sep='\t')
+        assert stat_df[['uid', 'index_name']].drop_duplicates().values.tolist() == [['uid', 'A1']]
+    assert (tmp_path / 'allc_uid_A1.tsv.gz.tbi').exists()
+
+
+def _write_test_bam(tmp_path, chroms, reads, bam_name='test.bam', sort=True):
+    """
+    Write reference fasta and coordinate sorted bam for ALLC calling,
+    reads are (name, chrom index, start, query sequence, cigar tuples, flag, mapq, qualities)
+    If not sort, reads are written in the given order without index, like a bismark bam.
+    """
+    import pysam
+    fasta_path = str(tmp_path / 'ref.fa')
+    with open(fasta_path, 'w') as f:
+        for chrom, seq in chroms:
+            f.write(f'>{chrom}\n')
+            # multi line fasta
+            for i in range(0, len(seq), 10):
+                f.write(seq[i:i + 10] + '\n')
+    pysam.faidx(fasta_path)
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                                              'SQ': [{'SN': chrom, 'LN': len(seq)} for chrom, seq in chroms]})
+    if not sort:
+        header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                                                  'SQ': header.to_dict()['SQ']})
+    bam_path = str(tmp_path / bam_name)
+    with pysam.AlignmentFile(bam_path, 'wb', header=header) as bam:
+        for name, chrom_id, start, seq, cigar, flag, mapq, quals in \
+                (sorted(reads, key=lambda r: (r[1], r[2])) if sort else reads):
+            read = pysam.AlignedSegment(header)
+            read.query_name = name
+            read.query_sequence = seq
+            read.query_qualities = [40] * len(seq) if quals is None else quals
+            read.flag = flag
+            read.reference_id = chrom_id
+            read.reference_start = start
+            read.mapping_quality = mapq
+            read.cigartuples = cigar
+            bam.write(read)
+    if sort:
+        pysam.index(bam_path)
+    return fasta_path, bam_path
+
+
+def _call_test_allc(worker, bam_path, fasta_path, out_path, bgzip):
+    result = worker(bam_path, fasta_path, num_upstr_bases=0, num_downstr_bases=2, buffer_line_number=2,
+                    min_mapq=10, min_base_quality=20, output_path=out_path, bgzip=bgzip)
+    count_df, _ = _stitch_allc_shards(out_path, [out_path], [result])
+    with gzip.open(out_path, 'rt') as f, open(out_path + '.idx') as idx_f:
+        return f.read(), idx_f.read(), count_df
+
+
+def test_pysam_engine(tmp_path, monkeypatch):
+    chroms = [('chr1', 'ATCGACCGTTACGCAGGTCGAACCGTAG'), ('chr2', 'GGCACGTAACG')]
+    reads = [
+        # forward, C sites at 2, 5, 6 (0-based) read as C, T, C
+        ('f1', 0, 1, 'TCGATCGT', [(0, 8)], 0, 60, None),
+        # soft clip and 1 bp insertion after ref 5, C sites 2, 5, 6 read as C, T, T
+        ('f2', 0, 2, 'AACGATGTGTTA', [(4, 2), (0, 4), (1, 1), (0, 5)], 0, 60, None),
+        # 2 bp deletion over ref 6, 7, C site 5 read as C, low quality base at C site 11
+        ('f3', 0, 4, 'ACTTACG', [(0, 2), (2, 2), (0, 5)], 0, 60, [40] * 5 + [10, 40]),
+        # reverse, G sites at 3, 7, 12, 15 read as G, A, G, A
+        ('r1', 0, 3, 'GACCATTACGCAA', [(0, 13)], 16, 60, None),
+        # low MAPQ, secondary, qc fail, duplicate and improper pair reads are not counted
+        ('m1', 0, 2, 'CGACC', [(0, 5)], 0, 5, None),
+        ('s1', 0, 2, 'CGACC', [(0, 5)], 0x100, 60, None),
+        ('q1', 0, 2, 'CGACC', [(0, 5)], 0x200, 60, None),
+        ('d1', 0, 2, 'CGACC', [(0, 5)], 0x400, 60, None),
+        ('p1', 0, 2, 'CGACC', [(0, 5)], 0x1 | 0x40, 60, None),
+        # C sites at 22, 23 read as T, C
+        ('e1', 0, 20, 'AATCGTAG', [(0, 8)], 0, 60, None),
+        # G sites at 0, 1 and C site at 9 have no complete context
+        ('g1', 1, 0, 'GACACG', [(0, 6)], 16, 60, None),
+        ('e2', 1, 7, 'AACG', [(0, 4)], 0, 60, None),
+        # start at C site 13 with MAPQ 13, its read start marker in mpileup is "^."
+        ('k1', 0, 13, 'CAG', [(0, 3)], 0, 13, None),
+    ]
+    fasta_path, bam_path = _write_test_bam(tmp_path, chroms, reads)
+    # flush the pysam engine every 2 reads, sites span the flush boundary
+    monkeypatch.setattr(allc, '_PILEUP_CHUNK_READS', 2)
+
+    expect_allc = ''.join(f'{line}\t1\n' for line in [
+        'chr1\t3\t+\tCGA\t2\t2', 'chr1\t4\t-\tCGA\t1\t1', 'chr1\t6\t+\tCCG\t1\t3',
+        'chr1\t7\t+\tCGT\t1\t2', 'chr1\t8\t-\tCGG\t0\t1', 'chr1\t13\t-\tCGT\t1\t1',
+        'chr1\t14\t+\tCAG\t1\t1', 'chr1\t16\t-\tCTG\t0\t1', 'chr1\t23\t+\tCCG\t0\t1', 'chr1\t24\t+\tCGT\t1\t1',
+        'chr2\t6\t-\tCGT\t1\t1'])
+    chr2_offset = len(expect_allc) - len('chr2\t6\t-\tCGT\t1\t1\t1\n')
+    for bgzip in [False, True]:
+        pysam_allc, pysam_idx, pysam_count_df = _call_test_allc(
+            _call_methylated_sites_pysam_worker, bam_path, fasta_path, str(tmp_path / f'pysam_{bgzip}.tsv.gz'), bgzip)
+        assert pysam_allc == expect_allc
+        assert pysam_idx == f'chr1\t0\nchr2\t{chr2_offset}\n#eof\n'
+        assert pysam_count_df.loc['CGT', 'mc'] == 4
+        assert pysam_count_df.loc['CGT', 'cov'] == 5
+        if shutil.which('samtools') is None:
+            continue
+        mpileup_allc, mpileup_idx, mpileup_count_df = _call_test_allc(
+            _call_methylated_sites_worker, bam_path, fasta_path, str(tmp_path / f'mpileup_{bgzip}.tsv.gz'), bgzip)
+        assert mpileup_allc == pysam_allc
+        assert mpileup_idx == pysam_idx
+        assert mpileup_count_df.sort_index().equals(pysam_count_df.sort_index())
+
+
+def test_bam_to_allc(tmp_path):
+    import pysam
+    chroms = [('chr1', 'ATCGACCGTTACGCAGGTCGAACCGTAG'), ('chr2', 'GGCACGTAACG')]
+    # unsorted bismark bams of one cell
+    r1_reads = [('e1', 0, 20, 'AATCGTAG', [(0, 8)], 0, 60, None),
+                ('f1', 0, 1, 'TCGATCGT', [(0, 8)], 0, 60, None),
+                # duplicate of f1 with lower base qualities
+                ('f1d', 0, 1, 'TCGATCGT', [(0, 8)], 0, 60, [20] * 8),
+                # MAPQ below the bamFilter threshold
+                ('m1', 0, 2, 'CGACC', [(0, 5)], 0, 5, None),
+                ('g1', 1, 0, 'GACACG', [(0, 6)], 16, 60, None)]
+    r2_reads = [('r1', 0, 3, 'GACCATTACGCAA', [(0, 13)], 16, 60, None),
+                ('k1', 0, 13, 'CAG', [(0, 3)], 0, 13, None),
+                ('e2', 1, 7, 'AACG', [(0, 4)], 0, 60, None)]
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    bismark_bams = {}
+    for read_type, reads in [('R1', r1_reads), ('R2', r2_reads)]:
+        bismark_bams[read_type] = _bismark_bam_path(out_dir, 'uid', 'A1', read_type)
+        fasta_path, _ = _write_test_bam(tmp_path, chroms, reads, bam_name=bismark_bams[read_type], sort=False)
+    kept_names = ['f1', 'r1', 'k1', 'e1', 'g1', 'e2']
+
+    # merged stream of the sorted bams
+    sort_bams = []
+    for bam_path in bismark_bams.values():
+        sort_bams.append(bam_path[:-3] + 'sort.bam')
+        pysam.sort('-o', sort_bams[-1], bam_path)
+    read_counts = {bam_path: 0 for bam_path in sort_bams}
+    dedup_stats = {bam_path: collections.defaultdict(int) for bam_path in sort_bams}
+    merged = [read.query_name for read in _iter_filtered_reads(sort_bams, 10, read_counts, dedup_stats=dedup_stats)]
+    assert merged == kept_names
+    assert list(read_counts.values()) == [3, 3]
+    assert dedup_stats[sort_bams[0]]['UNPAIRED_READ_DUPLICATES'] == 1
+    assert dedup_stats[sort_bams[0]]['UNPAIRED_READS_EXAMINED'] == 5
+    for bam_path in sort_bams:
+        pathlib.Path(bam_path).unlink()
+
+    # same ALLC as the pysam engine on a bam of the kept reads
+    _, kept_bam = _write_test_bam(tmp_path, chroms, [read for read in r1_reads + r2_reads if read[0] in kept_names])
+    expect_allc, expect_idx, expect_count_df = _call_test_allc(_call_methylated_sites_pysam_worker, kept_bam,
+                                                               fasta_path, str(tmp_path / 'expect.tsv.gz'), True)
+    assert expect_allc.count('\n') == 11
+
+    if shutil.which('samtools') is None:
+        pytest.skip('samtools is not installed')
+    # read from the sort stream
+    bam_cmds = {bam_path: _stream_cmds(bam_path, 'builtin', threads=1)[1] for bam_path in bismark_bams.values()}
+    final_bam_path = str(out_dir / 'uid_A1.final.bam')
+    allc_path = str(tmp_path / 'worker.tsv.gz')
+    count_df, _, read_counts, dedup_stats = _bam_to_allc_worker(
+        list(bismark_bams.values()), 10, final_bam_path, allc_path, fasta_path, 0, 2, 10, 20,
+        True, 1, True, builtin_dedup=True, bam_cmds=bam_cmds)
+    assert list(read_counts.values()) == [3, 3]
+    assert dedup_stats[bismark_bams['R1']]['UNPAIRED_READ_DUPLICATES'] == '1'
+    with gzip.open(allc_path, 'rt') as f:
+        assert f.read() == expect_allc
+    with pysam.AlignmentFile(final_bam_path) as bam:
+        assert [read.query_name for read in bam] == kept_names
+    assert count_df.equals(expect_count_df)
+    # no bam is written by the stream
+    assert sorted(p.name for p in out_dir.iterdir()) == sorted([pathlib.Path(p).name for p in bismark_bams.values()]
+                                                               + ['uid_A1.final.bam'])
+
+    # a failed sort fail the stream
+    bam_cmds[bismark_bams['R2']] = [f'samtools sort -u -o - {tmp_path / "missing.bam"}']
+    with pytest.raises(subprocess.CalledProcessError):
+        _bam_to_allc_worker(list(bismark_bams.values()), 10, final_bam_path, allc_path, fasta_path, 0, 2, 10, 20,
+                            True, 1, False, builtin_dedup=True, bam_cmds=bam_cmds)
+
+    # the whole stage
+    pathlib.Path(final_bam_path).unlink()
+    config = configparser.ConfigParser()
+    config.read_dict({'bamFilter': {'cores': '3', 'mapq_threshold': '10', 'dedup_engine': 'builtin', 'threads': '1'},
+                      'callMethylation': {'reference_fasta': fasta_path, 'num_upstr_bases': '0',
+                                          'num_downstr_bases': '2', 'min_mapq': '10', 'min_base_quality': '20'}})
+    bismark_df = pd.DataFrame({'uid': ['uid', 'uid'], 'index_name': ['A1', 'A1'], 'read_type': ['R1', 'R2']})
+    stat_dir = tmp_path / 'stats'
+    stat_dir.mkdir()
+    bam_df, allc_df = bam_to_allc(bismark_df, str(out_dir), config, stat_dir=stat_dir)
+    assert bam_df['read_type'].tolist() == ['R1', 'R2']
+    assert bam_df['out_reads'].tolist() == [3, 3]
+    assert bam_df['UNPAIRED_READ_DUPLICATES'].tolist() == ['1', '0']
+    assert set(allc_df['uid']) == {'uid'}
+    assert sorted(p.name for p in stat_dir.iterdir()) == sorted(f'{name}.tsv.gz' for name in SITE_STATS_TABLES)
+    with gzip.open(out_dir / 'allc_uid_A1.tsv.gz', 'rt') as f:
+        assert f.read() == expect_allc
+    # only the ALLC and its indexes are left
+    assert sorted(p.name for p in out_dir.iterdir()) == ['allc_uid_A1.tsv.gz', 'allc_uid_A1.tsv.gz.idx',
+                                                         'allc_uid_A1.tsv.gz.tbi']
+
+
+def test_stitch_allc_shards(tmp_path):
+    import pysam
+    rng = np.random.RandomState(0)
+    chroms = [(f'chr{i}', ''.join(rng.choice(list('ACGT'), length))) for i, length in [(1, 3000), (2, 500), (3, 2000)]]
+    reads = []
+    for chrom_id, (_, seq) in enumerate(chroms):
+        for i, start in enumerate(np.sort(rng.randint(0, len(seq) - 50, 200))):
+            # forward reads with random C to T conversion
+            read_seq = ''.join('T' if b == 'C' and rng.rand() < 0.5 else b for b in seq[start:start + 50])
+            reads.append((f'{chrom_id}_{i}', chrom_id, int(start), read_seq, [(0, 50)], 0, 60, None))
+    fasta_path, bam_path = _write_test_bam(tmp_path, chroms, reads)
+
+    for bgzip in [False, True]:
+        whole_path = str(tmp_path / f'whole_{bgzip}.tsv.gz')
+        _call_test_allc(_call_methylated_sites_pysam_worker, bam_path, fasta_path, whole_path, bgzip)
+        stitch_path = str(tmp_path / f'stitch_{bgzip}.tsv.gz')
+        shards = [['chr1'], ['chr2', 'chr3']] if bgzip else [['chr1'], ['chr2'], ['chr3']]
+        part_paths = [f'{stitch_path}.part{i}' for i in range(len(shards))]
+        shard_results = [_call_methylated_sites_pysam_worker(
+            bam_path, fasta_path, num_upstr_bases=0, num_downstr_bases=2, buffer_line_number=2,
+            min_mapq=10, min_base_quality=20, regions=regions, output_path=part_path, bgzip=bgzip)
+            for regions, part_path in zip(shards, part_paths)]
+        _stitch_allc_shards(stitch_path, part_paths, shard_results)
+
+        with gzip.open(whole_path, 'rt') as whole_f, gzip.open(stitch_path, 'rt') as stitch_f:
+            assert stitch_f.read() == whole_f.read()
+        with open(stitch_path + '.idx') as f:
+            idx = [line.rstrip('\n').split('\t') for line in f]
+        assert idx[-1] == ['#eof']
+        assert [chrom for chrom, _ in idx[:-1]] == ['chr1', 'chr2', 'chr3']
+        with gzip.open(stitch_path, 'rt') as f:
+            for chrom, offset in idx[:-1]:
+                # offset is the first line of the chromosome
+                f.seek(int(offset))
+                assert f.readline().startswith(f'{chrom}\t')
+                if int(offset) > 0:
+                    f.seek(int(offset) - 1)
+                    assert f.read(1) == '\n'
+        if bgzip:
+            with pysam.TabixFile(whole_path) as whole_tbx, pysam.TabixFile(stitch_path) as stitch_tbx:
+                assert stitch_tbx.contigs == whole_tbx.contigs
+                for chrom, start, end in [('chr1', 0, 3000), ('chr1', 1000, 1200), ('chr2', 100, 400),
+                                          ('chr3', 0, 50), ('chr3', 1900, 2000)]:
+                    assert list(stitch_tbx.fetch(chrom, start, end)) == list(whole_tbx.fetch(chrom, start, end))
+        else:
+            assert not pathlib.Path(stitch_path + '.tbi').exists()
+        assert not any(pathlib.Path(part_path).exists() for part_path in part_paths)
+
+
+def test_prepare_reference(tmp_path):
+    import pysam
+    rng = np.random.RandomState(0)
+    chroms = [('chr1', 95), ('chr2', 60), ('chrM', 7)]
+    fasta_path = str(tmp_path / 'ref.fa')
+    with open(fasta_path, 'w') as f:
+        for chrom, length in chroms:
+            # lower case soft masked bases, lines of 25 bases, last line can be shorter
+            seq = ''.join(rng.choice(list('ACGTNacgtn'), length))
+            f.write(f'>{chrom} description\n')
+            for i in range(0, length, 25):
+                f.write(seq[i:i + 25] + '\n')
+    pysam.faidx(fasta_path)
+    assert read_prepared_reference(fasta_path) is None
+    prepare_reference(fasta_path)
+    prepared_reference = read_prepared_reference(fasta_path)
+    fai_df = _read_faidx(fasta_path + '.fai')
+    for chrom, length in chroms:
+        seq = _get_chromosome_sequence(fasta_path, fai_df, chrom).upper()
+        assert len(seq) == length
+        assert get_chromosome_array(prepared_reference, chrom).tobytes().decode() == seq
+    assert get_chromosome_array(prepared_reference, 'chrX') is None
+
+
+def test_context_table(tmp_path, monkeypatch):
+    import pysam
+    # C/G at both chromosome ends, next to N and at the block bounds
+    chroms = [('chr1', 'CGNCAGTNGCCGATCGGACNNGTCAGCTCG'), ('chr2', 'GCANCG'), ('chr3', 'ATTA')]
+    fasta_path = str(tmp_path / 'ref.fa')
+    with open(fasta_path, 'w') as f:
+        for chrom, seq in chroms:
+            f.write(f'>{chrom}\n{seq[:20]}\n' + (f'{seq[20:]}\n' if len(seq) > 20 else ''))
+    pysam.faidx(fasta_path)
+    monkeypatch.setattr(reference, '_CONTEXT_TABLE_BLOCK', 7)
+    for num_upstr_bases, num_downstr_bases in [(0, 2), (1, 2), (2, 0)]:
+        prepare_context_table(fasta_path, num_upstr_bases, num_downstr_bases)
+        context_table = read_context_table(fasta_path, num_upstr_bases, num_downstr_bases)
+        for chrom, seq in chroms:
+            seq = np.frombuffer(seq.encode(), dtype=np.uint8)
+            pos = np.flatnonzero((seq == ord('C')) | (seq == ord('G')))
+            expect_context, expect_valid = get_site_contexts(seq, pos, seq[pos] == ord('G'),
+                                                             num_upstr_bases, num_downstr_bases)
+            chrom_context = get_chromosome_context(context_table, chrom)
+            context, valid = lookup_site_contexts(context_table, chrom_context, pos)
+            assert valid.tolist() == expect_valid.tolist()
+            assert context[valid].tolist() == expect_context[expect_valid].tolist()
+        assert get_chromosome_context(context_table, 'chrX') is None
+
+
+def test_get_site_contexts():
+    # contexts should be the same as string slicing in the mpileup engine
+    seq = 'ACGTTCGNACCAGG'
+    pos = np.array([1, 2, 5, 6, 9, 10, 12, 13])
+    minus_strand = np.array([seq[p] == 'G' for p in pos])
+    context, valid = get_site_contexts(np.frombuffer(seq.encode(), dtype=np.uint8),
+                                        pos, minus_strand, 1, 2)
+    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C', 'N': 'N'}
+    for p, strand, c, v in zip(pos, minus_strand, context, valid):
+        if strand:
+            expect = ''.join(complement[b] for b in reversed(seq[p - 2:p + 2]))
+        else:
+            expect = seq[p - 1:p + 3]
+        assert v == (len(expect) == 4)
+        if v:
+            assert c == expect
+
+
+def _legacy_count_read_bases(read_bases):
+    # the per character decoder used by the mpileup engine before the batched one
+    if read_bases.count("+") + read_bases.count("-") > 0:
+        read_bases_no_indel = ""
+        index = 0
+        prev_index = 0
+        while index < len(read_bases):
+            if read_bases[index] == "+" or read_bases[index] == "-":
+                indel_size = ""
+                ind = index + 1
+                while True:
+                    try:
+                        int(read_bases[ind])
+                        indel_size += read_bases[ind]
+                        ind += 1
+                    except:
+                        break
+                try:
+                    indel_size = int(indel_size)
+                except:
+                    index += 1
+                    continue
+                read_bases_no_indel += read_bases[prev_index:index]
+                index = ind + indel_size
+                prev_index = index
+            else:
+                index += 1
+        read_bases_no_indel += read_bases[prev_index:index]
+        read_bases = read_bases_no_indel
+    return [read_bases.count(base) for base in '.T,a']
+
+
+def test_count_read_bases():
+    read_bases_list = ['..TT,a', '.+2TT.T', '^+.T$,-1a,a', '.+12ACGTACGTACGT.', 'T-T.,', '^].^,T$',
+                       '.+3T.a', '*', ',+1a-2tT.', '+', '.-10T']
+    rng = np.random.RandomState(0)
+    tokens = ['.', ',', 'T', 't', 'a', 'A', 'C', '*', '$', '^~', '^.', '^+', '+1T', '-2ta', '+11TTTTTTTTTTT', '-', '+']
+    for _ in range(200):
+        read_bases_list.append(''.join(rng.choice(tokens, rng.randint(1, 30))))
+    # read start markers are removed before the old decoder
+    expect = np.array([_legacy_count_read_bases(re.sub(r'\^.', '', read_bases)) for read_bases in read_bases_list])
+    assert (_count_read_bases(read_bases_list) == expect).all()
+    # mapping quality 13, 11, 51 and 64 after the read start marker are not bases
+    assert _count_read_bases(['^..', '^,,', '^T.$', '^a,']).tolist() == [[1, 0, 0, 0], [0, 0, 1, 0],
+                                                                          [1, 0, 0, 0], [0, 0, 1, 0]]
+    assert _count_read_bases([]).shape == (0, 4)
+
+
+def test_site_stats():
+    # stats of two shards should be the same as one pass, CG and CH rows sum their contexts
+    context = np.array(['CGA', 'CAG', 'CGA', 'CTN', 'CNA'])
+    mc = np.array([1, 0, 2, 1, 0])
+    cov = np.array([1, 2, 200, 3, 1])
+    one_pass = SiteStats()
+    one_pass.add('chr1', context, mc, cov)
+    shards = SiteStats()
+    shards.add('chr1', context[:2], mc[:2], cov[:2])
+    other = SiteStats()
+    other.add('chr1', context[2:], mc[2:], cov[2:])
+    shards.update(other)
+    assert shards.profile_df().sort_index().equals(one_pass.profile_df().sort_index())
+    assert shards.cov_hist_df().sort_values(['context', 'cov']).reset_index(drop=True) \
+        .equals(one_pass.cov_hist_df().sort_values(['context', 'cov']).reset_index(drop=True))
+
+    profile_df = one_pass.profile_df()
+    assert profile_df.loc['CG', 'base_count'] == 2
+    assert profile_df.loc['CH', 'partial_cov'] == 5
+    cov_hist_df = one_pass.cov_hist_df().set_index(['context', 'cov'])['sites']
+    assert cov_hist_df[('CGA', 100)] == 1
+    chrom_df = one_pass.chrom_df().set_index('chrom')
+    assert chrom_df.loc['chr1', 'sites'] == 5
+    assert chrom_df.loc['chr1', 'CG_mc'] == 3
+
+
+def test_core_scheduler():
+    assert get_command_cores('pigz -cd -p 6 a.fq.gz | cutadapt -j 6 -o b.fq.gz -') == 13
+    assert get_command_cores('bismark ref --bowtie2 a.fq.gz') == 3
+
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def _job(cores):
+        # jobs ask for more than the budget use the whole budget
+        cores = min(cores, 4)
+        with lock:
+            running.append(cores)
+            max_running.append(sum(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(cores)
+        return cores
+
+    with CoreScheduler(4) as scheduler:
+        futures = [scheduler.submit(_job, cores, cores=cores) for cores in [3, 2, 1, 1, 4, 2, 8]]
+        scheduler.join()
+        assert [future.result() for future in futures] == [3, 2, 1, 1, 4, 2, 4]
+    assert max(max_running) <= 4
+
+    # dependent jobs start after their dependencies, errors are passed down the chain
+    order = []
+    with CoreScheduler(2) as scheduler:
+        first = scheduler.submit(order.append, 'first')
+        second = scheduler.submit(order.append, 'second', after=[first])
+        failed = scheduler.submit(int, 'x')
+        skipped = scheduler.submit(order.append, 'skipped', after=[second, failed])
+        try:
+            scheduler.join()
+        except ValueError:
+            pass
+    assert order == ['first', 'second']
+    assert isinstance(skipped.exception(), ValueError)
+
+
+# stand-in for bismark, map the reads of the fastq one after another on chr1 and write the SE report.
+# Every run is logged into bismark.log next to the script, fastq with a name in $BISMARK_FAIL fail.
+_STUB_BISMARK = """
+import os, sys, gzip, pathlib, pysam
+args = sys.argv[1:]
+fastq_path = pathlib.Path(args[2])
+out_dir = pathlib.Path(args[args.index('-o') + 1])
+with open(pathlib.Path(__file__).parent / 'bismark.log', 'a') as log:
+    log.write(fastq_path.name + '\\n')
+if os.environ.get('BISMARK_FAIL', '-') in fastq_path.name:
+    sys.exit('mapping failed')
+base_name = fastq_path.name[:-len('.fq.gz')]
+header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.0', 'SO': 'unsorted'},
+                                          'SQ': [{'SN': 'chr1', 'LN': 200}]})
+with gzip.open(fastq_path, 'rt') as f:
+    lines = f.read().split('\\n')
+with pysam.AlignmentFile(str(out_dir / f'{base_name}_bismark_bt2.bam'), 'wb', header=header) as bam:
+    for i in range(0, len(lines) - 1, 4):
+        read = pysam.AlignedSegment(header)
+        read.query_name = lines[i][1:]
+        read.query_sequence = lines[i + 1]
+        read.query_qualities = [40] * len(lines[i + 1])
+        read.reference_id = 0
+        read.reference_start = 180 - i * 2
+        read.mapping_quality = 60
+        read.cigartuples = [(0, len(lines[i + 1]))]
+        bam.write(read)
+n_reads = len(lines) // 4
+(out_dir / f'{base_name}_bismark_bt2_SE_report.txt').write_text(
+    f'Bismark report for: {fastq_path} (version: v0.16.3)\\n'
+    f'Sequences analysed in total:\\t{n_reads}\\n'
+    f'Number of alignments with a unique best hit from the different alignments:\\t{n_reads}\\n'
+    'Mapping efficiency:\\t100.0%\\n')
+"""
+
+
+def test_cell_dag(tmp_path, monkeypatch):
+    import pysam
+    if shutil.which('samtools') is None:
+        pytest.skip('samtools is not installed')
+    bin_dir = _stub_commands(tmp_path, monkeypatch, {'cutadapt': _STUB_CUTADAPT, 'pigz': _STUB_PIGZ,
+                                                     'bismark': _STUB_BISMARK})
+    fasta_path = tmp_path / 'ref.fa'
+    fasta_path.write_text('>chr1\n' + 'ACGTTCGACC' * 20 + '\n')
+    pysam.faidx(str(fasta_path))
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    # lane fastq of the demultiplexed cells, large cells first
+    records = []
+    for index_name, n_reads in [('ad001', 8), ('ad002', 6), ('ad003', 4)]:
+        for lane in ['L1', 'L2']:
+            for read_type in ['R1', 'R2']:
+                _write_fastq(out_dir / f'u_{lane}_{index_name}_{read_type}.fq.gz',
+                             [(f'{lane}_{index_name}_{i}', 'TCGACCGTTACG') for i in range(n_reads // 2)])
+            records.append({'uid': 'u', 'lane': lane, 'index_name': index_name, 'Trimmed': n_reads // 2})
+    demultiplex_df = pd.DataFrame(records)
+    config = configparser.ConfigParser()
+    config.read_dict({'demultiplex': {},
+                      'fastqTrim': {'r1_adapter': 'AGATCGGAAGAGCAC', 'length_threshold': '5',
+                                    'quality_threshold': '20', 'overlap': '6', 'r1_left_cut': '1',
+                                    'r1_right_cut': '0', 'r2_left_cut': '1', 'r2_right_cut': '0',
+                                    'total_reads_threshold': '1', 'pigz_cores': '1', 'cutadapt_cores': '1'},
+                      'bismark': {'bismark_reference': 'ref', 'read_min': '1', 'read_max': '1000'},
+                      'bamFilter': {'mapq_threshold': '10', 'dedup_engine': 'builtin', 'threads': '1'},
+                      'callMethylation': {'reference_fasta': str(fasta_path), 'num_upstr_bases': '0',
+                                          'num_downstr_bases': '2', 'buffer_line_number': '100', 'min_mapq': '10',
+                                          'min_base_quality': '20', 'engine': 'pysam'}})
+    stat_dir = tmp_path / 'stats'
+    stat_dir.mkdir()
+    # cells holding a reservation when each cell is submitted, itself included
+    running = []
+    submit_cell = CellDAG.submit_cell
+
+    def _submit_cell(self, uid, index_name):
+        running.append(sorted(self._reserved.keys()))
+        return submit_cell(self, uid, index_name)
+
+    monkeypatch.setattr(CellDAG, 'submit_cell', _submit_cell)
+
+    # the largest cell fail in bismark, with min_free only one cell run at a time,
+    # the failed cell release its space and the other cells still run
+    monkeypatch.setenv('BISMARK_FAIL', 'ad001')
+    with pytest.raises(RuntimeError, match='1 cells failed: u ad001') as e:
+        run_cell_dag(demultiplex_df, out_dir, config, CoreScheduler(4), min_free=1 << 60,
+                     manifest=Manifest(stat_dir))
+    assert isinstance(e.value.__cause__, subprocess.CalledProcessError)
+    assert running == [[('u', 'ad001')], [('u', 'ad002')], [('u', 'ad003')]]
+    manifest = Manifest(stat_dir)
+    assert manifest.cell_done('fastq', 'u', 'ad001')
+    assert not manifest.cell_done('bismark', 'u', 'ad001')
+    for index_name in ['ad002', 'ad003']:
+        assert manifest.cell_done('allc', 'u', index_name)
+    assert (out_dir / 'allc_u_ad002.tsv.gz').exists()
+
+    # resume, only the failed cell is mapped again, all cells start at once without min_free
+    (bin_dir / 'bismark.log').unlink()
+    monkeypatch.delenv('BISMARK_FAIL')
+    running.clear()
+    tables = run_cell_dag(demultiplex_df, out_dir, config, CoreScheduler(4), manifest=Manifest(stat_dir))
+    assert running == [[('u', 'ad001')]]
+    assert sorted((bin_dir / 'bismark.log').read_text().split()) == ['u_ad001_R1.trimed.fq.gz',
+                                                                     'u_ad001_R2.trimed.fq.gz']
+    assert tables['fastq_trim_result']['index_name'].tolist() == ['ad001'] * 2 + ['ad002'] * 2 + ['ad003'] * 2
+    assert tables['bismark_result']['total_reads'].tolist() == [8, 8, 6, 6, 4, 4]
+    assert tables['bam_process_result']['out_reads'].tolist() == [8, 8, 6, 6, 4, 4]
+    assert tables['allc_total_result']['index_name'].unique().tolist() == ['ad001', 'ad002', 'ad003']
+    # final bam and ALLC of each cell, only the trimmed fastq are left besides them
+    assert sorted(p.name for p in out_dir.iterdir() if not p.name.endswith('.trimed.fq.gz')) == sorted(
+        name for index_name in ['ad001', 'ad002', 'ad003']
+        for name in [f'allc_u_{index_name}.tsv.gz', f'allc_u_{index_name}.tsv.gz.idx',
+                     f'allc_u_{index_name}.tsv.gz.tbi', f'u_{index_name}.final.bam'])
+
+    # a normal run of a new out dir start all cells together
+    new_out_dir = tmp_path / 'new_out'
+    new_out_dir.mkdir()
+    for path in tmp_path.glob('*.fq.gz'):
+        path.unlink()
+    for record in records:
+        for read_type in ['R1', 'R2']:
+            _write_fastq(new_out_dir / f'u_{record["lane"]}_{record["index_name"]}_{read_type}.fq.gz',
+                         [(f'{record["lane"]}_{record["index_name"]}_{i}', 'TCGACCGTTACG')
+                          for i in range(record['Trimmed'])])
+    running.clear()
+    new_tables = run_cell_dag(demultiplex_df, new_out_dir, config, CoreScheduler(4))
+    assert running == [[('u', 'ad001')], [('u', 'ad001'), ('u', 'ad002')],
+                       [('u', 'ad001'), ('u', 'ad002'), ('u', 'ad003')]]
+    for name, table in tables.items():
+        if name == 'allc_total_result':
+            continue
+        assert new_tables[name].astype(str).equals(table.astype(str)), name
 
 
 def test_pipeline():
     return
 
 
+def test_usage(tmp_path):
+    usage.start_usage_log(tmp_path)
+    try:
+        with usage.usage_unit('fastq_qc', 'u', 'ad001', 'R1'):
+            result = usage.run('echo a | cat', shell=True, stdout=subprocess.PIPE, encoding='utf8')
+        assert result.stdout == 'a\n'
+        try:
+            usage.run(['false'], check=True, unit=('bam_qc', 'u'))
+        except subprocess.CalledProcessError:
+            pass
+    finally:
+        usage.stop_usage_log()
+    usage_df = usage.read_usage(tmp_path)
+    assert usage_df['stage'].tolist() == ['fastq_qc', 'bam_qc']
+    assert usage_df['returncode'].tolist() == [0, 1]
+    assert usage_df.loc[0, 'read_type'] == 'R1'
+    assert pd.isna(usage_df.loc[1, 'index_name'])
+    assert usage_df[['wall_time', 'cpu_time']].notna().all().all()
+
+
+def test_manifest(tmp_path):
+    bam_path = tmp_path / 'u_ad001.final.bam'
+    bam_path.write_bytes(b'bam')
+    manifest = Manifest(tmp_path)
+    manifest.record('bam', 'u', 'ad001', [bam_path], result=[{'read_type': 'R1', 'out_reads': np.int64(10)}])
+    manifest.stage_finished('bismark', ['u'])
+    # a line truncated by a killed run
+    with open(tmp_path / 'u.manifest.jsonl', 'a') as f:
+        f.write('{"stage": "bam", "uid"')
+
+    manifest = Manifest(tmp_path)
+    assert manifest.stage_done('bismark', ['u'])
+    assert not manifest.stage_done('bismark', ['u', 'v'])
+    assert manifest.cell_result('bam', 'u', 'ad001') == [{'read_type': 'R1', 'out_reads': 10}]
+    assert not manifest.cell_done('bam', 'u', 'ad002')
+    # changed output need to run again
+    bam_path.write_bytes(b'bam, half written')
+    assert not manifest.cell_done('bam', 'u', 'ad001')
+
+
 def test_validate_fastq_dataframe():
     # use the provided fastq_dataframe, make sure the dataframe validation function worked
     return
@@ -43,3 +1133,78 @@ def test_validate_fastq_dataframe():
 
 def test_summary_pipeline_stat():
     return
+
+
+def test_scratch(tmp_path, caplog):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    config = configparser.ConfigParser()
+    config.read_dict({'scheduler': {'scratch_dir': ''}})
+    assert get_work_dir(out_dir, config) == (out_dir, None)
+    assert get_min_free(config) == 0
+
+    # the work dir and its marker are reused by a rerun, a lost work dir get a new marker
+    config['scheduler']['scratch_dir'] = str(tmp_path / 'scratch')
+    config['scheduler']['scratch_min_free'] = '0.5'
+    assert get_min_free(config) == 512 * 1024 ** 2
+    work_dir, marker = get_work_dir(out_dir, config)
+    assert work_dir.parent == tmp_path / 'scratch'
+    assert work_dir.name.startswith('out.')
+    assert marker.parent == work_dir
+    assert marker.read_text() == f'{out_dir}\n'
+    assert get_work_dir(out_dir, config) == (work_dir, marker)
+    shutil.rmtree(work_dir)
+    new_work_dir, new_marker = get_work_dir(out_dir, config)
+    assert new_work_dir == work_dir
+    assert new_marker.name != marker.name
+    # another out dir with the same name get its own work dir
+    (tmp_path / 'other').mkdir()
+    assert get_work_dir(tmp_path / 'other' / 'out', config)[0] != work_dir
+
+    with caplog.at_level(logging.WARNING, logger='cemba_data.mapping.scratch'):
+        check_free_space(work_dir, 0)
+        assert len(caplog.records) == 0
+        check_free_space(work_dir, 1 << 60)
+        assert 'may not fit' in caplog.records[0].getMessage()
+
+    # final bam and ALLC with their indexes are moved, other files stay in the work dir
+    for name in ['u_ad001.final.bam', 'allc_u_ad001.tsv.gz', 'allc_u_ad001.tsv.gz.idx',
+                 'allc_u_ad001.tsv.gz.tbi', 'u_ad001_R1.trimed.fq.gz', 'u_ad002.final.bam']:
+        (work_dir / name).write_text(name)
+    move_cell_outputs(work_dir, out_dir, 'u', 'ad001')
+    assert sorted(p.name for p in out_dir.iterdir()) == ['allc_u_ad001.tsv.gz', 'allc_u_ad001.tsv.gz.idx',
+                                                         'allc_u_ad001.tsv.gz.tbi', 'u_ad001.final.bam']
+    assert (out_dir / 'u_ad001.final.bam').read_text() == 'u_ad001.final.bam'
+    assert sorted(p.name for p in work_dir.iterdir()) == sorted([new_marker.name, 'u_ad001_R1.trimed.fq.gz',
+                                                                 'u_ad002.final.bam'])
+    # nothing to move without a scratch dir
+    move_cell_outputs(out_dir, out_dir, 'u', 'ad001')
+    assert len(list(out_dir.iterdir())) == 4
+
+    # out_dir is never removed as a work dir
+    remove_work_dir(out_dir, out_dir)
+    assert out_dir.exists()
+    remove_work_dir(work_dir, out_dir)
+    assert not work_dir.exists()
+    assert len(list(out_dir.iterdir())) == 4
+
+
+def test_stats_store(tmp_path):
+    for uid in ['001', '002']:
+        (tmp_path / uid / 'stats').mkdir(parents=True)
+        pd.DataFrame({'uid': [uid], 'index_name': ['ad001'], 'out_reads': [10]}) \
+            .to_csv(tmp_path / uid / 'stats' / 'bam_process_result.tsv.gz', sep='\t', index=False)
+    (tmp_path / '001' / 'allc_001_ad001.tsv.gz').write_bytes(b'')
+    stat_dirs, allc_paths, _ = scan_out_dir(tmp_path)
+    assert len(stat_dirs) == 2
+    assert allc_paths[('001', 'ad001')].endswith('allc_001_ad001.tsv.gz')
+    tables = update_stats_store(tmp_path, stat_dirs)
+    assert sorted(tables['bam_process_result']['uid']) == ['001', '002']
+
+    # changed run is read again, removed run is dropped
+    pd.DataFrame({'uid': ['002', '002'], 'index_name': ['ad001', 'ad002'], 'out_reads': [10, 20]}) \
+        .to_csv(tmp_path / '002' / 'stats' / 'bam_process_result.tsv.gz', sep='\t', index=False)
+    (tmp_path / '001' / 'stats' / 'bam_process_result.tsv.gz').unlink()
+    tables = update_stats_store(tmp_path)
+    assert tables['bam_process_result']['out_reads'].tolist() == [10, 20]
+    assert set(tables['bam_process_result']['run']) == {'002'}
@@ -0,0 +1,243 @@
+"""
+Test functions in cemba_data.tools
+ALLC and BGZF related functions working on the mapping outputs
+"""
+
+from cemba_data.tools.allc import merge_allc, extract_context_allc
+from cemba_data.tools.allc_io import read_allc, convert_allc, merge_binary_allc, merge_chrom, \
+    AllcChunk, BinaryAllcWriter
+from cemba_data.tools import bgzf
+from cemba_data.tools.bgzf import bgzip_allc
+import gzip
+import zipfile
+import pytest
+import numpy as np
+import pandas as pd
+
+ALLC_COLUMNS = ['chrom', 'pos', 'strand', 'context', 'mc', 'cov']
+
+
+def _write_text_allc(path, rows):
+    with open(path, 'w') as f:
+        for chrom, pos, strand, context, mc, cov in rows:
+            f.write(f'{chrom}\t{pos}\t{strand}\t{context}\t{mc}\t{cov}\t1\n')
+    return str(path)
+
+
+def _random_allc_rows(seed, n_sites=30000):
+    """Sorted sites of two chromosomes, spanning many BGZF blocks and tabix windows"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for chrom, n in [('chr1', n_sites), ('chr10', n_sites // 3)]:
+        pos = np.sort(rng.choice(np.arange(1, n * 10), size=n, replace=False))
+        cov = rng.integers(1, 100, size=n)
+        # a few sites above uint16 in the binary ALLC
+        cov[::1000] += 70000
+        mc = rng.integers(0, cov + 1)
+        strand = rng.choice(['+', '-'], size=n)
+        context = rng.choice(['CGA', 'CGT', 'CAG', 'CTT', 'CCC'], size=n)
+        rows += list(zip([chrom] * n, pos.tolist(), strand, context, mc.tolist(), cov.tolist()))
+    return rows
+
+
+def _allc_df(allc_path, **kwargs):
+    chunks = list(read_allc(allc_path, **kwargs))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=ALLC_COLUMNS)
+    return pd.concat([pd.DataFrame(chunk._asdict()) for chunk in chunks], ignore_index=True)
+
+
+def test_merge_mixed_allc(tmp_path):
+    text_path = _write_text_allc(tmp_path / 'a.tsv', [('chr2', 5, '+', 'CGT', 1, 2),
+                                                      ('chr2', 9, '-', 'CAG', 0, 1),
+                                                      ('chr1', 3, '+', 'CGA', 2, 2)])
+    binary_source = _write_text_allc(tmp_path / 'b.tsv', [('chr1', 3, '+', 'CGA', 1, 3),
+                                                          ('chr1', 7, '-', 'CTT', 0, 4),
+                                                          ('chr2', 9, '-', 'CAG', 1, 1)])
+    binary_path = str(tmp_path / 'b.allc.npz')
+    convert_allc(binary_source, binary_path)
+
+    # text ALLC first, methylpy can not read the binary one
+    out_path = str(tmp_path / 'merged.tsv.gz')
+    merge_allc([text_path, binary_path], out_path)
+    merged = _allc_df(out_path)
+    assert merged['chrom'].tolist() == ['chr2', 'chr2', 'chr1', 'chr1']
+    assert merged['pos'].tolist() == [5, 9, 3, 7]
+    assert merged['strand'].tolist() == ['+', '-', '+', '-']
+    assert merged['context'].tolist() == ['CGT', 'CAG', 'CGA', 'CTT']
+    assert merged['mc'].tolist() == [1, 1, 3, 0]
+    assert merged['cov'].tolist() == [2, 2, 5, 4]
+    assert np.issubdtype(merged['pos'].dtype, np.integer)
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_extract_context_allc(tmp_path, binary):
+    allc_path = _write_text_allc(tmp_path / 'a.tsv', [('chr1', 10, '+', 'CGA', 1, 2), ('chr1', 11, '-', 'CGT', 2, 3),
+                                                      ('chr1', 20, '+', 'CAG', 1, 1), ('chr1', 30, '-', 'CGT', 1, 1),
+                                                      ('chr1', 40, '+', 'CGC', 1, 1), ('chr1', 41, '-', 'CGC', 0, 1),
+                                                      ('chr1', 42, '+', 'CGA', 1, 1), ('chr1', 43, '-', 'CGC', 1, 2),
+                                                      ('chr2', 5, '-', 'CGA', 1, 1)])
+    if binary:
+        convert_allc(allc_path, str(tmp_path / 'a.allc.npz'))
+        allc_path = str(tmp_path / 'a.allc.npz')
+    # output is gzip even without the gz suffix
+    out_path = str(tmp_path / 'cg.tsv')
+    extract_context_allc(allc_path, out_path, merge_strand=True, mc_context='CGN')
+    with gzip.open(out_path, 'rt') as f:
+        assert f.read() == 'chr1\t10\t+\tCGA\t3\t5\t1\nchr1\t30\t-\tCGT\t1\t1\t1\n' \
+                           'chr1\t40\t+\tCGC\t1\t2\t1\nchr1\t42\t+\tCGA\t2\t3\t1\nchr2\t5\t-\tCGA\t1\t1\t1\n'
+
+    out_path = str(tmp_path / 'ch.tsv.gz')
+    extract_context_allc(allc_path, out_path, merge_strand=True, mc_context='CHN')
+    with gzip.open(out_path, 'rt') as f:
+        assert f.read() == 'chr1\t20\t+\tCAG\t1\t1\t1\n'
+
+
+def test_binary_allc_blocks(tmp_path):
+    allc_path = str(tmp_path / 'a.allc.npz')
+    pos = np.arange(1, 26) * 3
+    cov = np.ones(25, dtype=np.int64)
+    cov[7] = 70000
+    with BinaryAllcWriter(allc_path, block_size=10) as writer:
+        # chunks smaller than the block are joined, the chromosome change flush the last block
+        for i in range(0, 25, 4):
+            sl = slice(i, i + 4)
+            writer.write(AllcChunk('chr1', pos[sl], np.array(['+', '-', '-', '+'])[:pos[sl].size],
+                                   np.array(['CGA', 'CAG', 'CGA', 'CTT'])[:pos[sl].size], cov[sl] // 2, cov[sl]))
+        writer.write(AllcChunk('chr2', np.array([5]), np.array(['-']), np.array(['CCC']),
+                               np.array([0]), np.array([1])))
+        with pytest.raises(ValueError):
+            writer.write(AllcChunk('chr1', np.array([100]), np.array(['+']), np.array(['CGA']),
+                                   np.array([0]), np.array([1])))
+
+    with zipfile.ZipFile(allc_path) as z:
+        with z.open('blocks.npy') as f:
+            blocks = np.load(f)
+        with z.open('0.cov.npy') as f:
+            assert np.load(f).dtype == np.uint32
+        with z.open('1.cov.npy') as f:
+            assert np.load(f).dtype == np.uint16
+    # chrom index, first pos, last pos, n sites
+    assert blocks.tolist() == [[0, 3, 30, 10], [0, 33, 60, 10], [0, 63, 75, 5], [1, 5, 5, 1]]
+
+    df = _allc_df(allc_path, chrom='chr1', start=35, end=65)
+    assert df['pos'].tolist() == [36, 39, 42, 45, 48, 51, 54, 57, 60, 63]
+    assert df['strand'].tolist() == [['+', '-', '-', '+'][i % 4] for i in range(11, 21)]
+    assert df['cov'].tolist() == cov[11:21].tolist()
+    assert _allc_df(allc_path, chrom='chr2')['context'].tolist() == ['CCC']
+
+
+def test_bgzip_allc_tabix(tmp_path, monkeypatch):
+    pysam = pytest.importorskip('pysam')
+    # many read batches, one of them cross the chromosome change
+    monkeypatch.setattr(bgzf, '_BGZIP_READ_SIZE', 100000)
+    text_path = _write_text_allc(tmp_path / 'a.tsv', _random_allc_rows(0))
+    out_path = bgzip_allc(text_path, str(tmp_path / 'a.tsv.gz'), threads=2)
+    with open(text_path, 'rb') as f, gzip.open(out_path) as gz:
+        assert gz.read() == f.read()
+
+    df = pd.read_csv(text_path, sep='\t', header=None, usecols=[0, 1], names=['chrom', 'pos'])
+    with pysam.TabixFile(out_path) as tbx:
+        assert list(tbx.contigs) == ['chr1', 'chr10']
+        for chrom, start, end in [('chr1', 1, 100), ('chr1', 16384, 100000), ('chr10', 90000, 200000)]:
+            # 1-based inclusive region, tabix fetch is 0-based half open
+            fetched = [int(line.split('\t')[1]) for line in tbx.fetch(chrom, start - 1, end)]
+            expected = df.loc[(df['chrom'] == chrom) & (df['pos'] >= start) & (df['pos'] <= end), 'pos']
+            assert fetched == expected.tolist()
+
+
+def test_convert_allc(tmp_path):
+    text_path = _write_text_allc(tmp_path / 'a.tsv', _random_allc_rows(1))
+    binary_path = str(tmp_path / 'a.allc.npz')
+    convert_allc(text_path, binary_path)
+    back_path = str(tmp_path / 'b.tsv.gz')
+    convert_allc(binary_path, back_path, cpu=2)
+    with open(text_path, 'rb') as f, gzip.open(back_path) as gz:
+        assert gz.read() == f.read()
+    assert (tmp_path / 'b.tsv.gz.tbi').exists()
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_read_allc_filters(tmp_path, binary):
+    rows = _random_allc_rows(2)
+    allc_path = _write_text_allc(tmp_path / 'a.tsv', rows)
+    if binary:
+        convert_allc(allc_path, str(tmp_path / 'a.allc.npz'))
+        allc_path = str(tmp_path / 'a.allc.npz')
+    df = pd.DataFrame(rows, columns=ALLC_COLUMNS)
+
+    def check(judge, **kwargs):
+        result = _allc_df(allc_path, chunk_size=1000, **kwargs)
+        expected = df[judge].reset_index(drop=True)
+        for col in ALLC_COLUMNS:
+            assert result[col].tolist() == expected[col].tolist(), (kwargs, col)
+
+    check(df['chrom'] == 'chr10', chrom='chr10')
+    check(df['chrom'].isin(['chr1', 'chr10']), chrom=['chr10', 'chr1'])
+    check(df['chrom'].isin([]), chrom='chrX')
+    check((df['chrom'] == 'chr1') & (df['pos'] >= 5000) & (df['pos'] <= 150000),
+          chrom='chr1', start=5000, end=150000)
+    check(df['context'].isin(['CGA', 'CGT']), context_pattern='CGN')
+    check(df['context'].isin(['CGA']), context_pattern=['CGN'], contexts={'CGA', 'CAG'})
+    check((df['cov'] >= 10) & (df['cov'] <= 50), min_cov=10, max_cov=50)
+    check((df['chrom'] == 'chr10') & (df['context'] == 'CTT') & (df['cov'] >= 90),
+          chrom='chr10', context_pattern='CTN', min_cov=90)
+    with pytest.raises(ValueError):
+        list(read_allc(allc_path, start=1, end=100))
+
+
+def test_merge_binary_allc(tmp_path):
+    paths = []
+    dfs = []
+    for i in range(3):
+        rows = _random_allc_rows(10 + i, n_sites=3000)
+        text_path = _write_text_allc(tmp_path / f'{i}.tsv', rows)
+        # the last input stays text
+        if i < 2:
+            convert_allc(text_path, str(tmp_path / f'{i}.allc.npz'))
+            paths.append(str(tmp_path / f'{i}.allc.npz'))
+        else:
+            paths.append(text_path)
+        dfs.append(pd.DataFrame(rows, columns=ALLC_COLUMNS))
+
+    def merged_df(sub_dfs):
+        # chr1 is before chr10 in every input, so sorting the chromosomes keep the file order
+        return pd.concat(sub_dfs).groupby(['chrom', 'pos'], sort=True) \
+            .agg({'strand': 'first', 'context': 'first', 'mc': 'sum', 'cov': 'sum'}).reset_index()
+
+    for out_name, n_inputs in [('binary.allc.npz', 2), ('mixed.allc.npz', 3), ('mixed.tsv.gz', 3)]:
+        out_path = str(tmp_path / out_name)
+        merge_binary_allc(paths[:n_inputs], out_path)
+        result = _allc_df(out_path)
+        expected = merged_df(dfs[:n_inputs])
+        for col in ALLC_COLUMNS:
+            assert result[col].tolist() == expected[col].tolist(), (out_name, col)
+
+    # small chunks, sites are merged across the buffer bounds of each file
+    chunks = list(merge_chrom(paths, 'chr10', chunk_size=7))
+    assert len(chunks) > 1
+    merged_pos = np.concatenate([chunk.pos for chunk in chunks])
+    merged_cov = np.concatenate([chunk.cov for chunk in chunks])
+    expected = merged_df(dfs)
+    chrom_expected = expected[expected['chrom'] == 'chr10']
+    assert merged_pos.tolist() == chrom_expected['pos'].tolist()
+    assert merged_cov.tolist() == chrom_expected['cov'].tolist()
+
+
+def test_methylpy_snp_options(tmp_path):
+    from cemba_data.tools.methylpy_utilities import merge_allc_files, filter_allc_files, \
+        merge_allc_files_worker, filter_allc_file_worker
+    allc_path = _write_text_allc(tmp_path / 'a.tsv', [('chr1', 3, '+', 'CGA', 1, 3)])
+    out_path = str(tmp_path / 'out.tsv')
+    # SNP columns are not read any more, the options fail instead of being ignored
+    with pytest.raises(ValueError):
+        merge_allc_files([allc_path], out_path, skip_snp_info=False)
+    with pytest.raises(ValueError):
+        merge_allc_files_worker([allc_path], out_path, skip_snp_info=False)
+    with pytest.raises(ValueError):
+        filter_allc_files([allc_path], [out_path], max_mismatch=[1, 1, 1])
+    with pytest.raises(ValueError):
+        filter_allc_file_worker(allc_path, out_path, max_mismatch_frac=[0.5, 0.5, 0.5])
+    filter_allc_file_worker(allc_path, out_path, mc_type='CGN')
+    with open(out_path) as f:
+        assert f.read() == 'chr1\t3\t+\tCGA\t1\t3\t1\n'
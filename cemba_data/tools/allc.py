@@ -1,13 +1,13 @@
 from .utilities import *
-import gzip
-from functools import partial
 from pybedtools import BedTool, cleanup
 from subprocess import run
-from collections import defaultdict
 import pandas as pd
 import numpy as np
 import os
 from .methylpy_utilities import merge_allc_files
+from .bgzf import bgzip_allc
+from .allc_io import read_allc, is_binary_allc, open_allc_writer, merge_binary_allc, \
+    AllcChunk, select_sites, concat_chunks, BINARY_ALLC_SUFFIX
 
 
 def _split_to_chrom_bed(allc_path, context_pattern, genome_size_path,
@@ -42,58 +42,30 @@ def _split_to_chrom_bed(allc_path, context_pattern, genome_size_path,
                  for c in context_pattern
                  for chrom in chrom_set}
 
-    # open all paths
-    open_func = partial(open, mode='a')
-    # open func for allc:
-    if '.gz' in allc_path[-3:]:
-        allc_open_func = partial(gzip.open, mode='rt')
-    else:
-        allc_open_func = partial(open, mode='r')
-
-    # split ALLC
+    # split ALLC, max cov (for single cell data) and contexts are filtered by the reader
+    all_contexts = set().union(*pattern_dict.values())
     first = True
-    cur_chrom = None
-    handle_dict = None
-    with allc_open_func(allc_path) as allc:
-        for line in allc:
-            if first:
-                chrom = line.split('\t')[0]
-                # judge if the first line have chr or not, if not,
-                # but ref_chrom_have_chr is true, add chr for every line
-                if ref_chrom_have_chr and not chrom.startswith('chr'):
-                    need_to_add_chr = True
-                    chrom = 'chr' + chrom
-                if chrom not in chrom_set:
-                    continue
-                first = False
-                cur_chrom = chrom
-                handle_dict = {c: open_func(path_dict[(c, cur_chrom)]) for c in context_pattern}
-            ll = line.split('\t')
-            # filter max cov (for single cell data)
-            if (max_cov_cutoff is not None) and (int(ll[5]) > max_cov_cutoff):
-                continue
-            # judge chrom
-            chrom = ll[0]
-            if need_to_add_chr:
-                chrom = 'chr' + chrom
-            if chrom not in chrom_set:
-                continue
-            if chrom != cur_chrom:
-                cur_chrom = chrom
-                for handle in handle_dict.values():
-                    handle.close()
-                handle_dict = {c: open_func(path_dict[(c, cur_chrom)]) for c in context_pattern}
-            # bed format [chrom, start, end, mc, cov]
-            ll[1] = str(int(ll[1]) - 1)  # because bed is 0 based
-            bed_line = '\t'.join([chrom, ll[1], ll[1], ll[4], ll[5]]) + '\n'
-            # assign each line to its patten content,
-            # will write multiple times if patten overlap
-            for c, p in pattern_dict.items():
-                if ll[3] in p:
-                    handle_dict[c].write(bed_line)
-    # close handle
-    for handle in handle_dict.values():
-        handle.close()
+    for chunk in read_allc(allc_path, contexts=all_contexts, max_cov=max_cov_cutoff):
+        chrom = chunk.chrom
+        if first:
+            # judge if the first chrom have chr or not, if not,
+            # but ref_chrom_have_chr is true, add chr for every chunk
+            if ref_chrom_have_chr and not chrom.startswith('chr'):
+                need_to_add_chr = True
+            first = False
+        if need_to_add_chr:
+            chrom = 'chr' + chrom
+        if chrom not in chrom_set:
+            continue
+        # bed format [chrom, start, end, mc, cov], bed is 0 based
+        bed_df = pd.DataFrame({'chrom': chrom, 'start': chunk.pos - 1, 'end': chunk.pos - 1,
+                               'mc': chunk.mc, 'cov': chunk.cov})
+        # assign each site to its patten content,
+        # will write multiple times if patten overlap
+        for c, p in pattern_dict.items():
+            judge = np.isin(chunk.context, list(p))
+            with open(path_dict[(c, chrom)], 'a') as f:
+                bed_df[judge].to_csv(f, sep='\t', header=False, index=False)
     return path_dict
 
 
@@ -184,16 +156,23 @@ def map_to_region(allc_path, out_path_prefix,
 
 def merge_allc(allc_paths, out_path, cpu=1, index='tabix'):
     """
-    Just a wrapper of methylpy merge allc
+    Just a wrapper of methylpy merge allc, if any ALLC is binary, merge them with allc_io instead.
     :param allc_paths:
     :param out_path:
     :param cpu:
     :param index:
     :return:
     """
-    if len(allc_paths) == 1:
+    if len(allc_paths) == 1 and not is_binary_allc(allc_paths[0]):
         with open(allc_paths[0]) as f:
             allc_paths = [i.strip('\n') for i in f.readlines()]
+    if any(is_binary_allc(path) for path in allc_paths):
+        # methylpy can not read binary ALLC, all inputs are merged by numpy, text output is BGZF with tabix index
+        if not out_path.endswith(BINARY_ALLC_SUFFIX) and not out_path.endswith('.gz'):
+            out_path += '.gz'
+        if not os.path.exists(out_path):
+            merge_binary_allc(allc_paths, out_path, cpu=cpu)
+        return
     out_path = out_path.rstrip('.gz')
     if not os.path.exists(out_path + '.gz'):
         merge_allc_files(allc_paths,
@@ -204,11 +183,9 @@ def merge_allc(allc_paths, out_path, cpu=1, index='tabix'):
                          skip_snp_info=True,
                          buffer_line_number=100000,
                          index=False)
-        # use bgzip and tabix
-        run(['bgzip', out_path])
-
-        if index == 'tabix':
-            run(['tabix', '-b', '2', '-e', '2', '-s', '1', out_path + '.gz'])
+        # bgzip and tabix index in one pass
+        bgzip_allc(out_path, out_path + '.gz', threads=cpu, index=index == 'tabix')
+        os.remove(out_path)
     return
 
 
@@ -230,127 +207,93 @@ def allc_to_bigwig(allc_path, out_path, chrom_size, mc_type='CGN'):
     return
 
 
+def _merge_cg_strand(chunk):
+    """
+    Merge mc and cov of continuous +/- strand sites into the first site.
+    Sites are paired greedily from left to right, same as reading line by line,
+    so in a run of linked sites (CGCG...), the 1st and 2nd are merged, then the 3rd and 4th.
+
+    Returns
+    -------
+    merged chunk, and whether the last site is left unpaired
+    """
+    pos, strand = chunk.pos, chunk.strand
+    if pos.size < 2:
+        return chunk, True
+    link = (pos[1:] == pos[:-1] + 1) & (strand[1:] != strand[:-1])
+    idx = np.arange(link.size)
+    # index of the first link in the run each link belongs to
+    is_run_start = link & ~np.concatenate([[False], link[:-1]])
+    run_start = np.maximum.accumulate(np.where(is_run_start, idx, 0))
+    pair_first = link & ((idx - run_start) % 2 == 0)
+    second = np.concatenate([[False], pair_first])
+    mc = chunk.mc.copy()
+    cov = chunk.cov.copy()
+    mc[:-1][pair_first] += chunk.mc[1:][pair_first]
+    cov[:-1][pair_first] += chunk.cov[1:][pair_first]
+    keep = ~second
+    merged = AllcChunk(chunk.chrom, pos[keep], strand[keep], chunk.context[keep], mc[keep], cov[keep])
+    return merged, not second[-1]
+
+
 def extract_context_allc(allc_path, out_path, merge_strand=True, mc_context='CGN'):
-    if 'CG' not in mc_context:
+    """
+    Extract sub-ALLC for certain mc contexts, text or binary ALLC are both accepted.
+    Output is binary ALLC if out_path ends with .allc.npz, otherwise BGZF text ALLC with tabix index,
+    which is gzip compressed whatever the out_path suffix is, same as before.
+    """
+    if isinstance(mc_context, str):
+        mc_context = [mc_context]
+    if not any('CG' in c for c in mc_context):
         merge_strand = False
 
-    if allc_path.endswith('gz'):
-        opener = partial(gzip.open, mode='rt')
-    else:
-        opener = partial(open, mode='r')
-    writer = partial(gzip.open, mode='wt')
-
-    context_set = parse_mc_pattern(mc_context)
-    with opener(allc_path) as allc, \
-            writer(out_path) as out_allc:
-        if merge_strand:
-            prev_line = None
-            cur_chrom = None
-            for line in allc:
-                cur_line = line.strip('\n').split('\t')
-                if cur_line[3] not in context_set:
-                    continue
-                if cur_line[0] != cur_chrom:
-                    if prev_line is not None:
-                        out_allc.write('\t'.join(prev_line) + '\n')
-                    prev_line = cur_line
-                    cur_chrom = cur_line[0]
-                    continue
-                if prev_line is None:
-                    prev_line = cur_line
-                    continue
+    with open_allc_writer(out_path, bgzip=True) as out_allc:
+        carry = None  # last unpaired site of the previous chunk
+        for chunk in read_allc(allc_path, context_pattern=mc_context):
+            if not merge_strand:
+                out_allc.write(chunk)
+                continue
+            if carry is not None:
+                if carry.chrom == chunk.chrom:
+                    chunk = concat_chunks([carry, chunk])
                 else:
-                    # pos should be continuous, strand should be reverse
-                    if int(prev_line[1]) + 1 == int(cur_line[1]) and prev_line[2] != cur_line[2]:
-                        new_line = prev_line[:4] + [str(int(prev_line[4]) + int(cur_line[4])),
-                                                    str(int(prev_line[5]) + int(cur_line[5])), '1']
-                        out_allc.write('\t'.join(new_line) + '\n')
-                        prev_line = None
-                    # otherwise, only write and update prev_line
-                    else:
-                        out_allc.write('\t'.join(prev_line) + '\n')
-                        prev_line = cur_line
-        else:
-            for line in allc:
-                cur_line = line.strip('\n').split('\t')
-                if cur_line[3] not in context_set:
-                    continue
-                out_allc.write('\t'.join(cur_line) + '\n')
+                    out_allc.write(carry)
+                carry = None
+            merged, last_unpaired = _merge_cg_strand(chunk)
+            if last_unpaired:
+                # the last site may pair with the first site of next chunk
+                carry = select_sites(merged, slice(-1, None))
+                merged = select_sites(merged, slice(None, -1))
+            out_allc.write(merged)
+        if carry is not None:
+            out_allc.write(carry)
     print(f'Extract {mc_context} finished:', out_path)
     return
 
 
-def get_allc_profile(allc_path, drop_n=True, n_rows=100000000, out_path=None):
+def _profile_from_sums(sum_df):
     """
-    Generate approximate profile for allc file. 1e8 rows finish in about 5 min.
-
-    Parameters
-    ----------
-    allc_path
-        path of the allc file
-    drop_n
-        whether drop context contain N
-    n_rows
-        number of rows to use, 1e8 is sufficient to get an approximate profile
-    out_path
-        if not None, save profile to out_path
-    Returns
-    -------
-
+    Profile of each context from site sums, sum_df index is context,
+    columns are count, mc, cov, cov2, rate, rate2, the *2 columns are sum of square.
     """
-    if 'gz' in allc_path:
-        opener = partial(gzip.open, mode='rt')
-    else:
-        opener = partial(open, mode='r')
-
-    # initialize count dict
-    mc_sum_dict = defaultdict(int)
-    cov_sum_dict = defaultdict(int)
-    cov_sum2_dict = defaultdict(int)  # sum of square, for calculating variance
-    rate_sum_dict = defaultdict(float)
-    rate_sum2_dict = defaultdict(float)  # sum of square, for calculating variance
-    context_count_dict = defaultdict(int)
-    with opener(allc_path) as f:
-        n = 0
-        for line in f:
-            chrom, pos, strand, context, mc, cov, p = line.split('\t')
-            if drop_n and 'N' in context:
-                continue
-            # mc and cov
-            mc_sum_dict[context] += int(mc)
-            cov_sum_dict[context] += int(cov)
-            cov_sum2_dict[context] += int(cov) ** 2
-            # raw base rate
-            rate = int(mc) / int(cov)
-            rate_sum_dict[context] += rate
-            rate_sum2_dict[context] += rate ** 2
-            # count context finally
-            context_count_dict[context] += 1
-            n += 1
-            if (n_rows is not None) and (n >= n_rows):
-                break
     # overall count
-    profile_df = pd.DataFrame({'partial_mc': mc_sum_dict,
-                               'partial_cov': cov_sum_dict})
-    profile_df['base_count'] = pd.Series(context_count_dict)
+    profile_df = pd.DataFrame({'partial_mc': sum_df['mc'],
+                               'partial_cov': sum_df['cov']})
+    profile_df['base_count'] = sum_df['count']
     profile_df['overall_mc_rate'] = profile_df['partial_mc'] / profile_df['partial_cov']
 
     # cov base mean and base std.
     # assume that base cov follows normal distribution
-    cov_sum_series = pd.Series(cov_sum_dict)
-    cov_sum2_series = pd.Series(cov_sum2_dict)
-    profile_df['base_cov_mean'] = cov_sum_series / profile_df['base_count']
+    profile_df['base_cov_mean'] = sum_df['cov'] / profile_df['base_count']
     profile_df['base_cov_std'] = np.sqrt(
-        (cov_sum2_series / profile_df['base_count']) - profile_df['base_cov_mean'] ** 2)
+        (sum_df['cov2'] / profile_df['base_count']) - profile_df['base_cov_mean'] ** 2)
 
     # assume that base rate follow beta distribution
     # so that observed rate actually follow joint distribution of beta (rate) and normal (cov) distribution
     # here we use the observed base_rate_mean and base_rate_var to calculate
     # approximate alpha and beta value for the base rate beta distribution
-    rate_sum_series = pd.Series(rate_sum_dict)
-    rate_sum2_series = pd.Series(rate_sum2_dict)
-    profile_df['base_rate_mean'] = rate_sum_series / profile_df['base_count']
-    profile_df['base_rate_var'] = (rate_sum2_series / profile_df['base_count']) - profile_df['base_rate_mean'] ** 2
+    profile_df['base_rate_mean'] = sum_df['rate'] / profile_df['base_count']
+    profile_df['base_rate_var'] = (sum_df['rate2'] / profile_df['base_count']) - profile_df['base_rate_mean'] ** 2
 
     # based on beta distribution mean, var
     # a / (a + b) = base_rate_mean
@@ -361,6 +304,49 @@ def get_allc_profile(allc_path, drop_n=True, n_rows=100000000, out_path=None):
     b = a * (1 / profile_df['base_rate_mean'] - 1)
     profile_df['base_beta_a'] = a
     profile_df['base_beta_b'] = b
+    return profile_df
+
+
+def get_allc_profile(allc_path, drop_n=True, n_rows=100000000, out_path=None):
+    """
+    Generate approximate profile for allc file. 1e8 rows finish in about 5 min.
+
+    Parameters
+    ----------
+    allc_path
+        path of the allc file
+    drop_n
+        whether drop context contain N
+    n_rows
+        number of rows to use, 1e8 is sufficient to get an approximate profile
+    out_path
+        if not None, save profile to out_path
+    Returns
+    -------
+
+    """
+    # sum of each context, sum2 are sum of square, for calculating variance
+    sum_dfs = []
+    n = 0
+    for chunk in read_allc(allc_path):
+        if drop_n:
+            n_context = [c for c in pd.unique(chunk.context) if 'N' in c]
+            chunk = select_sites(chunk, ~np.isin(chunk.context, n_context))
+        if n_rows is not None:
+            chunk = select_sites(chunk, slice(None, n_rows - n))
+        # raw base rate
+        rate = chunk.mc / chunk.cov
+        chunk_df = pd.DataFrame({'context': chunk.context, 'mc': chunk.mc, 'cov': chunk.cov,
+                                 'cov2': chunk.cov ** 2, 'rate': rate, 'rate2': rate ** 2,
+                                 'count': 1})
+        sum_dfs.append(chunk_df.groupby('context').sum())
+        n += chunk.pos.size
+        if (n_rows is not None) and (n >= n_rows):
+            break
+    sum_df = pd.concat(sum_dfs).groupby(level=0).sum()
+    sum_df.index.name = None
+
+    profile_df = _profile_from_sums(sum_df)
 
     if out_path is not None:
         profile_df.to_csv(out_path, sep='\t')
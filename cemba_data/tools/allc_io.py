@@ -0,0 +1,504 @@
+"""
+Chunked ALLC reader and writer for the text ALLC and the binary ALLC.
+
+Binary ALLC is a zip container that np.load can open directly (same as .npz), sites are stored in blocks,
+each block belong to one chromosome:
+    {block}.pos.npy      uint32, delta encoded 1-based positions, the first one is the absolute position
+    {block}.strand.npy   np.packbits of the strand bit, 1 means "-"
+    {block}.context.npy  uint8 context code, row number in codebook
+    {block}.mc.npy       uint16 or uint32
+    {block}.cov.npy      uint16 or uint32
+And three metadata arrays written when the file is closed:
+    chroms.npy           chromosome names, in file order
+    codebook.npy         contexts
+    blocks.npy           int64 array, one row per block: chrom index, first pos, last pos, number of sites
+
+read_allc is the only ALLC parser of the tools, it yields AllcChunk batches, a batch only contain sites of one chromosome.
+"""
+
+import gzip
+import zipfile
+import collections
+import numpy as np
+import pandas as pd
+from .bgzf import BgzfWriter, TabixIndex
+from .utilities import parse_mc_pattern
+
+BINARY_ALLC_SUFFIX = '.allc.npz'
+# sites per chunk when reading, and sites per block in binary ALLC
+ALLC_CHUNK_SIZE = 1000000
+_ZIP_MAGIC = b'PK\x03\x04'
+
+AllcChunk = collections.namedtuple('AllcChunk', ['chrom', 'pos', 'strand', 'context', 'mc', 'cov'])
+
+
+def is_binary_allc(allc_path):
+    """Judge ALLC format by the magic bytes, text ALLC is plain text or gzip"""
+    with open(allc_path, 'rb') as f:
+        return f.read(4) == _ZIP_MAGIC
+
+
+def select_sites(chunk, selection):
+    """Subset all columns of a chunk with a bool mask, index or slice"""
+    return AllcChunk(chunk.chrom, *[col[selection] for col in chunk[1:]])
+
+
+def concat_chunks(chunks):
+    """Concatenate chunks of the same chromosome"""
+    if len(chunks) == 1:
+        return chunks[0]
+    return AllcChunk(chunks[0].chrom, *[np.concatenate(cols) for cols in zip(*[chunk[1:] for chunk in chunks])])
+
+
+def _judge_sites(pos, cov, start, end, min_cov, max_cov):
+    """Bool mask of region and coverage filters, None if no filter is given"""
+    judge = None
+    for values, cutoff, op in [(pos, start, np.greater_equal), (pos, end, np.less_equal),
+                               (cov, min_cov, np.greater_equal), (cov, max_cov, np.less_equal)]:
+        if cutoff is None:
+            continue
+        cur_judge = op(values, cutoff)
+        judge = cur_judge if judge is None else judge & cur_judge
+    return judge
+
+
+def _split_chunk_by_chrom(chrom, pos, strand, context, mc, cov):
+    """Split parsed columns into AllcChunk of each chromosome, chromosomes need to be contiguous"""
+    change = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+    bounds = np.concatenate([[0], change, [chrom.size]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield AllcChunk(chrom[start], pos[start:end], strand[start:end],
+                        context[start:end], mc[start:end], cov[start:end])
+
+
+def _read_methylpy_index(allc_path):
+    """chrom: uncompressed offset dict from the methylpy .idx file, None if the index not exist"""
+    index_path = allc_path + '.idx'
+    try:
+        with open(index_path) as f:
+            return {chrom: int(offset) for chrom, offset in
+                    (line.rstrip('\n').split('\t') for line in f if not line.startswith('#'))}
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _read_text_allc(allc_path, chunk_size, chroms=None, start=None, end=None,
+                    contexts=None, min_cov=None, max_cov=None):
+    handle = gzip.open(allc_path, 'rb') if allc_path.endswith('gz') else open(allc_path, 'rb')
+    if chroms is not None and len(chroms) == 1:
+        # jump to the chromosome with the methylpy index
+        chrom_offset = _read_methylpy_index(allc_path)
+        if chrom_offset is not None:
+            if list(chroms)[0] not in chrom_offset:
+                handle.close()
+                return
+            handle.seek(chrom_offset[list(chroms)[0]])
+    context_list = None if contexts is None else list(contexts)
+    with handle:
+        try:
+            reader = pd.read_csv(handle, sep='\t', header=None, usecols=[0, 1, 2, 3, 4, 5],
+                                 names=['chrom', 'pos', 'strand', 'context', 'mc', 'cov'],
+                                 dtype={'chrom': str, 'pos': np.int64, 'strand': str,
+                                        'context': str, 'mc': np.int64, 'cov': np.int64},
+                                 na_filter=False, chunksize=chunk_size)
+        except pd.errors.EmptyDataError:
+            return
+        remaining_chroms = None if chroms is None else set(chroms)
+        for df in reader:
+            for chunk in _split_chunk_by_chrom(*[df[col].to_numpy() for col in AllcChunk._fields]):
+                if chroms is not None:
+                    if chunk.chrom not in chroms:
+                        if len(remaining_chroms) == 0:
+                            # chromosomes are contiguous, all wanted chromosomes are passed
+                            return
+                        continue
+                    remaining_chroms.discard(chunk.chrom)
+                judge = _judge_sites(chunk.pos, chunk.cov, start, end, min_cov, max_cov)
+                if context_list is not None:
+                    context_judge = np.isin(chunk.context, context_list)
+                    judge = context_judge if judge is None else judge & context_judge
+                yield chunk if judge is None else select_sites(chunk, judge)
+
+
+def _read_binary_allc(allc_path, chroms=None, start=None, end=None,
+                      contexts=None, min_cov=None, max_cov=None):
+    with np.load(allc_path) as allc:
+        chrom_names = allc['chroms']
+        codebook = allc['codebook']
+        blocks = allc['blocks']
+        # context filter is done on codes, only the kept sites are decoded
+        context_codes = None if contexts is None else np.flatnonzero(np.isin(codebook, list(contexts)))
+        for block_id, (chrom_id, first_pos, last_pos, n_sites) in enumerate(blocks):
+            block_chrom = chrom_names[chrom_id]
+            if chroms is not None and block_chrom not in chroms:
+                continue
+            if (start is not None and last_pos < start) or (end is not None and first_pos > end):
+                continue
+            pos = np.cumsum(allc[f'{block_id}.pos'], dtype=np.int64)
+            code = allc[f'{block_id}.context']
+            cov = allc[f'{block_id}.cov'].astype(np.int64)
+            judge = _judge_sites(pos, cov, start, end, min_cov, max_cov)
+            if context_codes is not None:
+                context_judge = np.isin(code, context_codes)
+                judge = context_judge if judge is None else judge & context_judge
+            minus = np.unpackbits(allc[f'{block_id}.strand'], count=n_sites).astype(bool)
+            mc = allc[f'{block_id}.mc'].astype(np.int64)
+            if judge is not None:
+                pos, code, cov, minus, mc = pos[judge], code[judge], cov[judge], minus[judge], mc[judge]
+            yield AllcChunk(block_chrom, pos, np.where(minus, '-', '+'), codebook[code], mc, cov)
+
+
+def _rebatch(chunks, chunk_size):
+    """Regroup chunks into batches of chunk_size sites, only the last batch of each chromosome can be smaller"""
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        if chunk.pos.size == 0:
+            continue
+        if pending_size > 0 and chunk.chrom != pending[0].chrom:
+            yield concat_chunks(pending)
+            pending = []
+            pending_size = 0
+        pending.append(chunk)
+        pending_size += chunk.pos.size
+        if pending_size >= chunk_size:
+            merged = concat_chunks(pending)
+            n_batches = pending_size // chunk_size
+            for i in range(n_batches):
+                yield select_sites(merged, slice(i * chunk_size, (i + 1) * chunk_size))
+            pending_size -= n_batches * chunk_size
+            pending = [select_sites(merged, slice(n_batches * chunk_size, None))] if pending_size > 0 else []
+    if pending_size > 0:
+        yield concat_chunks(pending)
+
+
+def read_allc(allc_path, chrom=None, start=None, end=None, context_pattern=None, contexts=None,
+              min_cov=None, max_cov=None, chunk_size=ALLC_CHUNK_SIZE):
+    """
+    Read text or binary ALLC in batches, filters are applied inside the reader.
+    For binary ALLC, blocks outside the chromosomes or region are skipped and contexts are filtered by code.
+    For text ALLC, reading stops after the wanted chromosomes,
+    and jumps to the chromosome with the methylpy .idx if there is only one.
+
+    Parameters
+    ----------
+    allc_path
+        path of text ALLC (plain or gzip) or binary ALLC
+    chrom
+        if not None, only yield sites on this chromosome, can also be a list of chromosomes
+    start
+        1-based start of the region (inclusive), only used with a single chrom
+    end
+        1-based end of the region (inclusive), only used with a single chrom
+    context_pattern
+        mC context pattern such as CGN, or a list of patterns
+    contexts
+        set of exact contexts to keep, used together with context_pattern if both given
+    min_cov
+        keep sites with cov >= min_cov
+    max_cov
+        keep sites with cov <= max_cov
+    chunk_size
+        sites per batch, batches do not cross chromosomes,
+        so the last batch of each chromosome can be smaller
+    Returns
+    -------
+    Generator of AllcChunk, pos, mc, cov are int64 arrays, strand and context are str arrays
+    """
+    allc_path = str(allc_path)
+    if chrom is None:
+        chroms = None
+    elif isinstance(chrom, str):
+        chroms = {chrom}
+    else:
+        chroms = set(chrom)
+    if (start is not None or end is not None) and (chroms is None or len(chroms) != 1):
+        raise ValueError('Region start and end can only be used with a single chrom.')
+
+    if context_pattern is not None:
+        if isinstance(context_pattern, str):
+            context_pattern = [context_pattern]
+        pattern_contexts = set()
+        for pattern in context_pattern:
+            pattern_contexts |= parse_mc_pattern(pattern)
+        contexts = pattern_contexts if contexts is None else pattern_contexts & set(contexts)
+
+    if is_binary_allc(allc_path):
+        chunks = _read_binary_allc(allc_path, chroms=chroms, start=start, end=end,
+                                   contexts=contexts, min_cov=min_cov, max_cov=max_cov)
+    else:
+        chunks = _read_text_allc(allc_path, chunk_size, chroms=chroms, start=start, end=end,
+                                 contexts=contexts, min_cov=min_cov, max_cov=max_cov)
+    yield from _rebatch(chunks, chunk_size)
+
+
+def read_allc_chroms(allc_path):
+    """
+    Chromosomes of ALLC in file order. Binary ALLC only read the metadata,
+    text ALLC is read through, its methylpy .idx is not trusted for the order.
+    """
+    allc_path = str(allc_path)
+    if is_binary_allc(allc_path):
+        with np.load(allc_path) as allc:
+            return allc['chroms'].tolist()
+    chroms = []
+    for chunk in read_allc(allc_path):
+        if len(chroms) == 0 or chroms[-1] != chunk.chrom:
+            chroms.append(chunk.chrom)
+    return chroms
+
+
+def _count_dtype(values):
+    return np.uint16 if values.size == 0 or values.max() <= np.iinfo(np.uint16).max else np.uint32
+
+
+class BinaryAllcWriter:
+    """
+    Write AllcChunk into binary ALLC. Sites of each chromosome need to be written together and sorted.
+    """
+
+    def __init__(self, path, block_size=ALLC_CHUNK_SIZE, compress_level=1):
+        self.path = path
+        self.block_size = block_size
+        # low compress level, delta encoded columns already compress well and reading speed is what matters
+        self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED,
+                                    compresslevel=compress_level, allowZip64=True)
+        self._chroms = []
+        self._codebook = {}
+        self._blocks = []
+        self._cur_chrom = None
+        self._pending = []
+        self._pending_size = 0
+
+    def _write_array(self, name, array):
+        with self._zip.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, np.ascontiguousarray(array), allow_pickle=False)
+
+    def _encode_context(self, context):
+        # hash based factorize, much faster than np.unique on str arrays
+        inverse, unique_context = pd.factorize(np.asarray(context))
+        for c in unique_context:
+            if c not in self._codebook:
+                self._codebook[c] = len(self._codebook)
+        if len(self._codebook) > np.iinfo(np.uint8).max + 1:
+            raise ValueError('Binary ALLC support at most 256 different contexts.')
+        codes = np.array([self._codebook[c] for c in unique_context], dtype=np.uint8)
+        return codes[inverse]
+
+    def _write_block(self, pos, strand, context, mc, cov):
+        block_id = len(self._blocks)
+        pos = np.asarray(pos, dtype=np.int64)
+        self._write_array(f'{block_id}.pos', np.diff(pos, prepend=0).astype(np.uint32))
+        self._write_array(f'{block_id}.strand', np.packbits(np.asarray(strand) == '-'))
+        self._write_array(f'{block_id}.context', self._encode_context(context))
+        mc = np.asarray(mc)
+        cov = np.asarray(cov)
+        self._write_array(f'{block_id}.mc', mc.astype(_count_dtype(mc)))
+        self._write_array(f'{block_id}.cov', cov.astype(_count_dtype(cov)))
+        self._blocks.append([len(self._chroms) - 1, pos[0], pos[-1], pos.size])
+
+    def _flush(self, final):
+        if self._pending_size == 0:
+            return
+        columns = [np.concatenate(col) for col in zip(*self._pending)]
+        n_blocks = self._pending_size // self.block_size
+        if final and self._pending_size % self.block_size > 0:
+            n_blocks += 1
+        for i in range(n_blocks):
+            self._write_block(*[col[i * self.block_size:(i + 1) * self.block_size] for col in columns])
+        rest = n_blocks * self.block_size
+        self._pending_size = max(self._pending_size - rest, 0)
+        self._pending = [[col[rest:] for col in columns]] if self._pending_size > 0 else []
+
+    def write(self, chunk):
+        if chunk.pos.size == 0:
+            return
+        if chunk.chrom != self._cur_chrom:
+            self._flush(final=True)
+            if chunk.chrom in self._chroms:
+                raise ValueError(f'Sites of chromosome {chunk.chrom} are not contiguous.')
+            self._chroms.append(chunk.chrom)
+            self._cur_chrom = chunk.chrom
+        self._pending.append(chunk[1:])
+        self._pending_size += chunk.pos.size
+        if self._pending_size >= self.block_size:
+            self._flush(final=False)
+
+    def close(self):
+        if self._zip.fp is None:
+            return
+        self._flush(final=True)
+        self._write_array('chroms', np.array(self._chroms, dtype=str))
+        self._write_array('codebook', np.array(sorted(self._codebook, key=self._codebook.get), dtype=str))
+        self._write_array('blocks', np.array(self._blocks, dtype=np.int64).reshape(-1, 4))
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TextAllcWriter:
+    """
+    Write AllcChunk into text ALLC, BGZF with tabix index if bgzip is True.
+    bgzip is judged by whether path ends with gz if it is None.
+    """
+
+    def __init__(self, path, threads=1, bgzip=None, index=True):
+        self.path = path
+        if bgzip is None:
+            bgzip = path.endswith('gz')
+        if bgzip:
+            self._handle = BgzfWriter(path, threads=threads)
+            self._tabix_index = TabixIndex() if index else None
+        else:
+            self._handle = open(path, 'w')
+            self._tabix_index = None
+        self._cur_offset = 0
+
+    def write(self, chunk):
+        if chunk.pos.size == 0:
+            return
+        lines = [f'{chunk.chrom}\t{p}\t{s}\t{c}\t{m}\t{v}\t1\n'
+                 for p, s, c, m, v in zip(chunk.pos.tolist(), chunk.strand, chunk.context,
+                                          chunk.mc.tolist(), chunk.cov.tolist())]
+        out = ''.join(lines)
+        self._handle.write(out)
+        if self._tabix_index is not None:
+            line_end = self._cur_offset + np.cumsum(np.fromiter(map(len, lines), dtype=np.int64,
+                                                                count=len(lines)))
+            self._tabix_index.add_batch(chunk.chrom, chunk.pos,
+                                        np.append(self._cur_offset, line_end[:-1]), line_end)
+        self._cur_offset += len(out)
+
+    def close(self):
+        self._handle.close()
+        if self._tabix_index is not None and not self._tabix_index.resolved:
+            self._tabix_index.resolve(self._handle)
+            if len(self._tabix_index.chroms) > 0:
+                self._tabix_index.write(self.path + '.tbi')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_allc_writer(path, threads=1, bgzip=None, index=True):
+    """Binary ALLC writer if path ends with BINARY_ALLC_SUFFIX, otherwise text ALLC writer"""
+    path = str(path)
+    if path.endswith(BINARY_ALLC_SUFFIX):
+        return BinaryAllcWriter(path)
+    else:
+        return TextAllcWriter(path, threads=threads, bgzip=bgzip, index=index)
+
+
+def convert_allc(allc_path, out_path, cpu=1):
+    """
+    Convert text ALLC to binary ALLC or binary ALLC to text ALLC, direction is judged by the input format.
+
+    Parameters
+    ----------
+    allc_path
+        input ALLC path
+    out_path
+        output ALLC path, text output is BGZF compressed and tabix indexed if it ends with gz
+    cpu
+        threads to compress text output
+    """
+    allc_path = str(allc_path)
+    out_path = str(out_path)
+    if is_binary_allc(allc_path):
+        writer = TextAllcWriter(out_path, threads=cpu)
+    else:
+        writer = BinaryAllcWriter(out_path)
+    with writer:
+        for chunk in read_allc(allc_path):
+            writer.write(chunk)
+    return
+
+
+def _merge_chunks(chunks):
+    """Sum mc and cov of the same position, chunks are from the same chromosome"""
+    pos = np.concatenate([chunk.pos for chunk in chunks])
+    unique_pos, first, inverse = np.unique(pos, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    mc = np.bincount(inverse, weights=np.concatenate([chunk.mc for chunk in chunks]),
+                     minlength=unique_pos.size).astype(np.int64)
+    cov = np.bincount(inverse, weights=np.concatenate([chunk.cov for chunk in chunks]),
+                      minlength=unique_pos.size).astype(np.int64)
+    strand = np.concatenate([chunk.strand for chunk in chunks])[first]
+    context = np.concatenate([chunk.context for chunk in chunks])[first]
+    return AllcChunk(chunks[0].chrom, unique_pos, strand, context, mc, cov)
+
+
+def merge_chrom(allc_paths, chrom, chunk_size=ALLC_CHUNK_SIZE):
+    """
+    Streaming merge of one chromosome. Each round merge all buffered sites before the smallest
+    last buffered position among files that still have sites, so no file is read ahead too far.
+
+    Parameters
+    ----------
+    allc_paths
+        list of binary or text ALLC paths
+    chrom
+        chromosome to merge
+    chunk_size
+        sites per read batch of each file
+
+    Returns
+    -------
+    Generator of merged AllcChunk of the chromosome, mc and cov of the same position are summed
+    """
+    readers = [read_allc(allc_path, chrom=chrom, chunk_size=chunk_size) for allc_path in allc_paths]
+    buffers = [None] * len(readers)
+    while True:
+        for i, reader in enumerate(readers):
+            if reader is not None and buffers[i] is None:
+                buffers[i] = next(reader, None)
+                if buffers[i] is None:
+                    readers[i] = None
+        active = [buffer for buffer in buffers if buffer is not None]
+        if len(active) == 0:
+            return
+        # when all files are exhausted, merge everything left
+        bound = min([buffers[i].pos[-1] for i, reader in enumerate(readers) if reader is not None],
+                    default=np.iinfo(np.int64).max)
+        chunks = []
+        for i, buffer in enumerate(buffers):
+            if buffer is None:
+                continue
+            n = np.searchsorted(buffer.pos, bound, side='right')
+            chunks.append(select_sites(buffer, slice(None, n)))
+            buffers[i] = select_sites(buffer, slice(n, None)) if n < buffer.pos.size else None
+        yield _merge_chunks(chunks)
+
+
+def merge_binary_allc(allc_paths, out_path, cpu=1):
+    """
+    Merge ALLC files, mc and cov of the same position are summed.
+    Inputs are read by read_allc, so binary and text ALLC can be merged together.
+
+    Parameters
+    ----------
+    allc_paths
+        list of binary or text ALLC paths
+    out_path
+        output path, binary if it ends with BINARY_ALLC_SUFFIX, otherwise text ALLC
+    cpu
+        threads to compress text output
+    """
+    chrom_order = []
+    for allc_path in allc_paths:
+        for chrom in read_allc_chroms(allc_path):
+            if chrom not in chrom_order:
+                chrom_order.append(chrom)
+
+    with open_allc_writer(out_path, threads=cpu) as writer:
+        for chrom in chrom_order:
+            for chunk in merge_chrom(allc_paths, chrom):
+                writer.write(chunk)
+    return
@@ -0,0 +1,245 @@
+"""
+BGZF writer and tabix (.tbi) index builder for ALLC files.
+
+BGZF is a series of gzip members of at most 64 KB uncompressed data, any gzip reader can read it,
+samtools/htslib and tabix can random access it with virtual offset (compressed block offset << 16 | offset in block).
+ALLC records are always 1 bp long (tabix -s 1 -b 2 -e 2), so every record falls in the leaf bin of its 16 kb window,
+the binning index and the linear index are both built from the first and last record of each window.
+"""
+
+import io
+import struct
+import zlib
+import collections
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+# max uncompressed size of one block, same as bgzip
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# number of blocks compressed together in each batch, per thread
+_BLOCK_BATCH = 8
+# bytes of plain text ALLC read at once by bgzip_allc, lines in one read are indexed together
+_BGZIP_READ_SIZE = 1 << 24
+
+# tabix index constants
+_TBI_MAGIC = b'TBI\x01'
+_LINEAR_SHIFT = 14
+_LEAF_BIN_OFFSET = 4681  # ((1 << 15) - 1) // 7, first bin of the 16 kb level
+_META_BIN = 37450
+
+
+def _compress_block(data, level=6):
+    """Compress one BGZF block, data should be no more than BGZF_BLOCK_SIZE bytes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra subfield, which record total block size - 1
+    header = struct.pack('<BBBBIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord('B'), ord('C'), 2, len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter:
+    """
+    Write text or bytes into a BGZF file. Blocks are compressed by a thread pool when threads > 1,
+    zlib release the GIL, so blocks are compressed in parallel and written in order.
+    The compressed offset of every block is kept, so any uncompressed offset can be turned into a virtual offset.
+    Many writers can share one thread pool by passing the same executor, it is not shut down by the writer.
+    """
+
+    def __init__(self, path, threads=1, level=6, executor=None):
+        self.path = path
+        self.level = level
+        self.uncompressed_size = 0
+        # compressed offset of each block start, the last one is the current end of the file
+        self.block_offsets = [0]
+        self._handle = open(path, 'wb')
+        self._buffer = bytearray()
+        self._threads = threads
+        self._own_executor = executor is None and threads > 1
+        if executor is None and threads > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._executor = executor
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer += data
+        self.uncompressed_size += len(data)
+        if len(self._buffer) >= BGZF_BLOCK_SIZE * _BLOCK_BATCH * self._threads:
+            self._flush_blocks(final=False)
+        return len(data)
+
+    def _flush_blocks(self, final):
+        n_blocks = len(self._buffer) // BGZF_BLOCK_SIZE
+        if final and len(self._buffer) % BGZF_BLOCK_SIZE > 0:
+            n_blocks += 1
+        blocks = [bytes(self._buffer[i * BGZF_BLOCK_SIZE:(i + 1) * BGZF_BLOCK_SIZE]) for i in range(n_blocks)]
+        if self._executor is not None:
+            compressed_blocks = self._executor.map(_compress_block, blocks, [self.level] * n_blocks)
+        else:
+            compressed_blocks = (_compress_block(block, self.level) for block in blocks)
+        for compressed_block in compressed_blocks:
+            self._handle.write(compressed_block)
+            self.block_offsets.append(self.block_offsets[-1] + len(compressed_block))
+        del self._buffer[:n_blocks * BGZF_BLOCK_SIZE]
+        return
+
+    def virtual_offset(self, uncompressed_offset):
+        """Virtual offset of an uncompressed offset, the block need to be flushed already"""
+        block, within = divmod(uncompressed_offset, BGZF_BLOCK_SIZE)
+        return (self.block_offsets[block] << 16) | within
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self._flush_blocks(final=True)
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+        if self._own_executor:
+            self._executor.shutdown()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TabixIndex:
+    """
+    Tabix index of an ALLC file (1-based position in column 2, sorted, chromosomes are contiguous).
+    Records are added with their uncompressed start and end offsets while writing,
+    call resolve(writer) after the BgzfWriter closed to turn them into virtual offsets.
+    """
+
+    def __init__(self):
+        # chrom: [windows, start offsets, end offsets, record number]
+        self.chroms = collections.OrderedDict()
+        self.resolved = False
+
+    def add(self, chrom, pos, start_offset, end_offset):
+        """Add one record, pos is 1-based"""
+        window = (pos - 1) >> _LINEAR_SHIFT
+        if chrom not in self.chroms:
+            self.chroms[chrom] = [[window], [start_offset], [end_offset], 1]
+            return
+        windows, starts, ends, _ = record = self.chroms[chrom]
+        if windows[-1] == window:
+            ends[-1] = end_offset
+        else:
+            windows.append(window)
+            starts.append(start_offset)
+            ends.append(end_offset)
+        record[3] += 1
+        return
+
+    def add_batch(self, chrom, pos, start_offset, end_offset):
+        """Add sorted records of one chrom, all parameters are arrays"""
+        if len(pos) == 0:
+            return
+        window = (np.asarray(pos, dtype=np.int64) - 1) >> _LINEAR_SHIFT
+        unique_window, first = np.unique(window, return_index=True)
+        last = np.append(first[1:], window.size) - 1
+        starts = np.asarray(start_offset)[first].tolist()
+        ends = np.asarray(end_offset)[last].tolist()
+        unique_window = unique_window.tolist()
+        if chrom not in self.chroms:
+            self.chroms[chrom] = [[], [], [], 0]
+        windows, chrom_starts, chrom_ends, _ = record = self.chroms[chrom]
+        if len(windows) > 0 and windows[-1] == unique_window[0]:
+            chrom_ends[-1] = ends[0]
+            unique_window, starts, ends = unique_window[1:], starts[1:], ends[1:]
+        windows += unique_window
+        chrom_starts += starts
+        chrom_ends += ends
+        record[3] += window.size
+        return
+
+    def resolve(self, writer):
+        """Turn uncompressed offsets into virtual offsets of the closed writer"""
+        for windows, starts, ends, _ in self.chroms.values():
+            starts[:] = [writer.virtual_offset(offset) for offset in starts]
+            ends[:] = [writer.virtual_offset(offset) for offset in ends]
+        self.resolved = True
+        return
+
+    def shift(self, compressed_offset):
+        """Shift all virtual offsets, used when a BGZF file is appended after compressed_offset bytes"""
+        if not self.resolved:
+            raise ValueError('Resolve the index before shifting it.')
+        shift = compressed_offset << 16
+        for windows, starts, ends, _ in self.chroms.values():
+            starts[:] = [offset + shift for offset in starts]
+            ends[:] = [offset + shift for offset in ends]
+        return
+
+    def update(self, other):
+        """Append the chromosomes of another resolved index, chromosomes should not overlap"""
+        for chrom, record in other.chroms.items():
+            if chrom in self.chroms:
+                raise ValueError(f'Chromosome {chrom} already in the index.')
+            self.chroms[chrom] = record
+        return
+
+    def write(self, path):
+        """Write the .tbi file, the index need to be resolved"""
+        if not self.resolved:
+            raise ValueError('Resolve the index before writing it.')
+        names = b''.join(chrom.encode() + b'\x00' for chrom in self.chroms)
+        # generic format, seq col 1, begin col 2, end col 2, meta char #, skip 0 lines
+        data = [_TBI_MAGIC, struct.pack('<8i', len(self.chroms), 0, 1, 2, 2, ord('#'), 0, len(names)), names]
+        for windows, starts, ends, n_records in self.chroms.values():
+            data.append(struct.pack('<i', len(windows) + 1))
+            for window, start, end in zip(windows, starts, ends):
+                data.append(struct.pack('<IiQQ', _LEAF_BIN_OFFSET + window, 1, start, end))
+            # pseudo bin with the chrom offset range and the record numbers
+            data.append(struct.pack('<IiQQQQ', _META_BIN, 2, starts[0], ends[-1], n_records, 0))
+            # linear index, windows without record use the offset of the previous window
+            linear_index = [0] * (windows[-1] + 1)
+            for window, start in zip(windows, starts):
+                linear_index[window] = start
+            for i in range(1, len(linear_index)):
+                if linear_index[i] == 0:
+                    linear_index[i] = linear_index[i - 1]
+            data.append(struct.pack(f'<i{len(linear_index)}Q', len(linear_index), *linear_index))
+        with BgzfWriter(path) as f:
+            f.write(b''.join(data))
+        return
+
+
+def bgzip_allc(allc_path, out_path, threads=1, index=True):
+    """
+    Compress a plain text ALLC into BGZF and build its tabix index in the same pass,
+    replace bgzip + tabix -s 1 -b 2 -e 2.
+    Lines are read in batches of about _BGZIP_READ_SIZE bytes, the chrom and pos columns of a batch
+    are parsed by pandas and added to the index with TabixIndex.add_batch for each chromosome run.
+    """
+    tabix_index = TabixIndex() if index else None
+    cur_offset = 0
+    with open(allc_path, 'rb') as f, BgzfWriter(out_path, threads=threads) as writer:
+        while True:
+            lines = f.readlines(_BGZIP_READ_SIZE)
+            if len(lines) == 0:
+                break
+            data = b''.join(lines)
+            writer.write(data)
+            if tabix_index is not None:
+                line_end = cur_offset + np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)))
+                line_start = np.append(cur_offset, line_end[:-1])
+                df = pd.read_csv(io.BytesIO(data), sep='\t', header=None, usecols=[0, 1],
+                                 dtype={0: str, 1: np.int64}, na_filter=False)
+                chrom = df[0].to_numpy()
+                pos = df[1].to_numpy()
+                bounds = np.concatenate([[0], np.flatnonzero(chrom[1:] != chrom[:-1]) + 1, [chrom.size]])
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    tabix_index.add_batch(chrom[start], pos[start:end],
+                                          line_start[start:end], line_end[start:end])
+            cur_offset += len(data)
+    if tabix_index is not None:
+        tabix_index.resolve(writer)
+        if len(tabix_index.chroms) > 0:
+            tabix_index.write(out_path + '.tbi')
+    return out_path
@@ -213,6 +213,7 @@ import os
 import math
 import shlex
 import numpy as np
+import pandas as pd
 import subprocess
 import time
 import itertools
@@ -220,6 +221,7 @@ import multiprocessing
 import gzip
 import collections
 from pkg_resources import parse_version
+from .allc_io import read_allc, open_allc_writer, merge_chrom
 import glob
 
 
@@ -383,71 +385,43 @@ def convert_allc_to_bigwig(input_allc_file,
         g.write(fields[0] + "\t" + fields[1] + "\n")
     g.close()
 
-    # prepare wig file
-    cur_chrom = ""
-    bin_start, bin_end = 0, 0
-    bin_mc, bin_h, bin_site = 0, 0, 0
+    # prepare wig file, bins of each chrom are summed over chunks and written when the chrom ends
     g = open(output_file + ".wig", 'w')
-    with open_allc_file(input_allc_file) as f:
-        for line in f:
-            fields = line.split("\t")
-            if fields[3] not in mc_class:
-                continue
-            pos = int(fields[1]) - 1
-            if cur_chrom != fields[0] or pos >= bin_end:
-                try:
-                    if fields[0].startswith("chr"):
-                        cur_chrom_end = chrom_end[fields[0]]
-                    else:
-                        cur_chrom_end = chrom_end["chr" + fields[0]]
-                except KeyError:
-                    # chrom not in chrom size file
-                    continue
-
-                if bin_h > 0 and bin_site >= min_bin_sites and bin_h >= min_bin_cov:
-                    mc_level = str(float(bin_mc) / float(bin_h))
-                    if add_chr_prefix and not cur_chrom.startswith("chr"):
-                        g.write("\t".join(["chr" + cur_chrom,
-                                           str(bin_start),
-                                           str(bin_end),
-                                           mc_level]) + "\n")
-                    else:
-                        g.write("\t".join([cur_chrom,
-                                           str(bin_start),
-                                           str(bin_end),
-                                           mc_level]) + "\n")
-
-                if pos >= cur_chrom_end:
-                    print_warning("Skip site beyond chromosome boundary: " + line)
-                    cur_chrom = fields[0]
-                    bin_mc, bin_h, bin_site = 0, 0, 0
-                    continue
-                # reset
-                cur_chrom = fields[0]
-                bin_mc, bin_h, bin_site = 0, 0, 0
-                bin_end = int(float(pos) / float(bin_size) + 1) * bin_size
-                bin_start = bin_end - bin_size
-                if bin_end > cur_chrom_end:
-                    bin_end = cur_chrom_end
-            # update mc, h and site
-            h_site = int(fields[5])
-            if h_site >= min_site_cov \
-                    and (max_site_cov is None or h_site <= max_site_cov):
-                bin_mc += int(fields[4])
-                bin_h += h_site
-                bin_site += 1
-    if bin_h > 0 and bin_site >= min_bin_sites and bin_h >= min_bin_cov:
-        mc_level = str(float(bin_mc) / float(bin_h))
-        if add_chr_prefix and not cur_chrom.startswith("chr"):
-            g.write("\t".join(["chr" + cur_chrom,
-                               str(bin_start),
-                               str(bin_end),
-                               mc_level]) + "\n")
-        else:
-            g.write("\t".join([cur_chrom,
-                               str(bin_start),
-                               str(bin_end),
-                               mc_level]) + "\n")
+
+    def write_bins(chrom, bin_sums):
+        if chrom is None or len(bin_sums) == 0:
+            return
+        bin_df = pd.concat(bin_sums).groupby(level=0).sum()
+        bin_df = bin_df[(bin_df['h'] > 0) & (bin_df['site'] >= min_bin_sites) & (bin_df['h'] >= min_bin_cov)]
+        if add_chr_prefix and not chrom.startswith("chr"):
+            chrom = "chr" + chrom
+        out_df = pd.DataFrame({'chrom': chrom,
+                               'start': bin_df.index * bin_size,
+                               'end': np.minimum((bin_df.index + 1) * bin_size, cur_chrom_end),
+                               'mc_level': (bin_df['mc'] / bin_df['h']).map(str)})
+        out_df.to_csv(g, sep='\t', header=False, index=False)
+
+    cur_chrom = None
+    cur_chrom_end = 0
+    bin_sums = []
+    for chunk in read_allc(input_allc_file, contexts=mc_class,
+                           min_cov=min_site_cov, max_cov=max_site_cov):
+        if chunk.chrom != cur_chrom:
+            write_bins(cur_chrom, bin_sums)
+            cur_chrom = chunk.chrom
+            bin_sums = []
+            cur_chrom_end = chrom_end.get(cur_chrom if cur_chrom.startswith("chr") else "chr" + cur_chrom)
+        if cur_chrom_end is None:
+            # chrom not in chrom size file
+            continue
+        pos = chunk.pos - 1
+        judge = pos < cur_chrom_end
+        if not judge.all():
+            print_warning("Skip sites beyond chromosome boundary: " + cur_chrom)
+        # update mc, h and site of each bin
+        bin_sums.append(pd.DataFrame({'mc': chunk.mc[judge], 'h': chunk.cov[judge], 'site': 1},
+                                     index=pos[judge] // bin_size).groupby(level=0).sum())
+    write_bins(cur_chrom, bin_sums)
     g.close()
 
     # generate bigwig file
@@ -458,6 +432,19 @@ def convert_allc_to_bigwig(input_allc_file,
     subprocess.check_call(shlex.split("rm " + output_file + ".wig " + output_file + ".chrom_size"))
 
 
+def _check_snp_options(max_mismatch=None, max_mismatch_frac=None, skip_snp_info=True):
+    """
+    read_allc only keep the first six ALLC columns, the SNP match/mismatch columns are dropped,
+    so mismatch filters and merging SNP information are not available any more.
+    """
+    if max_mismatch is not None or max_mismatch_frac is not None:
+        raise ValueError('Mismatch-based filtering (max_mismatch, max_mismatch_frac) is not supported, '
+                         'the ALLC reader do not keep the SNP columns.')
+    if not skip_snp_info:
+        raise ValueError('Merging SNP information is not supported, the ALLC reader do not keep the SNP columns, '
+                         'use skip_snp_info=True.')
+
+
 def filter_allc_files(allc_files,
                       output_files,
                       num_procs=1,
@@ -476,6 +463,7 @@ def filter_allc_files(allc_files,
         exit("output files must be a list of string(s)")
     if len(allc_files) != len(output_files):
         exit("Number of allc files does not match number of output files")
+    _check_snp_options(max_mismatch=max_mismatch, max_mismatch_frac=max_mismatch_frac)
 
     if num_procs > 1:
         pool = multiprocessing.Pool(min(num_procs, len(allc_files)))
@@ -523,68 +511,16 @@ def filter_allc_file_worker(allc_file,
                             buffer_line_number=100000):
     if mc_type is not None:
         mc_class = expand_nucleotide_code(mc_type)
-    # input & output
-    f = open_allc_file(allc_file)
-    if compress_output:
-        if output_file[-3:] != ".gz":
-            output_file += ".gz"
-        output_fhandler = gzip.open(output_file, 'wt')
     else:
-        output_fhandler = open(output_file, 'w')
-    # begin
-    line_counts = 0
-    out = ""
-    for line in f:
-        fields = line.split("\t")
-        if (chroms is None or fields[0] in chroms) \
-                and (mc_type is None or fields[3] in mc_class) \
-                and int(fields[5]) >= min_cov \
-                and (max_cov is None or int(fields[5]) <= max_cov):
-            pass
-        else:
-            continue
-
-        if max_mismatch is not None or max_mismatch_frac is not None:
-            try:
-                matches = map(int, fields[7].split(","))
-                mismatches = map(int, fields[8].split(","))
-            except:
-                print_error("allc file " + allc_file + "does not contain SNP information used "
-                            + "for applying mismatch-based filtering!\n")
-            pass_snp_filter = True
-            if max_mismatch is not None:
-                try:
-                    for index, cutoff in enumerate(max_mismatch):
-                        if mismatches[index] > cutoff:
-                            pass_snp_filter = False
-                            break
-                except:
-                    pass
-            if max_mismatch_frac is not None:
-                try:
-                    for index, cutoff in enumerate(max_mismatch_frac):
-                        cov = mismatches[index] + matches[index]
-                        if cov > 0 and float(mismatches[index]) / float(cov) > cutoff:
-                            pass_snp_filter = False
-                            break
-                except:
-                    pass
-            if not pass_snp_filter:
-                continue
-
-        line_counts += 1
-        out += line
-        # print out once reach buffer limit
-        if line_counts > buffer_line_number:
-            output_fhandler.write(out)
-            line_counts = 0
-            out = ""
-    # clear buffer
-    if line_counts > 0:
-        output_fhandler.write(out)
-        out = ""
-    f.close()
-    output_fhandler.close()
+        mc_class = None
+    _check_snp_options(max_mismatch=max_mismatch, max_mismatch_frac=max_mismatch_frac)
+    # input & output
+    if compress_output and output_file[-3:] != ".gz":
+        output_file += ".gz"
+    with open_allc_writer(output_file, bgzip=compress_output) as output_fhandler:
+        for chunk in read_allc(allc_file, chrom=chroms, contexts=mc_class,
+                               min_cov=min_cov, max_cov=max_cov, chunk_size=buffer_line_number):
+            output_fhandler.write(chunk)
 
 
 def merge_allc_files(allc_files,
@@ -597,6 +533,7 @@ def merge_allc_files(allc_files,
     # User input checks
     if not isinstance(allc_files, list):
         exit("allc_files must be a list of string(s)")
+    _check_snp_options(skip_snp_info=skip_snp_info)
     # add .gz suffix
     if compress_output and output_file[-3:] != ".gz":
         output_file += ".gz"
@@ -694,6 +631,7 @@ def merge_allc_files_minibatch(allc_files,
     # User input checks
     if not isinstance(allc_files, list):
         exit("allc_files must be a list of string(s)")
+    _check_snp_options(skip_snp_info=skip_snp_info)
     # merge all files at once
     try:
         merge_allc_files_worker(allc_files=allc_files,
@@ -739,117 +677,26 @@ def merge_allc_files_worker(allc_files,
     if not isinstance(allc_files, list):
         exit("allc_files must be a list of string(s)")
 
-    # scan allc file to set up a table for fast look-up of lines belong
-    # to different chromosomes
-    fhandles = []
-    chrom_pointer = []
-    chroms = set([])
-    try:
-        for index, allc_file in enumerate(allc_files):
-            fhandles.append(open_allc_file(allc_file))
-            chrom_pointer.append(read_allc_index(allc_file))
-            for chrom in chrom_pointer[index].keys():
-                chroms.add(chrom)
-    except:
-        for f in fhandles:
-            f.close()
-        raise
-        # exit() # exit due to failure of openning all allc files at once
+    _check_snp_options(skip_snp_info=skip_snp_info)
+
+    # chromosomes in the order they first appear in the allc indexes
+    chroms = []
+    for allc_file in allc_files:
+        for chrom in read_allc_index(allc_file).keys():
+            if chrom not in chroms:
+                chroms.append(chrom)
     if query_chroms is not None:
         if isinstance(query_chroms, list):
             chroms = query_chroms
         else:
             chroms = [query_chroms]
     chroms = list(map(str, chroms))
-    # output
-    if compress_output:
-        g = gzip.open(output_file, 'wt')
-    else:
-        g = open(output_file, 'w')
 
-    # merge allc files
-    out = ""
-    for chrom in chroms:
-        cur_pos = np.array([np.nan for index in range(len(allc_files))])
-        cur_fields = []
-        num_remaining_allc = 0
-        # init
-        for index, allc_file in enumerate(allc_files):
-            fhandles[index].seek(chrom_pointer[index].get(chrom, 0))
-            line = fhandles[index].readline()
-            fields = line.split("\t")
-            cur_fields.append(None)
-            if fields[0] == chrom:
-                cur_pos[index] = int(fields[1])
-                cur_fields[index] = fields
-                num_remaining_allc += 1
-
-        # check consistency of SNP information
-        context_len = None
-        if not skip_snp_info:
-            for index, allc_file in enumerate(allc_files):
-                # skip allc with no data in this chromosome
-                if cur_fields[index] is None:
-                    continue
-                # SNP information is missing
-                if len(cur_fields[index]) < 9:
-                    print_warning("SNP information not found in " + allc_file + "!\n"
-                                  + "Skip SNP information\n")
-                    skip_snp_info = True
-                    break
-                # init contex_len
-                if context_len is None:
-                    context_len = len(cur_fields[index][7].split(","))
-                # check whether contex length are the same
-                if context_len != len(cur_fields[index][7].split(",")) or \
-                        context_len != len(cur_fields[index][8].split(",")):
-                    print_error("Inconsistent sequence context length: "
-                                + allc_file + "\n")
-        # merge
-        line_counts = 0
-        while num_remaining_allc > 0:
-            mc, h = 0, 0
-            if not skip_snp_info:
-                matches = [0 for index in range(context_len)]
-                mismatches = list(matches)
-            c_info = None
-            for index in np.where(cur_pos == np.nanmin(cur_pos))[0]:
-                mc += int(cur_fields[index][4])
-                h += int(cur_fields[index][5])
-                if not skip_snp_info:
-                    for ind, match, mismatch in zip(range(context_len),
-                                                    cur_fields[index][7].split(","),
-                                                    cur_fields[index][8].split(",")):
-                        matches[ind] += int(match)
-                        mismatches[ind] += int(mismatch)
-                if c_info is None:
-                    c_info = "\t".join(cur_fields[index][:4])
-                # update
-                line = fhandles[index].readline()
-                fields = line.split("\t")
-                if fields[0] == chrom:
-                    cur_pos[index] = int(fields[1])
-                    cur_fields[index] = fields
-                else:
-                    cur_pos[index] = np.nan
-                    num_remaining_allc -= 1
-            # output
-            if not skip_snp_info:
-                out += c_info + "\t" + str(mc) + "\t" + str(h) + "\t1" + "\t" \
-                       + ",".join(map(str, matches)) + "\t" + ",".join(map(str, mismatches)) + "\n"
-            else:
-                out += c_info + "\t" + str(mc) + "\t" + str(h) + "\t1\n"
-            line_counts += 1
-            if line_counts > buffer_line_number:
-                g.write(out)
-                line_counts = 0
-                out = ""
-    if line_counts > 0:
-        g.write(out)
-        out = ""
-    g.close()
-    for index in range(len(allc_files)):
-        fhandles[index].close()
+    # merge allc files, each file is read in batches and seek to the chrom with the index
+    with open_allc_writer(output_file, bgzip=compress_output, index=False) as g:
+        for chrom in chroms:
+            for chunk in merge_chrom(allc_files, chrom, chunk_size=buffer_line_number):
+                g.write(chunk)
     return 0
 
 
@@ -887,42 +734,38 @@ def index_allc_file(allc_file, reindex=False):
             pass
         else:
             return 0
-    g = open(index_file, 'w')
+    # offsets are uncompressed offsets, count line length while streaming, no decompress to disk
     if 'gz' in allc_file:
-        subprocess.run(f'pigz -d -p 8 {allc_file}', shell=True)
-        f = open(allc_file[:-3])
+        f = gzip.open(allc_file, 'rb')
     else:
-        f = open(allc_file)
+        f = open(allc_file, 'rb')
+    g = open(index_file, 'w')
 
-    cur_chrom = ""
+    cur_chrom = b""
+    cur_pointer = 0
     # check header
     line = f.readline()
     try:
-        fields = line.split("\t")
+        fields = line.split(b"\t")
         int(fields[1])
         int(fields[4])
         int(fields[5])
-        # no header, continue to start from the beginning of allc file
-        f.seek(0)
-        cur_pointer = 0
+        # no header, start from the beginning of allc file
+        lines = itertools.chain([line], f)
     except:
         # find header, skip it
-        cur_pointer = f.tell()
+        cur_pointer = len(line)
+        lines = f
     # find chrom pointer
-    while True:
-        line = f.readline()
-        if not line:
-            break
-        fields = line.split("\t")
-        if fields[0] != cur_chrom:
-            g.write(fields[0] + "\t" + str(cur_pointer) + "\n")
-            cur_chrom = fields[0]
-        cur_pointer = f.tell()
+    for line in lines:
+        chrom = line[:line.index(b"\t")] if b"\t" in line else line
+        if chrom != cur_chrom:
+            g.write(chrom.decode() + "\t" + str(cur_pointer) + "\n")
+            cur_chrom = chrom
+        cur_pointer += len(line)
     g.write("#eof\n")
     f.close()
     g.close()
-    if 'gz' in allc_file:
-        subprocess.run(f'pigz -p 8 {allc_file[:-3]}', shell=True)
     return 0
 
 